@@ -0,0 +1,162 @@
+"""Measures the read and write latency of the stores of the feed position
+
+Every store of poll_feed is read, written conditionally after a read, as
+poll_feed checkpoints, and written with an outdated expected id, which
+compare and set has to reject. Afterwards several threads increment a counter
+in the store with compare and set at the same time, and the final value shows
+whether an update got lost. The in-memory and file stores run locally, the
+S3 and DynamoDB stores need AWS credentials, an existing bucket or a table
+with the string hash key 'feed'.
+
+Example:
+    python3 benchmark/checkpoint_stores.py --store memory --store file \\
+        --store s3 --bucket my-bucket --store dynamodb --table dmm-integration-feed-checkpoints
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from run_benchmark import load_handler  # noqa: E402
+
+STORES = ['memory', 'file', 's3', 'dynamodb']
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--store', action='append', choices=STORES, default=[],
+                        help='the stores to measure, memory and file if none is given')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--contenders', type=int, default=4,
+                        help='threads which update the store at the same time')
+    parser.add_argument('--updates', type=int, default=25,
+                        help='updates per contender')
+    parser.add_argument('--bucket', help='bucket of the s3 store')
+    parser.add_argument('--table', help='table of the dynamodb store')
+    parser.add_argument('--key', default='benchmark/last_event_id',
+                        help='object key or feed key the stores use')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    args = parser.parse_args()
+
+    handler = load_handler('poll_feed')
+    with tempfile.TemporaryDirectory() as directory:
+        stores = StoreFactory(handler, args.key, directory, args.bucket, args.table)
+        report = {name: CheckpointBenchmark(stores.create, name).run(
+            args.iterations, args.contenders, args.updates)
+            for name in args.store or ['memory', 'file']}
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for name, result in report.items():
+            print('{}: {}'.format(name, ', '.join(
+                '{} p50 {:.2f} ms p99 {:.2f} ms'.format(operation, *latencies)
+                for operation, latencies in result['latency_ms'].items())))
+            print('  {} updates by {} contenders, {} applied, {} conflicts, {} lost'.format(
+                result['updates'], result['contenders'], result['applied'],
+                result['conflicts'], result['lost']))
+
+
+class StoreFactory:
+    """Creates stores of the same feed position, like overlapping runs of
+    poll_feed do
+    """
+
+    def __init__(self, handler, key: str, directory: str, bucket: str | None,
+        table: str | None):
+        self._handler = handler
+        self._key = key
+        self._directory = directory
+        self._bucket = bucket
+        self._table = table
+        self._values: dict[str, str] = {}
+
+    def create(self, name: str):
+        match name:
+            case 'memory':
+                return self._handler.InMemoryCheckpointStore(self._key, self._values)
+            case 'file':
+                return self._handler.FileCheckpointStore(os.path.join(self._directory, self._key))
+            case 's3':
+                if self._bucket is None:
+                    raise ValueError('--bucket is required for the s3 store')
+                return self._handler.LastProcessedEventIdRepo(
+                    self._handler.aws_client('s3'), self._bucket, self._key)
+            case 'dynamodb':
+                if self._table is None:
+                    raise ValueError('--table is required for the dynamodb store')
+                return self._handler.DynamoDBCheckpointStore(
+                    self._handler.aws_client('dynamodb'), self._table, self._key)
+
+
+class CheckpointBenchmark:
+    def __init__(self, create, name: str):
+        self._create = create
+        self._name = name
+
+    def run(self, iterations: int, contenders: int, updates: int) -> dict:
+        store = self._create(self._name)
+        store.put_last_event_id('0')
+        store.get_last_event_id()
+
+        latencies = {'get': [], 'put': [], 'rejected_compare_and_set': []}
+        for iteration in range(iterations):
+            latencies['get'].append(self._timed(store.get_last_event_id))
+            latencies['put'].append(self._timed(
+                lambda: store.put_last_event_id(str(iteration + 1))))
+            latencies['rejected_compare_and_set'].append(self._timed(
+                lambda: store.compare_and_set('outdated', 'rejected')))
+
+        return {'latency_ms': {operation: self._percentiles(values)
+                               for operation, values in latencies.items()},
+                **self._contend(contenders, updates)}
+
+    def _contend(self, contenders: int, updates: int) -> dict:
+        """Lets the contenders increment the stored number, each retrying
+        after a conflict until all its updates are applied
+        """
+
+        self._create(self._name).put_last_event_id('0')
+        conflicts = [0] * contenders
+
+        def contend(index: int) -> None:
+            store = self._create(self._name)
+            for _ in range(updates):
+                while True:
+                    current = store.get_last_event_id()
+                    if store.compare_and_set(current, str(int(current) + 1)):
+                        break
+                    conflicts[index] += 1
+
+        threads = [threading.Thread(target=contend, args=(index,)) for index in range(contenders)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        applied = int(self._create(self._name).get_last_event_id())
+        return {'contenders': contenders, 'updates': contenders * updates,
+                'applied': applied, 'conflicts': sum(conflicts),
+                'lost': contenders * updates - applied}
+
+    @staticmethod
+    def _timed(operation) -> float:
+        start = time.perf_counter()
+        operation()
+        return (time.perf_counter() - start) * 1000
+
+    @staticmethod
+    def _percentiles(values: list[float]) -> tuple[float, float]:
+        ordered = sorted(values)
+        return statistics.median(ordered), ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+"""Runs both Lambdas end to end against local stand-ins and reports their throughput
+
+poll_feed reads a workload of events from a local Data Mesh Manager and sends
+them to an in-memory queue, while manage_iam_policies consumes the queue in
+batches, as the event source mapping of Lambda does. Every call to Data Mesh
+Manager and AWS waits the configured latency. The report contains the events
+processed per second, the time from an event in Data Mesh Manager until its
+access change was applied (time to permission) and the remote calls per event.
+
+With --fault, calls fail at random, to quantify the cost of retries and
+recovery: the report then contains the injected faults, the failed
+invocations, dead-lettered messages and repeated writes to IAM and Data Mesh
+Manager, while the throughput and duration show how fast the backlog drains
+despite the faults.
+
+Example:
+    python3 benchmark/run_benchmark.py --scenario mixed --seed 7 --events 500 \\
+        --latency-ms dmm=30 --latency-ms iam=80 --latency-ms sqs=10
+
+    python3 benchmark/run_benchmark.py --no-fifo --fault iam:throttling=0.05 \\
+        --fault dmm:5xx=0.02 --fault sqs:partial_batch=0.1
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stand_ins import FAULTS, CallCounter, DMMStandIn, FaultInjector, IAMStandIn, \
+    S3StandIn, SecretsManagerStandIn, SQSStandIn  # noqa: E402
+from workload import SCENARIOS, WorkloadGenerator  # noqa: E402
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ['dmm', 's3', 'sqs', 'secretsmanager', 'iam']
+
+API_KEY = 'benchmark-api-key'
+BUCKET_NAME = 'dmm-integration'
+PROFILE_OBJECT_PREFIX = 'profiles/'
+# as configured in terraform, the queue redrives after max_receive_count + 1 receives
+MAX_RECEIVE_COUNT = 5
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--scenario', choices=SCENARIOS, default='mixed',
+                        help='the kind of workload, see benchmark/workload.py')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='runs with the same seed process the same workload')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='events per page of the feed')
+    parser.add_argument('--batch-size', type=int, default=10,
+                        help='records per invocation of manage_iam_policies')
+    parser.add_argument('--fifo', action=argparse.BooleanOptionalAction, default=True,
+                        help='send the events to a fifo queue')
+    parser.add_argument('--latency-ms', action='append', default=[], metavar='SERVICE=MS',
+                        help='latency per call of a service ({}), or of all services without a name'
+                        .format(', '.join(SERVICES)))
+    parser.add_argument('--fault', action='append', default=[], metavar='SERVICE:FAULT=RATE',
+                        help='share of calls of a service which fail with a fault ({})'
+                        .format(', '.join(FAULTS)))
+    parser.add_argument('--fault-timeout-ms', type=float, default=1000,
+                        help='time a call takes before it times out')
+    parser.add_argument('--profile-sample-rate', type=float, default=0,
+                        help='share of invocations which are profiled')
+    parser.add_argument('--profile-dir', default='profiles',
+                        help='directory the profiles are written to, readable with python3 -m pstats')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    args = parser.parse_args()
+
+    faults = FaultInjector(parse_faults(args.fault), args.seed, args.fault_timeout_ms / 1000) \
+        if len(args.fault) > 0 else None
+    benchmark = Benchmark(parse_latencies(args.latency_ms), args.page_size,
+                          args.batch_size, args.fifo, args.profile_sample_rate, faults)
+    report = benchmark.run(WorkloadGenerator(args.seed).generate(args.scenario, args.events))
+    if args.profile_sample_rate > 0:
+        report['profiles'] = benchmark.write_profiles(args.profile_dir)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+def parse_latencies(values: list[str]) -> dict[str, float]:
+    latencies = {service: 0.0 for service in SERVICES}
+    for value in values:
+        service, _, milliseconds = value.rpartition('=')
+        if service == '':
+            latencies = {name: float(milliseconds) / 1000 for name in SERVICES}
+        elif service in SERVICES:
+            latencies[service] = float(milliseconds) / 1000
+        else:
+            raise ValueError('Unknown service {}'.format(service))
+    return latencies
+
+
+def parse_faults(values: list[str]) -> dict[tuple[str, str], float]:
+    rates = {}
+    for value in values:
+        name, _, rate = value.rpartition('=')
+        service, _, fault = name.partition(':')
+        if service not in SERVICES:
+            raise ValueError('Unknown service {}'.format(service))
+        if fault not in FAULTS:
+            raise ValueError('Unknown fault {}'.format(fault))
+        rates[(service, fault)] = float(rate)
+    return rates
+
+
+def _load_module(name: str, path: str):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_handler(name: str):
+    """Imports the lambda_handler module of a function under its own name,
+    as both functions use the same module name
+
+    Each function gets its own copy of the shared module, as it does in its
+    bundle, so that the functions do not share the state of a warm container.
+    """
+
+    common = _load_module('{}_dmm_common'.format(name),
+                          os.path.join(REPOSITORY, 'src', 'common', 'dmm_common.py'))
+    previous = sys.modules.get('dmm_common')
+    sys.modules['dmm_common'] = common
+    try:
+        return _load_module('{}_lambda_handler'.format(name),
+                            os.path.join(REPOSITORY, 'src', name, 'lambda_handler.py'))
+    finally:
+        if previous is None:
+            del sys.modules['dmm_common']
+        else:
+            sys.modules['dmm_common'] = previous
+
+
+def shared_module(handler):
+    """Returns the copy of the shared module the given lambda_handler module uses"""
+
+    return sys.modules[handler.aws_client.__module__]
+
+
+class Context:
+    """Context of an invocation, as passed by Lambda"""
+
+    def __init__(self, timeout_seconds: float):
+        self.aws_request_id = str(uuid.uuid4())
+        self._deadline = time.time() + timeout_seconds
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int((self._deadline - time.time()) * 1000)
+
+
+class Benchmark:
+    def __init__(self, latencies: dict[str, float], page_size: int, batch_size: int, fifo: bool,
+        profile_sample_rate: float = 0, faults: FaultInjector | None = None):
+        self._counter = CallCounter()
+        self._faults = faults
+        self._dmm = DMMStandIn(self._counter, API_KEY, page_size, latencies['dmm'], faults)
+        self._s3 = S3StandIn(self._counter, latencies['s3'], faults)
+        self._sqs = SQSStandIn(self._counter, latencies['sqs'], faults)
+        self._secretsmanager = SecretsManagerStandIn(
+            self._counter, {'dmm-api-key': API_KEY}, latencies['secretsmanager'], faults)
+        self._iam = IAMStandIn(self._counter, latencies['iam'], faults)
+        self._batch_size = batch_size
+        self._profile_sample_rate = profile_sample_rate
+        self._queue_url = self._sqs.queue_url('dmm-events.fifo' if fifo else 'dmm-events')
+        self._poll_feed = load_handler('poll_feed')
+        self._manage_iam_policies = load_handler('manage_iam_policies')
+        self._dead_letter_queue_url = self._sqs.queue_url('dmm-events-dlq')
+        self._metrics_sinks = {}
+        self._poll_failures = 0
+        self._invocation_failures = 0
+
+    def run(self, workload: dict) -> dict:
+        self._configure()
+        self._dmm.start()
+        try:
+            return self._run(workload)
+        finally:
+            self._dmm.stop()
+
+    def _configure(self) -> None:
+        os.environ.update({
+            'dmm_base_url': self._dmm.base_url,
+            'dmm_api_key_secret_name': 'dmm-api-key',
+            'bucket_name': BUCKET_NAME,
+            'last_event_id_object_name': 'last_event_id',
+            'circuit_state_object_name': 'circuit_state',
+            'sqs_queue_url': self._queue_url,
+            'dead_letter_queue_url': self._dead_letter_queue_url,
+            'max_receive_count': str(MAX_RECEIVE_COUNT),
+            'log_level': os.environ.get('log_level', 'ERROR'),
+            # profiles are written to the s3 stand-in
+            'profile_sample_rate': str(self._profile_sample_rate),
+            'profile_bucket_name': BUCKET_NAME,
+            'profile_object_prefix': PROFILE_OBJECT_PREFIX,
+        })
+        if self._faults is not None:
+            os.environ.update({
+                # a delayed response times out, as it does in the functions
+                'dmm_read_timeout': str(self._faults.timeout_seconds / 2),
+                # a circuit opened by faults closes within a run
+                'dmm_circuit_reset_timeout_seconds': os.environ.get(
+                    'dmm_circuit_reset_timeout_seconds', '1'),
+            })
+        clients = {'s3': self._s3, 'sqs': self._sqs,
+                   'secretsmanager': self._secretsmanager, 'iam': self._iam}
+        for name, handler in (('poll_feed', self._poll_feed),
+                              ('manage_iam_policies', self._manage_iam_policies)):
+            handler.reset_warm_container()
+            common = shared_module(handler)
+            common._aws_clients.update(clients)
+            self._metrics_sinks[name] = common.InMemoryMetricsSink()
+            common._metrics = common.Metrics(sink=self._metrics_sinks[name])
+
+    def write_profiles(self, directory: str) -> int:
+        """Writes the profiles of all sampled invocations and returns their number"""
+
+        profiles = 0
+        for (_, key), body in self._s3.objects.items():
+            if not key.startswith(PROFILE_OBJECT_PREFIX):
+                continue
+            path = os.path.join(directory, key[len(PROFILE_OBJECT_PREFIX):])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                file.write(body)
+            profiles += key.endswith('.prof')
+        return profiles
+
+    def _run(self, workload: dict) -> dict:
+        for dataproduct in workload['dataproducts']:
+            self._dmm.add_dataproduct(dataproduct)
+        for data_usage_agreement in workload['data_usage_agreements']:
+            self._dmm.add_data_usage_agreement(data_usage_agreement)
+
+        started_at = time.perf_counter()
+        for event in workload['events']:
+            # the whole workload is a backlog, created when the run starts, so
+            # that the time to permission is measured from there
+            self._dmm.add_event({**event, 'time': datetime.now(timezone.utc).isoformat()})
+
+        poller = threading.Thread(target=self._poll)
+        poller.start()
+        invocations = self._consume(poller)
+        duration = time.perf_counter() - started_at
+
+        return self._report(len(workload['events']), duration, invocations)
+
+    def _poll(self) -> None:
+        last_event_id = self._dmm.last_event_id()
+        while self._checkpoint() != last_event_id:
+            try:
+                self._poll_feed.lambda_handler({}, Context(59))
+            except Exception:
+                # the next scheduled invocation starts from the last checkpoint
+                self._poll_failures += 1
+
+    def _checkpoint(self) -> str | None:
+        checkpoint = self._s3.objects.get((BUCKET_NAME, 'last_event_id'))
+        return None if checkpoint is None else checkpoint.decode('utf-8')
+
+    def _consume(self, poller: threading.Thread) -> int:
+        invocations = 0
+        while poller.is_alive() or self._sqs.depth(self._queue_url) > 0:
+            records = self._sqs.receive_records(self._queue_url, self._batch_size)
+            if len(records) == 0:
+                time.sleep(0.001)
+                continue
+
+            invocations += 1
+            try:
+                response = self._manage_iam_policies.lambda_handler({'Records': records}, Context(30))
+                failed = {failure['itemIdentifier'] for failure in response['batchItemFailures']}
+            except Exception:
+                # the whole batch is received again
+                self._invocation_failures += 1
+                failed = {record['messageId'] for record in records}
+            self._return_failed([record for record in records if record['messageId'] in failed])
+        return invocations
+
+    def _return_failed(self, records: list[dict]) -> None:
+        redriven = [record for record in records
+                    if int(record['attributes']['ApproximateReceiveCount']) > MAX_RECEIVE_COUNT]
+        self._sqs.return_records(self._dead_letter_queue_url, redriven)
+        self._sqs.return_records(self._queue_url,
+                                 [record for record in records if record not in redriven])
+
+    def _report(self, events: int, duration: float, invocations: int) -> dict:
+        manage_iam_policies = self._metrics_sinks['manage_iam_policies']
+        # events of the same agreement in a batch are collapsed into one access change
+        time_to_permission = sorted(manage_iam_policies.values('AccessChangeLatency'))
+
+        calls = {}
+        for (service, operation), count in sorted(self._counter.calls().items()):
+            calls['{}.{}'.format(service, operation)] = {
+                'calls': count, 'per_event': round(count / events, 3)}
+
+        report = {
+            'events': events,
+            'access_changes': len(time_to_permission),
+            'errors': sum(manage_iam_policies.values('EventErrors')),
+            'invocations': invocations,
+            'duration_seconds': round(duration, 3),
+            'events_per_second': round(events / duration, 1),
+            'time_to_permission_ms': {
+                'p50': round(percentile(time_to_permission, 50), 1),
+                'p99': round(percentile(time_to_permission, 99), 1),
+                'max': round(time_to_permission[-1], 1) if len(time_to_permission) > 0 else 0.0
+            },
+            'calls': calls,
+            'calls_per_event': round(sum(call['calls'] for call in calls.values()) / events, 3)
+        }
+        if self._faults is not None:
+            report['faults'] = {
+                'injected': {'{}:{}'.format(*key): count
+                             for key, count in sorted(self._faults.injected().items())},
+                'failed_polls': self._poll_failures,
+                'failed_invocations': self._invocation_failures,
+                # sent again after a failed poll or send
+                'duplicate_messages': self._sqs.sent_messages.get(self._queue_url, 0) - events,
+                'dead_lettered': self._sqs.depth(self._dead_letter_queue_url),
+                'repeated_writes': {'iam': self._iam.repeated_writes,
+                                    'dmm': self._dmm.repeated_writes}
+            }
+        return report
+
+
+def percentile(sorted_values: list[float], value: float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    # nearest rank, as the metrics of the functions
+    rank = -(-value * len(sorted_values) // 100)
+    return sorted_values[max(int(rank), 1) - 1]
+
+
+def print_report(report: dict) -> None:
+    print('Processed {} events with {} access changes in {} s, {} invocations, {} errors'.format(
+        report['events'], report['access_changes'], report['duration_seconds'],
+        report['invocations'], report['errors']))
+    print('Throughput: {} events/s'.format(report['events_per_second']))
+    print('Time to permission: p50 {p50} ms, p99 {p99} ms, max {max} ms'
+                 .format(**report['time_to_permission_ms']))
+    print('Remote calls per event: {}'.format(report['calls_per_event']))
+    for name, call in report['calls'].items():
+        print('  {:<40} {:>8} {:>8}'.format(name, call['calls'], call['per_event']))
+    if 'faults' in report:
+        faults = report['faults']
+        print('Faults: {}'.format(', '.join('{} {}'.format(name, count)
+                                            for name, count in faults['injected'].items()) or 'none'))
+        print('  failed polls {}, failed invocations {}, duplicate messages {}, dead-lettered {}'
+              .format(faults['failed_polls'], faults['failed_invocations'],
+                      faults['duplicate_messages'], faults['dead_lettered']))
+        print('  repeated writes: iam {iam}, dmm {dmm}'.format(**faults['repeated_writes']))
+    if 'profiles' in report:
+        print('Profiles: {}'.format(report['profiles']))
+
+
+if __name__ == '__main__':
+    main()
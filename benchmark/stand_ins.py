@@ -0,0 +1,464 @@
+"""Local stand-ins for Data Mesh Manager and the AWS services both Lambdas call
+
+Every stand-in waits a configurable time per call, to simulate the latency of
+the real service, and counts its calls by operation. The AWS stand-ins only
+implement the operations and responses the Lambdas use.
+
+With a FaultInjector, calls fail at random with throttling, server errors,
+timeouts or 404s, and entries of SendMessageBatch fail on their own. The AWS
+stand-ins retry failed calls as botocore does by default, so that every
+attempt is counted and waited for like in the Lambda.
+"""
+
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+FAULTS = ['throttling', '5xx', 'timeout', '404', 'partial_batch']
+
+# botocore retries throttling, server errors and timeouts with up to 5 attempts
+BOTOCORE_MAX_ATTEMPTS = 5
+
+
+class CallCounter:
+    """Counts calls by service and operation, shared by all stand-ins"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[tuple[str, str], int] = {}
+
+    def add(self, service: str, operation: str) -> None:
+        with self._lock:
+            key = (service, operation)
+            self._calls[key] = self._calls.get(key, 0) + 1
+
+    def calls(self) -> dict[tuple[str, str], int]:
+        with self._lock:
+            return dict(self._calls)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._calls = {}
+
+
+class FaultInjector:
+    """Decides with a seeded random generator which calls fail and how
+
+    Rates are set per service and fault, e.g. ('iam', 'throttling') = 0.05
+    fails 5% of all IAM calls with a throttling error. A timed out call takes
+    timeout_seconds before it fails.
+    """
+
+    def __init__(self, rates: dict[tuple[str, str], float], seed: int = 1,
+        timeout_seconds: float = 1.0):
+        self._rates = rates
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._injected: dict[tuple[str, str], int] = {}
+        self.timeout_seconds = timeout_seconds
+
+    def fault(self, service: str, faults: list[str]) -> str | None:
+        """Returns the fault of a call, if it fails"""
+
+        with self._lock:
+            for fault in faults:
+                rate = self._rates.get((service, fault), 0.0)
+                if rate > 0 and self._random.random() < rate:
+                    key = (service, fault)
+                    self._injected[key] = self._injected.get(key, 0) + 1
+                    return fault
+        return None
+
+    def backoff(self, attempt: int) -> float:
+        # the exponential backoff of botocore's legacy retry mode
+        with self._lock:
+            return self._random.random() * 2 ** (attempt - 1)
+
+    def injected(self) -> dict[tuple[str, str], int]:
+        with self._lock:
+            return dict(self._injected)
+
+
+class StandIn:
+    # error codes of the faults, as the service returns them
+    error_codes = {'throttling': 'Throttling', '5xx': 'InternalError', '404': 'NotFound'}
+
+    def __init__(self, service: str, counter: CallCounter, latency_seconds: float = 0.0,
+        faults: FaultInjector | None = None):
+        self._service = service
+        self._counter = counter
+        self.latency_seconds = latency_seconds
+        self._faults = faults
+
+    def _call(self, operation: str, faults: tuple[str, ...] = ('throttling', '5xx', 'timeout')) -> None:
+        attempt = 0
+        while True:
+            attempt += 1
+            self._counter.add(self._service, operation)
+            if self.latency_seconds > 0:
+                time.sleep(self.latency_seconds)
+            fault = None if self._faults is None else self._faults.fault(self._service, list(faults))
+            if fault is None:
+                return
+            if fault == 'timeout':
+                time.sleep(self._faults.timeout_seconds)
+            # a 404 is not retried
+            if fault == '404' or attempt >= BOTOCORE_MAX_ATTEMPTS:
+                raise self._fault_error(fault, operation)
+            time.sleep(self._faults.backoff(attempt))
+
+    def _fault_error(self, fault: str, operation: str) -> Exception:
+        if fault == 'timeout':
+            return ReadTimeoutError(endpoint_url='https://{}.amazonaws.com'.format(self._service))
+        return self._client_error(self.error_codes[fault], operation)
+
+    def _client_error(self, code: str, operation: str) -> ClientError:
+        return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+def sqs_record(message_id: str, body: str, message_attributes: dict,
+    message_group_id: str | None, sent_timestamp: int, queue_arn: str,
+    receive_count: int = 0) -> dict:
+    """Returns a message as a record of an SQS event of Lambda"""
+
+    attributes = {'ApproximateReceiveCount': str(receive_count),
+                  'SentTimestamp': str(sent_timestamp)}
+    if message_group_id is not None:
+        attributes['MessageGroupId'] = message_group_id
+    return {
+        'messageId': message_id,
+        'receiptHandle': message_id,
+        'body': body,
+        'attributes': attributes,
+        'messageAttributes': {
+            name: {'dataType': attribute['DataType'],
+                   'stringValue': attribute['StringValue']}
+            for name, attribute in message_attributes.items()},
+        'eventSourceARN': queue_arn
+    }
+
+
+class S3StandIn(StandIn):
+    error_codes = {'throttling': 'SlowDown', '5xx': 'InternalError', '404': 'NoSuchKey'}
+
+    def __init__(self, counter: CallCounter, latency_seconds: float = 0.0,
+        faults: FaultInjector | None = None):
+        super().__init__('s3', counter, latency_seconds, faults)
+        self._lock = threading.Lock()
+        self.objects: dict[tuple[str, str], bytes] = {}
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        self._call('GetObject', ('throttling', '5xx', 'timeout', '404'))
+        with self._lock:
+            body = self.objects.get((Bucket, Key))
+        if body is None:
+            raise self._client_error('NoSuchKey', 'GetObject')
+        return {'Body': _Body(body), 'ETag': self._etag(body)}
+
+    def put_object(self, Body: str | bytes, Bucket: str, Key: str,
+        IfMatch: str | None = None, IfNoneMatch: str | None = None, **kwargs) -> dict:
+        self._call('PutObject')
+        body = Body.encode('utf-8') if isinstance(Body, str) else Body
+        with self._lock:
+            # conditional writes, as S3 checks them
+            current = self.objects.get((Bucket, Key))
+            if (IfNoneMatch == '*' and current is not None) or (IfMatch is not None and (
+                current is None or self._etag(current) != IfMatch)):
+                raise self._client_error('PreconditionFailed', 'PutObject')
+            self.objects[(Bucket, Key)] = body
+        return {'ETag': self._etag(body)}
+
+    @staticmethod
+    def _etag(body: bytes) -> str:
+        return '"{}"'.format(hashlib.md5(body).hexdigest())
+
+
+class _Body:
+    def __init__(self, content: bytes):
+        self._content = content
+
+    def read(self) -> bytes:
+        return self._content
+
+
+class SQSStandIn(StandIn):
+    """Keeps the messages of all queues in memory
+
+    Messages are received as the records of an SQS event of Lambda. Records
+    which are returned as failed are put back at the end of their queue.
+    """
+
+    region = 'eu-central-1'
+    account_id = '000000000000'
+    error_codes = {'throttling': 'RequestThrottled', '5xx': 'InternalError',
+                   '404': 'AWS.SimpleQueueService.NonExistentQueue'}
+
+    def __init__(self, counter: CallCounter, latency_seconds: float = 0.0,
+        faults: FaultInjector | None = None):
+        super().__init__('sqs', counter, latency_seconds, faults)
+        self._lock = threading.Lock()
+        self._queues: dict[str, list[dict]] = {}
+        self.sent_messages: dict[str, int] = {}
+
+    def queue_url(self, queue_name: str) -> str:
+        return 'https://sqs.{}.amazonaws.com/{}/{}'.format(
+            self.region, self.account_id, queue_name)
+
+    def send_message(self, QueueUrl: str, MessageBody: str,
+        MessageAttributes: dict | None = None, MessageGroupId: str | None = None,
+        MessageDeduplicationId: str | None = None, **kwargs) -> dict:
+        self._call('SendMessage')
+        return {'MessageId': self._enqueue(QueueUrl, MessageBody, MessageAttributes,
+                                           MessageGroupId)}
+
+    def send_message_batch(self, QueueUrl: str, Entries: list[dict]) -> dict:
+        self._call('SendMessageBatch')
+        successful, failed = [], []
+        for entry in Entries:
+            if self._faults is not None and self._faults.fault('sqs', ['partial_batch']) is not None:
+                failed.append({'Id': entry['Id'], 'SenderFault': False,
+                               'Code': 'InternalError', 'Message': 'InternalError'})
+                continue
+            message_id = self._enqueue(QueueUrl, entry['MessageBody'],
+                                       entry.get('MessageAttributes'), entry.get('MessageGroupId'))
+            successful.append({'Id': entry['Id'], 'MessageId': message_id})
+        return {'Successful': successful, 'Failed': failed}
+
+    def _enqueue(self, queue_url: str, body: str, message_attributes: dict | None,
+        message_group_id: str | None) -> str:
+        message_id = str(uuid.uuid4())
+        record = sqs_record(message_id, body, message_attributes or {}, message_group_id,
+                            int(time.time() * 1000),
+                            'arn:aws:sqs:{}:{}:{}'.format(self.region, self.account_id,
+                                                          queue_url.rsplit('/', 1)[-1]))
+        with self._lock:
+            self._queues.setdefault(queue_url, []).append(record)
+            self.sent_messages[queue_url] = self.sent_messages.get(queue_url, 0) + 1
+        return message_id
+
+    def change_message_visibility(self, QueueUrl: str, ReceiptHandle: str,
+        VisibilityTimeout: int) -> dict:
+        # redelivery is not delayed, failed records are received again at once
+        self._call('ChangeMessageVisibility')
+        return {}
+
+    def receive_records(self, queue_url: str, max_records: int) -> list[dict]:
+        """Takes the next records of a queue, as Lambda polls them"""
+
+        with self._lock:
+            queue = self._queues.get(queue_url, [])
+            records, self._queues[queue_url] = queue[:max_records], queue[max_records:]
+        for record in records:
+            attributes = record['attributes']
+            attributes['ApproximateReceiveCount'] = str(
+                int(attributes['ApproximateReceiveCount']) + 1)
+        return records
+
+    def return_records(self, queue_url: str, records: list[dict]) -> None:
+        with self._lock:
+            self._queues.setdefault(queue_url, []).extend(records)
+
+    def depth(self, queue_url: str) -> int:
+        with self._lock:
+            return len(self._queues.get(queue_url, []))
+
+
+class SecretsManagerStandIn(StandIn):
+    error_codes = {'throttling': 'ThrottlingException', '5xx': 'InternalServiceError',
+                   '404': 'ResourceNotFoundException'}
+
+    def __init__(self, counter: CallCounter, secrets: dict[str, str],
+        latency_seconds: float = 0.0, faults: FaultInjector | None = None):
+        super().__init__('secretsmanager', counter, latency_seconds, faults)
+        self._secrets = secrets
+
+    def get_secret_value(self, SecretId: str) -> dict:
+        self._call('GetSecretValue')
+        if SecretId not in self._secrets:
+            raise self._client_error('ResourceNotFoundException', 'GetSecretValue')
+        return {'SecretString': self._secrets[SecretId]}
+
+
+class IAMStandIn(StandIn):
+    """Keeps the inline policies of all roles in memory
+
+    Writes which do not change a policy, as the same policy put again or a
+    deleted policy deleted again, are counted as repeated writes.
+    """
+
+    error_codes = {'throttling': 'Throttling', '5xx': 'ServiceFailure', '404': 'NoSuchEntity'}
+
+    def __init__(self, counter: CallCounter, latency_seconds: float = 0.0,
+        faults: FaultInjector | None = None):
+        super().__init__('iam', counter, latency_seconds, faults)
+        self._lock = threading.Lock()
+        self.role_policies: dict[tuple[str, str], dict] = {}
+        self.repeated_writes = 0
+
+    def put_role_policy(self, RoleName: str, PolicyName: str, PolicyDocument: str) -> dict:
+        self._call('PutRolePolicy', ('throttling', '5xx', 'timeout', '404'))
+        policy = json.loads(PolicyDocument)
+        with self._lock:
+            if self.role_policies.get((RoleName, PolicyName)) == policy:
+                self.repeated_writes += 1
+            self.role_policies[(RoleName, PolicyName)] = policy
+        return {}
+
+    def delete_role_policy(self, RoleName: str, PolicyName: str) -> dict:
+        self._call('DeleteRolePolicy', ('throttling', '5xx', 'timeout', '404'))
+        with self._lock:
+            if self.role_policies.pop((RoleName, PolicyName), None) is None:
+                self.repeated_writes += 1
+                raise self._client_error('NoSuchEntity', 'DeleteRolePolicy')
+        return {}
+
+
+class DMMStandIn:
+    """Serves the events feed, data usage agreements and data products of a
+    workload over HTTP on a local port
+
+    Injected faults are answered with 429 and a Retry-After header, 500 or
+    503, 404, or a response delayed past the read timeout of the client. A PUT
+    of an unchanged document is counted as a repeated write.
+    """
+
+    def __init__(self, counter: CallCounter, api_key: str, page_size: int = 100,
+        latency_seconds: float = 0.0, faults: FaultInjector | None = None):
+        self._counter = counter
+        self._api_key = api_key
+        self._page_size = page_size
+        self.latency_seconds = latency_seconds
+        self._faults = faults
+        self.repeated_writes = 0
+        self._lock = threading.Lock()
+        self._events: list[dict] = []
+        self._event_positions: dict[str, int] = {}
+        self.documents: dict[str, dict] = {}
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._request_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self._server.server_port)
+
+    def start(self) -> 'DMMStandIn':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_data_usage_agreement(self, data_usage_agreement: dict) -> None:
+        with self._lock:
+            self.documents['/api/datausageagreements/{}'.format(
+                data_usage_agreement['info']['id'])] = data_usage_agreement
+
+    def add_dataproduct(self, dataproduct: dict) -> None:
+        with self._lock:
+            self.documents['/api/dataproducts/{}'.format(dataproduct['info']['id'])] = dataproduct
+
+    def add_event(self, event: dict) -> None:
+        with self._lock:
+            self._event_positions[event['id']] = len(self._events)
+            self._events.append(event)
+
+    def last_event_id(self) -> str | None:
+        with self._lock:
+            return self._events[-1]['id'] if len(self._events) > 0 else None
+
+    def _events_after(self, last_event_id: str | None) -> list[dict]:
+        with self._lock:
+            start = 0 if last_event_id is None else self._event_positions[last_event_id] + 1
+            return self._events[start:start + self._page_size]
+
+    def _request_handler(self):
+        stand_in = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            # keeps connections open, as Data Mesh Manager does
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/api/events':
+                    last_event_id = parse_qs(url.query).get('lastEventId', [None])[0]
+                    self._respond('GetEvents', lambda: (200, stand_in._events_after(last_event_id)))
+                else:
+                    self._respond(self._operation('Get', url.path),
+                                  lambda: self._document(url.path))
+
+            def do_PUT(self):
+                path = urlparse(self.path).path
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+                def put() -> tuple[int, dict | None]:
+                    with stand_in._lock:
+                        if path not in stand_in.documents:
+                            return 404, None
+                        if stand_in.documents[path] == body:
+                            stand_in.repeated_writes += 1
+                        stand_in.documents[path] = body
+                    return 200, body
+
+                self._respond(self._operation('Put', path), put)
+
+            def _respond(self, operation: str, respond) -> None:
+                stand_in._counter.add('dmm', operation)
+                if stand_in.latency_seconds > 0:
+                    time.sleep(stand_in.latency_seconds)
+                fault = None if stand_in._faults is None else stand_in._faults.fault(
+                    'dmm', ['throttling', '5xx', 'timeout', '404'])
+                headers = {}
+                if fault == 'timeout':
+                    # the client gives up before the response is sent
+                    time.sleep(stand_in._faults.timeout_seconds)
+                if self.headers.get('x-api-key') != stand_in._api_key:
+                    status, body = 401, None
+                elif fault == 'throttling':
+                    status, body = 429, None
+                    headers['Retry-After'] = '1'
+                elif fault == '5xx':
+                    status, body = random.choice([500, 503]), None
+                elif fault == '404':
+                    status, body = 404, None
+                else:
+                    status, body = respond()
+                content = b'' if body is None else json.dumps(body).encode('utf-8')
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(content)))
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.end_headers()
+                    self.wfile.write(content)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client closed the connection after a timeout
+                    self.close_connection = True
+
+            @staticmethod
+            def _document(path: str) -> tuple[int, dict | None]:
+                with stand_in._lock:
+                    document = stand_in.documents.get(path)
+                return (404, None) if document is None else (200, document)
+
+            @staticmethod
+            def _operation(method: str, path: str) -> str:
+                resource = path.split('/')[2] if path.count('/') >= 2 else path
+                return {'datausageagreements': method + 'DataUsageAgreement',
+                        'dataproducts': method + 'DataProduct'}.get(resource, method + path)
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
@@ -0,0 +1,277 @@
+"""Generates reproducible Data Mesh Manager workloads for load and soak tests
+
+A workload contains the data products, data usage agreements and events of
+one or more scenarios. The same seed always generates the same workload, so
+that benchmark runs are comparable. Workloads are written as json, either as a
+whole, as pages of the events feed or as SQS events of manage_iam_policies.
+
+Example:
+    python3 benchmark/workload.py --scenario mixed --events 1000 --seed 7 --format sqs > records.json
+"""
+
+import argparse
+import json
+import random
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from stand_ins import sqs_record
+
+ACTIVATED = 'com.datamesh-manager.events.DataUsageAgreementActivatedEvent'
+DEACTIVATED = 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent'
+# forwarded by poll_feed, but ignored by manage_iam_policies
+IRRELEVANT_EVENT_TYPES = [
+    'com.datamesh-manager.events.DataProductCreatedEvent',
+    'com.datamesh-manager.events.DataProductUpdatedEvent',
+    'com.datamesh-manager.events.DataUsageAgreementCreatedEvent',
+    'com.datamesh-manager.events.DataUsageAgreementUpdatedEvent',
+    'com.datamesh-manager.events.TeamUpdatedEvent',
+]
+
+SCENARIOS = ['approval_burst', 'toggle_storm', 'consumer_fan_in',
+             'large_dataproducts', 'irrelevant_events', 'mixed']
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=SCENARIOS, default='mixed')
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--format', choices=['workload', 'feed', 'sqs'], default='workload',
+                        help='the whole workload, pages of the events feed or SQS events')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=10)
+    args = parser.parse_args()
+
+    workload = WorkloadGenerator(args.seed).generate(args.scenario, args.events)
+    match args.format:
+        case 'workload':
+            output = workload
+        case 'feed':
+            output = feed_pages(workload['events'], args.page_size)
+        case 'sqs':
+            output = sqs_events(workload['events'], args.batch_size)
+    json.dump(output, sys.stdout, indent=2)
+
+
+def feed_pages(events: list[dict], page_size: int = 100) -> list[list[dict]]:
+    """Returns the events as cloudevents-batch pages, as DMMEventsClient reads
+    them, followed by the empty page at the end of the feed
+    """
+
+    return [events[start:start + page_size]
+            for start in range(0, len(events), page_size)] + [[]]
+
+
+def sqs_events(events: list[dict], batch_size: int = 10,
+    queue_arn: str = 'arn:aws:sqs:eu-central-1:000000000000:dmm-events.fifo') -> list[dict]:
+    """Returns the events as SQS events of Lambda, as manage_iam_policies
+    receives them after poll_feed sent them to the queue
+    """
+
+    records = []
+    for event in events:
+        sent_at = _epoch_millis(event['time'])
+        records.append(sqs_record(
+            message_id=str(uuid.uuid5(uuid.NAMESPACE_URL, event['id'])),
+            body=json.dumps(event),
+            message_attributes={
+                'dmm-event-time': {'DataType': 'String', 'StringValue': event['time']},
+                'dmm-poll-time': {'DataType': 'Number', 'StringValue': str(sent_at)},
+                'dmm-enqueue-time': {'DataType': 'Number', 'StringValue': str(sent_at)}},
+            message_group_id='1' if queue_arn.endswith('.fifo') else None,
+            sent_timestamp=sent_at,
+            queue_arn=queue_arn,
+            receive_count=1))
+    return [{'Records': records[start:start + batch_size]}
+            for start in range(0, len(records), batch_size)]
+
+
+def _epoch_millis(value: str) -> int:
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+class WorkloadGenerator:
+    """Builds workloads from scenarios with a seeded random generator
+
+    Every scenario adds its data products and agreements to the workload and
+    appends its events, which are spaced in time like they occur in Data Mesh
+    Manager.
+    """
+
+    def __init__(self, seed: int, start: datetime = datetime(2024, 1, 1, tzinfo=timezone.utc)):
+        self._random = random.Random(seed)
+        self._time = start
+        self._dataproducts: dict[str, dict] = {}
+        self._data_usage_agreements: dict[str, dict] = {}
+        self._events: list[dict] = []
+
+    def generate(self, scenario: str, events: int) -> dict:
+        getattr(self, scenario)(events)
+        return self.workload()
+
+    def workload(self) -> dict:
+        return {
+            'dataproducts': list(self._dataproducts.values()),
+            'data_usage_agreements': list(self._data_usage_agreements.values()),
+            'events': list(self._events)
+        }
+
+    def approval_burst(self, events: int) -> None:
+        """Many new agreements between a few consumers and providers approved
+        within seconds, e.g. when a team onboards
+        """
+
+        consumers = [self._consumer() for _ in range(max(1, events // 20))]
+        providers = [self._provider(output_ports=self._random.randint(1, 3))
+                     for _ in range(max(1, events // 20))]
+        for _ in range(events):
+            provider = self._random.choice(providers)
+            agreement = self._agreement(self._random.choice(consumers), provider,
+                                        self._random.choice(provider['outputPorts']))
+            self._event(ACTIVATED, agreement, gap_seconds=0.05)
+
+    def toggle_storm(self, events: int) -> None:
+        """A single agreement activated and deactivated over and over"""
+
+        provider = self._provider()
+        agreement = self._agreement(self._consumer(), provider, provider['outputPorts'][0])
+        for index in range(events):
+            self._event(ACTIVATED if index % 2 == 0 else DEACTIVATED, agreement, gap_seconds=0.2)
+
+    def consumer_fan_in(self, events: int) -> None:
+        """Agreements of a single consumer with many providers, so all access
+        changes affect the same role
+        """
+
+        consumer = self._consumer()
+        for _ in range(events):
+            provider = self._provider()
+            agreement = self._agreement(consumer, provider, provider['outputPorts'][0])
+            self._event(ACTIVATED, agreement, gap_seconds=0.5)
+
+    def large_dataproducts(self, events: int) -> None:
+        """Agreements for the ports of providers with many output ports and
+        Glue ports with many ARNs
+        """
+
+        providers = [self._provider(output_ports=self._random.randint(20, 50), arns_per_port=20)
+                     for _ in range(max(1, events // 50))]
+        consumers = [self._consumer() for _ in range(max(1, events // 10))]
+        for _ in range(events):
+            provider = self._random.choice(providers)
+            agreement = self._agreement(self._random.choice(consumers), provider,
+                                        self._random.choice(provider['outputPorts']))
+            self._event(ACTIVATED, agreement, gap_seconds=1)
+
+    def irrelevant_events(self, events: int) -> None:
+        """Events of other types, which are only forwarded"""
+
+        for _ in range(events):
+            self._events.append(self._cloud_event(self._random.choice(IRRELEVANT_EVENT_TYPES),
+                                                  self._id(), gap_seconds=0.5))
+
+    def mixed(self, events: int) -> None:
+        """All other scenarios in random chunks, interleaved with changes of
+        existing agreements
+        """
+
+        weights = {'approval_burst': 4, 'toggle_storm': 1, 'consumer_fan_in': 2,
+                   'large_dataproducts': 1, 'irrelevant_events': 4, 'revocations': 2}
+        remaining = events
+        while remaining > 0:
+            scenario = self._random.choices(list(weights), list(weights.values()))[0]
+            chunk = min(remaining, self._random.randint(5, 50))
+            if scenario == 'revocations':
+                chunk = min(chunk, len(self._data_usage_agreements))
+                if chunk == 0:
+                    continue
+                for agreement in self._random.sample(list(self._data_usage_agreements.values()), chunk):
+                    self._event(DEACTIVATED, agreement, gap_seconds=2)
+            else:
+                getattr(self, scenario)(chunk)
+            remaining -= chunk
+
+    def _consumer(self) -> dict:
+        dataproduct_id = self._id()
+        dataproduct = {
+            'dataProductSpecification': '0.0.1',
+            'info': {'id': dataproduct_id, 'name': 'Consumer {}'.format(dataproduct_id[:8])},
+            'owner': {'teamId': self._id()},
+            'custom': {'aws-role-name': 'consumer-role-{}'.format(dataproduct_id[:8])},
+            'outputPorts': []
+        }
+        self._dataproducts[dataproduct_id] = dataproduct
+        return dataproduct
+
+    def _provider(self, output_ports: int = 1, arns_per_port: int = 3) -> dict:
+        dataproduct_id = self._id()
+        dataproduct = {
+            'dataProductSpecification': '0.0.1',
+            'info': {'id': dataproduct_id, 'name': 'Provider {}'.format(dataproduct_id[:8])},
+            'owner': {'teamId': self._id()},
+            'custom': {},
+            'outputPorts': [self._output_port(dataproduct_id, index, arns_per_port)
+                            for index in range(output_ports)]
+        }
+        self._dataproducts[dataproduct_id] = dataproduct
+        return dataproduct
+
+    def _output_port(self, dataproduct_id: str, index: int, arns: int) -> dict:
+        name = '{}-{}'.format(dataproduct_id[:8], index)
+        if self._random.random() < 0.5:
+            return {'id': 'port-{}'.format(index), 'custom': {
+                'output-port-type': 's3_bucket',
+                'aws-s3-bucket-arn': 'arn:aws:s3:::bucket-{}'.format(name)}}
+
+        # a glue table port with a number of tables and their s3 folders
+        custom = {
+            'output-port-type': 'glue_table',
+            'aws-athena-workgroup-arn':
+                'arn:aws:athena:eu-central-1:000000000000:workgroup/wg-{}'.format(name),
+            'aws-glue-catalog-arn': 'arn:aws:glue:eu-central-1:000000000000:catalog',
+            'aws-glue-database-arn':
+                'arn:aws:glue:eu-central-1:000000000000:database/db-{}'.format(name)}
+        for table in range(max(1, self._random.randint(1, arns))):
+            custom['aws-glue-table-{}-arn'.format(table)] = \
+                'arn:aws:glue:eu-central-1:000000000000:table/db-{}/table-{}'.format(name, table)
+            custom['aws-s3-folder-{}-arn'.format(table)] = \
+                'arn:aws:s3:::bucket-{}/table-{}'.format(name, table)
+        return {'id': 'port-{}'.format(index), 'custom': custom}
+
+    def _agreement(self, consumer: dict, provider: dict, output_port: dict) -> dict:
+        agreement_id = self._id()
+        agreement = {
+            'info': {'id': agreement_id, 'active': False},
+            'consumer': {'dataProductId': consumer['info']['id']},
+            'provider': {'dataProductId': provider['info']['id'],
+                         'outputPortId': output_port['id']},
+            'custom': {},
+            'tags': []
+        }
+        self._data_usage_agreements[agreement_id] = agreement
+        return agreement
+
+    def _event(self, event_type: str, agreement: dict, gap_seconds: float) -> None:
+        self._events.append(self._cloud_event(event_type, agreement['info']['id'], gap_seconds))
+
+    def _cloud_event(self, event_type: str, data_id: str, gap_seconds: float) -> dict:
+        # exponentially distributed gaps, as independent events arrive
+        self._time += timedelta(seconds=self._random.expovariate(1 / gap_seconds))
+        return {
+            'specversion': '1.0',
+            'id': self._id(),
+            'source': 'https://api.datamesh-manager.com',
+            'type': event_type,
+            'time': self._time.isoformat(),
+            'datacontenttype': 'application/json',
+            'data': {'id': data_id}
+        }
+
+    def _id(self) -> str:
+        return str(uuid.UUID(int=self._random.getrandbits(128), version=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,12 @@ BUCKET_NAME="dmm-integration"
 
 declare -a LAMBDAS=("poll_feed" "manage_iam_policies")
 
+# aws services each lambda creates clients for, all other botocore models are left out of the bundle
+declare -A AWS_SERVICES=(
+  ["poll_feed"]="s3 sqs secretsmanager dynamodb"
+  ["manage_iam_policies"]="iam sqs secretsmanager dynamodb sts"
+)
+
 function build {
   local name=$1
   local src="src/$name"
@@ -20,12 +26,26 @@ function build {
   rm -rf "$out"
   mkdir -p "$out"
 
-  # copy sources
-  cp -r "$src/lambda_handler.py" "$src/requirements.txt" "$out"
+  # copy sources, the module shared by both lambdas is bundled next to each handler
+  cp -r "$src/lambda_handler.py" "$src/requirements.txt" src/common/dmm_common.py "$out"
   cd "$out" || exit 1
 
   # install dependencies
-  python3.10 -m pip install --upgrade -r requirements.txt --target .
+  python3.10 -m pip install --upgrade --no-compile -r requirements.txt --target .
+
+  # slim down the bundle, a smaller artifact is downloaded and unpacked faster on a cold start
+  rm -rf bin
+  find . -type d -name tests -prune -exec rm -rf {} +
+  for model in botocore/data/*/; do
+    local service
+    service=$(basename "$model")
+    if [[ " ${AWS_SERVICES[$name]} " != *" $service "* ]]; then
+      rm -rf "$model"
+    fi
+  done
+
+  # precompile bytecode, the function cannot write it at runtime
+  python3.10 -m compileall -q -j 0 .
 
   cd "$WORKING_DIRECTORY" || exit 1
 }
@@ -35,20 +55,20 @@ function test {
   local src="src/$name"
   local out="out/$name"
 
-  # copy testfile
-  cp -r "$src/test_lambda_handler.py" "$out"
+  # copy testfiles
+  cp -r "$src/test_lambda_handler.py" src/common/test_dmm_common.py src/common/call_accounting.py "$out"
   cd "$out" || exit 1
 
   # run tests
-  python3.10 -m unittest -v test_lambda_handler -f
+  python3.10 -m unittest -v test_lambda_handler test_dmm_common -f
   exit_code=$?
 
   # exit if any test failed
   if [ $exit_code != 0 ]; then exit $exit_code
   fi
 
-  # remove testfile
-  rm test_lambda_handler.py
+  # remove testfiles
+  rm test_lambda_handler.py test_dmm_common.py call_accounting.py
 
   cd "$WORKING_DIRECTORY" || exit 1
 }
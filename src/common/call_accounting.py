@@ -0,0 +1,128 @@
+"""Counting of remote calls for the call budget tests of both functions
+
+cicd.sh copies this module next to the tests of each function, it is not
+part of the deployed functions.
+"""
+
+import json
+import threading
+from collections import Counter
+from typing import Callable
+
+import boto3
+from botocore.awsrequest import AWSResponse
+
+from dmm_common import HttpResponse
+
+
+class CallAccounting:
+    """Counts the remote calls of a test scenario by service and method
+
+    Calls of boto3 clients are counted before their stub answers them, calls
+    to Data Mesh Manager by a session which serves the given documents or
+    events, with the methods of the DMMCallLatency metric. A scenario
+    declares a budget of calls per processed event, and over_budget returns
+    every service or method which was called more often.
+    """
+
+    _dmm_methods = {('GET', 'datausageagreements'): 'GetDataUsageAgreement',
+                    ('PUT', 'datausageagreements'): 'PutDataUsageAgreement',
+                    ('GET', 'dataproducts'): 'GetDataProduct'}
+
+    def __init__(self):
+        self.calls: Counter[str] = Counter()
+        # documents are fetched concurrently
+        self._lock = threading.Lock()
+
+    def aws_client(self, service_name: str,
+        responses: dict[str, dict | Callable[[], dict]] | None = None):
+        """Returns a client which answers each call with the response given
+        for its operation, or an empty one
+        """
+
+        def respond(model, **kwargs) -> tuple[AWSResponse, dict]:
+            response = (responses or {}).get(model.name, {})
+            return AWSResponse(None, 200, {}, None), response() if callable(response) else response
+
+        client = boto3.client(service_name)
+        client.meta.events.register('before-parameter-build.*.*', self._count_aws_call)
+        client.meta.events.register('before-call.*.*', respond)
+        return client
+
+    def dmm_documents_session(self, documents: dict[str, dict]) \
+        -> 'CallAccounting.DocumentsSession':
+        """Returns a session which serves and stores the documents by their
+        path of the api, e.g. dataproducts/<id>
+        """
+
+        return self.DocumentsSession(self, documents)
+
+    def dmm_feed_session(self, events: list[dict], page_size: int = 100) \
+        -> 'CallAccounting.FeedSession':
+        """Returns a session which serves the events in pages, their ids are
+        their positions in the feed, starting at 1
+        """
+
+        return self.FeedSession(self, events, page_size)
+
+    def over_budget(self, events: int, budget: dict[str, float]) -> dict[str, int]:
+        """Returns the calls of the services and methods, given as service or
+        service.Method, which exceed their budget per event
+
+        Services without a budget must not be called at all.
+        """
+
+        calls = {name: sum(count for call, count in self.calls.items()
+                           if call == name or call.startswith(name + '.'))
+                 for name in budget}
+        unbudgeted = Counter(call.split('.')[0] for call in self.calls
+                             if not any(call == name or call.startswith(name + '.')
+                                        for name in budget))
+        return {**{name: count for name, count in calls.items()
+                   if count > budget[name] * events},
+                **{service: self.calls_of(service) for service in unbudgeted}}
+
+    def calls_of(self, service: str) -> int:
+        return sum(count for call, count in self.calls.items()
+                   if call.startswith(service + '.'))
+
+    def count(self, call: str) -> None:
+        with self._lock:
+            self.calls[call] += 1
+
+    def _count_aws_call(self, model, **kwargs) -> None:
+        self.count('{}.{}'.format(model.service_model.service_name, model.name))
+
+    class DocumentsSession:
+        def __init__(self, accounting: 'CallAccounting', documents: dict[str, dict]):
+            self._accounting = accounting
+            self._documents = documents
+
+        def get(self, url: str, headers: dict | None = None) -> HttpResponse:
+            path = self._path('GET', url)
+            if path not in self._documents:
+                return HttpResponse(404, {}, b'', url)
+            return HttpResponse(200, {}, json.dumps(self._documents[path]).encode('utf-8'), url)
+
+        def put(self, url: str, headers: dict | None = None, json: dict | None = None) \
+            -> HttpResponse:
+            self._documents[self._path('PUT', url)] = json
+            return HttpResponse(200, {}, b'', url)
+
+        def _path(self, method: str, url: str) -> str:
+            path = url.split('/api/', 1)[1]
+            self._accounting.count('dmm.{}'.format(
+                CallAccounting._dmm_methods[(method, path.split('/')[0])]))
+            return path
+
+    class FeedSession:
+        def __init__(self, accounting: 'CallAccounting', events: list[dict], page_size: int):
+            self._accounting = accounting
+            self._events = events
+            self._page_size = page_size
+
+        def get(self, url: str, headers: dict | None = None) -> HttpResponse:
+            self._accounting.count('dmm.GetEvents')
+            last_event_id = url.partition('?lastEventId=')[2] or '0'
+            page = self._events[int(last_event_id):int(last_event_id) + self._page_size]
+            return HttpResponse(200, {}, json.dumps(page).encode('utf-8'), url)
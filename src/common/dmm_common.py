@@ -0,0 +1,930 @@
+"""Components shared by both functions
+
+cicd.sh copies this module next to the lambda_handler of each function, so
+both are deployed with the same code. The state kept between invocations of
+a warm container lives here as well, as the components it holds do.
+"""
+
+import json
+import logging
+import marshal
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from os import environ
+from typing import Callable, Mapping, NamedTuple, TypeAlias, TypeVar
+
+import urllib3
+from botocore.exceptions import ClientError
+
+DMMEvent: TypeAlias = dict[str, str | dict]
+T = TypeVar('T')
+
+log = logging.getLogger('dmm_common')
+
+# reused by all invocations of a warm container
+_aws_clients: dict[str, object] = {}
+_http_session: 'HttpSession | None' = None
+_secret_cache: 'SecretCache | None' = None
+_metrics: 'Metrics | None' = None
+_logging_configured = False
+# the components above are created on first use, which may happen in the
+# threads of several feeds or accounts at once
+_warm_container_lock = threading.RLock()
+# correlation ids added to every log line
+_log_context: ContextVar[dict[str, str]] = ContextVar('log_context', default={})
+
+
+def aws_client(service_name: str):
+    if service_name not in _aws_clients:
+        with _warm_container_lock:
+            if service_name not in _aws_clients:
+                # imported on first use, as it takes most of the time of a cold start
+                import boto3
+                _aws_clients[service_name] = boto3.client(service_name)
+    return _aws_clients[service_name]
+
+
+def shared_http_session() -> 'HttpSession':
+    global _http_session
+    with _warm_container_lock:
+        if _http_session is None:
+            _http_session = HttpSession(
+                connect_timeout=float(environ.get('dmm_connect_timeout', 3.05)),
+                read_timeout=float(environ.get('dmm_read_timeout', 10)),
+                max_retries=int(environ.get('dmm_max_retries', 3)),
+                max_retry_seconds=float(environ.get('dmm_max_retry_seconds', 15)))
+        return _http_session
+
+
+def shared_secret_cache() -> 'SecretCache':
+    global _secret_cache
+    with _warm_container_lock:
+        if _secret_cache is None:
+            _secret_cache = SecretCache(
+                Secrets(aws_client('secretsmanager')),
+                ttl_seconds=float(environ.get('secret_cache_ttl_seconds', 300)))
+        return _secret_cache
+
+
+def reset_shared_warm_container() -> None:
+    """Drops the clients, secrets and metrics kept between invocations"""
+
+    global _http_session, _secret_cache, _metrics
+    with _warm_container_lock:
+        _aws_clients.clear()
+        _http_session = None
+        _secret_cache = None
+        _metrics = None
+
+
+class Feed(NamedTuple):
+    """The events feed of a Data Mesh Manager organization
+
+    The name is None for the single organization configured by dmm_base_url
+    and dmm_api_key_secret_name.
+    """
+
+    name: str | None
+    dmm_base_url: str
+    dmm_api_key_secret_name: str
+    last_event_id_object_name: str | None = None
+    circuit_state_object_name: str | None = None
+
+    @property
+    def message_group_id(self) -> str:
+        # the events of an organization keep their order, independent of others
+        return '1' if self.name is None else self.name
+
+
+def configured_feeds() -> list[Feed]:
+    """Returns the feeds of all organizations in the json list feeds, or the
+    feed of the single organization if it is not set
+
+    An organization needs a name and dmm_api_key_secret_name, dmm_base_url
+    and the names of its S3 objects are optional.
+    """
+
+    if not environ.get('feeds'):
+        return [Feed(None,
+                     environ['dmm_base_url'],
+                     environ['dmm_api_key_secret_name'],
+                     environ.get('last_event_id_object_name'),
+                     environ.get('circuit_state_object_name'))]
+
+    return [Feed(organization['name'],
+                 organization.get('dmm_base_url') or environ['dmm_base_url'],
+                 organization['dmm_api_key_secret_name'],
+                 organization.get('last_event_id_object_name')
+                 or 'poll_feed/{}/last_event_id'.format(organization['name']),
+                 organization.get('circuit_state_object_name')
+                 or 'poll_feed/{}/circuit_state'.format(organization['name']))
+            for organization in json.loads(environ['feeds'])]
+
+
+def run_deadline(context) -> float | None:
+    """Returns the time until which new work may be started, e.g. a page of
+    the feed or the retry of a request, so that the function is not stopped
+    in the middle of it
+    """
+
+    if not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return time.time() + context.get_remaining_time_in_millis() / 1000 \
+        - float(environ.get('deadline_safety_seconds', 5))
+
+
+def event_time(event: DMMEvent) -> datetime | None:
+    """Returns the time of a cloud event, if it has one"""
+
+    if 'time' not in event:
+        return None
+    # python 3.10 accepts neither 'Z' nor more than six fractional digits
+    value = re.sub(r'(\.\d{6})\d+', r'\1', event['time'].replace('Z', '+00:00'))
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+
+
+def configure_logging(event_log: logging.Logger) -> None:
+    """Writes all log lines as JSON, with the levels from the environment
+
+    log_level is the level of all loggers, log_levels the levels of single
+    loggers, e.g. 'poll_feed.events=WARNING,botocore=ERROR'. log_sample_rate is
+    the share of events whose lines below warning are written to event_log.
+    """
+
+    global _logging_configured
+    if _logging_configured:
+        return
+
+    root = logging.getLogger()
+    if len(root.handlers) == 0:
+        root.addHandler(logging.StreamHandler())
+    for handler in root.handlers:
+        handler.setFormatter(JsonFormatter())
+
+    root.setLevel(environ.get('log_level', 'INFO').upper())
+    for logger_level in environ.get('log_levels', '').split(','):
+        if '=' in logger_level:
+            name, level = logger_level.split('=', 1)
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+    event_log.addFilter(SamplingFilter(float(environ.get('log_sample_rate', 1))))
+
+    _logging_configured = True
+
+
+def bind_request_id(context) -> None:
+    """Adds the id of the current invocation to all following log lines"""
+
+    request_id = getattr(context, 'aws_request_id', None)
+    _log_context.set({} if request_id is None else {'request_id': request_id})
+
+
+@contextmanager
+def log_context(**correlation_ids: str):
+    """Adds the given ids to all log lines written within the block"""
+
+    token = _log_context.set({**_log_context.get(), **correlation_ids})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **_log_context.get()
+        }
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Lets the lines of a share of all events through, and all warnings
+
+    Events are sampled by their id, so either all or none of the lines of an
+    event are written.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self._rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self._rate >= 1 or record.levelno >= logging.WARNING:
+            return True
+        event_id = _log_context.get().get('event_id')
+        if event_id is None:
+            return random.random() < self._rate
+        return zlib.crc32(event_id.encode('utf-8')) % 10_000 < self._rate * 10_000
+
+
+class LazyJson:
+    """Serializes a value only once its log line is actually written"""
+
+    def __init__(self, value: Callable[[], object]):
+        self._value = value
+
+    def __str__(self) -> str:
+        return json.dumps(self._value(), default=str)
+
+
+@contextmanager
+def profiled(context, function_log: logging.Logger):
+    """Profiles the block for a share of all invocations
+
+    profile_sample_rate is the share of invocations which are profiled. The
+    summary is logged to function_log and, if profile_bucket_name is set,
+    written to S3 below the name of that log, together with the full profile,
+    which can be read with pstats.
+    """
+
+    sample_rate = float(environ.get('profile_sample_rate', 0))
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        yield
+        return
+
+    profiler = InvocationProfiler(int(environ.get('profile_top', 15)))
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        summary = profiler.summary()
+        function_log.info('Profile: %s', LazyJson(lambda: summary))
+        bucket_name = environ.get('profile_bucket_name')
+        if bucket_name:
+            try:
+                profiler.save(aws_client('s3'), bucket_name, '{}{}/{}/{}'.format(
+                    environ.get('profile_object_prefix', 'profiles/'), function_log.name,
+                    datetime.now(timezone.utc).strftime('%Y-%m-%d'),
+                    getattr(context, 'aws_request_id', None) or time.time_ns()))
+            except Exception as e:
+                # a lost profile must not fail the invocation
+                function_log.warning('Could not save profile: %s', e)
+
+
+class InvocationProfiler:
+    """Profiles the function calls and memory allocations of an invocation
+
+    cProfile only sees the thread it was started in, so the time of work
+    done in thread pools shows up as the time spent waiting for them. The
+    profiling modules are only imported once an invocation is profiled.
+    """
+
+    def __init__(self, top: int = 15):
+        import cProfile
+
+        self._top = top
+        self._profile = cProfile.Profile()
+        self._started_at = 0.0
+        self._duration = 0.0
+        self._peak_memory = 0
+        self._snapshot: 'tracemalloc.Snapshot | None' = None
+
+    def start(self) -> None:
+        import tracemalloc
+
+        tracemalloc.start()
+        self._started_at = time.perf_counter()
+        self._profile.enable()
+
+    def stop(self) -> None:
+        import tracemalloc
+
+        self._profile.disable()
+        self._duration = time.perf_counter() - self._started_at
+        self._peak_memory = tracemalloc.get_traced_memory()[1]
+        self._snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+        tracemalloc.stop()
+
+    def summary(self) -> dict:
+        """Returns the functions with the highest own and cumulative time,
+        the peak memory and the sites with the largest allocations
+        """
+
+        import pstats
+
+        stats = pstats.Stats(self._profile).stats
+
+        def top_functions(time_index: int) -> list[dict]:
+            # the values of a function are (primitive calls, calls, own time, cumulative time, callers)
+            ranked = sorted(stats.items(), key=lambda item: item[1][time_index],
+                            reverse=True)[:self._top]
+            return [{'function': '{}:{}({})'.format(self._short_path(path), line, name),
+                     'calls': calls,
+                     'own_ms': round(own_time * 1000, 3),
+                     'cumulative_ms': round(cumulative_time * 1000, 3)}
+                    for (path, line, name), (_, calls, own_time, cumulative_time, _)
+                    in ranked]
+
+        allocations = self._snapshot.statistics('lineno')[:self._top] \
+            if self._snapshot is not None else []
+        return {
+            'duration_ms': round(self._duration * 1000, 3),
+            'peak_memory_kb': round(self._peak_memory / 1024, 1),
+            'top_own_time': top_functions(2),
+            'top_cumulative_time': top_functions(3),
+            'top_allocations': [
+                {'site': '{}:{}'.format(self._short_path(statistic.traceback[0].filename),
+                                        statistic.traceback[0].lineno),
+                 'size_kb': round(statistic.size / 1024, 1),
+                 'count': statistic.count}
+                for statistic in allocations]
+        }
+
+    def save(self, s3, bucket: str, key: str) -> None:
+        """Writes the summary as json and the full profile in the format of
+        pstats
+        """
+
+        import pstats
+
+        s3.put_object(Body=json.dumps(self.summary()), Bucket=bucket, Key=key + '.json')
+        s3.put_object(Body=marshal.dumps(pstats.Stats(self._profile).stats),
+                      Bucket=bucket, Key=key + '.prof')
+
+    @staticmethod
+    def _short_path(path: str) -> str:
+        # the package and module are enough to tell where the time went
+        return '/'.join(path.replace('\\', '/').split('/')[-2:])
+
+
+def shared_metrics() -> 'Metrics':
+    global _metrics
+    with _warm_container_lock:
+        if _metrics is None:
+            _metrics = Metrics(environ.get('metrics_namespace', 'DMMIntegration'))
+        return _metrics
+
+
+class Metrics:
+    """Collects the metrics of an invocation and writes them in the CloudWatch
+    embedded metric format
+
+    All values of a metric are written as one array, so a histogram of e.g.
+    call latencies is a single log line and needs no call to CloudWatch.
+    Counts are summed up before they are written. Timed blocks are kept as
+    spans until the next flush, to trace where the time of a request went.
+    """
+
+    # values per metric and log line supported by CloudWatch
+    _max_values = 100
+    _max_spans = 1000
+
+    def __init__(
+        self,
+        namespace: str = 'DMMIntegration',
+        sink: Callable[[dict], None] | None = None,
+        clock: Callable[[], float] = time.perf_counter
+    ):
+        self._namespace = namespace
+        self._sink = sink or self._print
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._values: dict[tuple[tuple, str, str], list[float]] = {}
+        # with the thread which timed the block
+        self._spans: list[tuple[int, dict]] = []
+
+    def put(self, name: str, value: float, unit: str = 'None',
+        dimensions: dict[str, str] | None = None) -> None:
+        key = (self._dimensions_key(dimensions), name, unit)
+        with self._lock:
+            self._values.setdefault(key, []).append(value)
+
+    def count(self, name: str, value: float = 1,
+        dimensions: dict[str, str] | None = None) -> None:
+        key = (self._dimensions_key(dimensions), name, 'Count')
+        with self._lock:
+            counts = self._values.setdefault(key, [0])
+            counts[0] += value
+
+    @contextmanager
+    def timer(self, name: str, dimensions: dict[str, str] | None = None,
+        error_metric: str | None = None):
+        """Measures the time of the block in milliseconds and counts the
+        exceptions it raises in the error metric, if one is given
+        """
+
+        start = self._clock()
+        try:
+            yield
+        except Exception:
+            if error_metric is not None:
+                self.count(error_metric, 1, dimensions)
+            raise
+        finally:
+            duration = (self._clock() - start) * 1000
+            self.put(name, duration, 'Milliseconds', dimensions)
+            with self._lock:
+                if len(self._spans) < self._max_spans:
+                    self._spans.append((threading.get_ident(),
+                                        {'name': name, **(dimensions or {}),
+                                         'start': start, 'duration_ms': duration}))
+
+    def spans(self, thread_id: int | None = None) -> list[dict]:
+        """Returns the timed blocks since the last flush in the order they
+        ended, with the start time of the clock in seconds, only those of a
+        thread if one is given
+        """
+
+        with self._lock:
+            return [span for span_thread_id, span in self._spans
+                    if thread_id is None or span_thread_id == thread_id]
+
+    def latency_summary(self) -> dict[str, dict[str, float]]:
+        """Returns the percentiles of all times recorded since the last flush"""
+
+        with self._lock:
+            values = {key: list(metric_values)
+                      for key, metric_values in self._values.items()
+                      if key[2] == 'Milliseconds'}
+
+        summary = {}
+        for (dimensions, name, _), metric_values in values.items():
+            metric_values.sort()
+            label = name if len(dimensions) == 0 else '{}[{}]'.format(
+                name, ','.join('{}={}'.format(key, value) for key, value in dimensions))
+            summary[label] = {
+                'count': len(metric_values),
+                'p50': self._percentile(metric_values, 50),
+                'p90': self._percentile(metric_values, 90),
+                'p99': self._percentile(metric_values, 99),
+                'max': metric_values[-1]
+            }
+        return summary
+
+    def flush(self) -> None:
+        with self._lock:
+            values, self._values = self._values, {}
+            self._spans = []
+
+        metrics_by_dimensions: dict[tuple, list[tuple[str, str, list[float]]]] = {}
+        for (dimensions, name, unit), metric_values in values.items():
+            metrics_by_dimensions.setdefault(dimensions, []).append(
+                (name, unit, metric_values))
+
+        timestamp = int(time.time() * 1000)
+        for dimensions, metrics in metrics_by_dimensions.items():
+            max_length = max(len(metric_values) for _, _, metric_values in metrics)
+            for offset in range(0, max_length, self._max_values):
+                chunk = [(name, unit, metric_values[offset:offset + self._max_values])
+                         for name, unit, metric_values in metrics
+                         if len(metric_values) > offset]
+                self._sink({
+                    '_aws': {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [{
+                            'Namespace': self._namespace,
+                            'Dimensions': [[key for key, _ in dimensions]],
+                            'Metrics': [{'Name': name, 'Unit': unit}
+                                        for name, unit, _ in chunk]
+                        }]
+                    },
+                    **{name: metric_values[0] if len(metric_values) == 1 else metric_values
+                       for name, _, metric_values in chunk},
+                    **dict(dimensions)
+                })
+
+    @staticmethod
+    def _percentile(sorted_values: list[float], percentile: float) -> float:
+        # nearest rank
+        rank = math.ceil(percentile / 100 * len(sorted_values))
+        return sorted_values[max(rank, 1) - 1]
+
+    @staticmethod
+    def _dimensions_key(dimensions: dict[str, str] | None) -> tuple:
+        return tuple(sorted((dimensions or {}).items()))
+
+    @staticmethod
+    def _print(document: dict) -> None:
+        print(json.dumps(document), flush=True)
+
+
+class InMemoryMetricsSink:
+    """Keeps the metric documents instead of writing them, e.g. for tests"""
+
+    def __init__(self):
+        self.documents: list[dict] = []
+
+    def __call__(self, document: dict) -> None:
+        self.documents.append(document)
+
+    def values(self, name: str, dimensions: dict[str, str] | None = None) -> list[float]:
+        values = []
+        for document in self.documents:
+            if name in document and all(document.get(key) == value for key, value
+                                        in (dimensions or {}).items()):
+                value = document[name]
+                values.extend(value if isinstance(value, list) else [value])
+        return values
+
+
+class HttpError(Exception):
+    def __init__(self, status_code: int, url: str):
+        super().__init__('HTTP {} for {}'.format(status_code, url))
+        self.status_code = status_code
+
+
+class HttpResponse:
+    def __init__(self, status_code: int, headers: Mapping[str, str], body: bytes, url: str):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.url = url
+
+    def json(self):
+        return json.loads(self.body)
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise HttpError(self.status_code, self.url)
+
+
+class HttpSession:
+    """Keep-alive HTTP session with timeouts and bounded retries
+
+    Connections are pooled, so they are reused by all requests of a container,
+    including those of later warm invocations. Connection errors, timeouts,
+    429 and 5xx responses are retried with jittered exponential backoff,
+    honouring a Retry-After header if the server sends one. The retries of a
+    request end after max_retry_seconds, and an attempt is only started if
+    it can time out before the deadline of the invocation, so that waiting
+    for the server never outlasts the timeout of the function. The counters
+    are shared by the threads of an invocation.
+    """
+
+    _retry_status_codes = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.25,
+        backoff_max: float = 5.0,
+        max_retry_after: float = 20.0,
+        max_retry_seconds: float = 15.0,
+        pool_size: int = 10,
+        sleep: Callable[[float], None] = time.sleep,
+        clock: Callable[[], float] = time.time
+    ):
+        self._timeout = urllib3.Timeout(connect=connect_timeout, read=read_timeout)
+        # the longest an attempt can take
+        self._attempt_seconds = connect_timeout + read_timeout
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._max_retry_after = max_retry_after
+        self._max_retry_seconds = max_retry_seconds
+        self._sleep = sleep
+        self._clock = clock
+        self._deadline: float | None = None
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._retries = 0
+
+        # retries are done here, as urllib3 does not back off with jitter
+        self._pool = urllib3.PoolManager(num_pools=4, maxsize=pool_size, retries=False)
+
+    def set_deadline(self, deadline: float | None) -> None:
+        """Sets the time of the clock after which no attempt may end, for the
+        requests of the current invocation
+        """
+
+        self._deadline = deadline
+
+    def get(self, url: str, headers: dict[str, str]) -> HttpResponse:
+        return self.request('GET', url, headers)
+
+    def put(self, url: str, headers: dict[str, str], json: dict) -> HttpResponse:
+        return self.request('PUT', url, headers, json)
+
+    def request(self, method: str, url: str, headers: dict[str, str],
+        json: dict | None = None) -> HttpResponse:
+        body = None if json is None else _json_body(json)
+        started_at = self._clock()
+        attempt = 0
+        while True:
+            with self._lock:
+                self._requests += 1
+            try:
+                raw_response = self._pool.request(method, url,
+                                                  body=body,
+                                                  headers=headers,
+                                                  timeout=self._timeout)
+            except urllib3.exceptions.HTTPError as e:
+                delay = self._backoff(attempt)
+                if not self._may_retry(attempt, started_at, delay):
+                    raise e
+                reason = type(e).__name__
+            else:
+                response = HttpResponse(raw_response.status, raw_response.headers,
+                                        raw_response.data, url)
+                if response.status_code not in self._retry_status_codes:
+                    return response
+                delay = self._retry_after(response)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                elif delay > self._max_retry_after:
+                    # waiting that long would exceed the lambda timeout
+                    return response
+                if not self._may_retry(attempt, started_at, delay):
+                    return response
+                reason = response.status_code
+
+            attempt += 1
+            with self._lock:
+                self._retries += 1
+            log.warning('Retrying %s %s in %.2fs (%s), attempt %s',
+                        method, url, delay, reason, attempt)
+            self._sleep(delay)
+
+    def stats(self) -> dict[str, int]:
+        """Returns the number of requests, retries and opened connections"""
+
+        connections = 0
+        pools = self._pool.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+
+        with self._lock:
+            requests, retries = self._requests, self._retries
+        return {
+            'requests': requests,
+            'retries': retries,
+            'connections': connections,
+            'reused_connections': max(requests - connections, 0)
+        }
+
+    def _may_retry(self, attempt: int, started_at: float, delay: float) -> bool:
+        if attempt >= self._max_retries:
+            return False
+        retry_at = self._clock() + delay
+        if retry_at - started_at > self._max_retry_seconds:
+            return False
+        return self._deadline is None or retry_at + self._attempt_seconds <= self._deadline
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self._backoff_max, self._backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def _retry_after(response: HttpResponse) -> float | None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is None:
+            return None
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+            return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+
+def _json_body(value: dict) -> bytes:
+    return json.dumps(value).encode('utf-8')
+
+
+class CircuitOpenException(Exception):
+    def __init__(self, name):
+        super().__init__("Circuit breaker is open: {}".format(name))
+
+
+class CircuitBreaker:
+    """Fails fast while a remote service keeps failing
+
+    The breaker is closed as long as calls succeed. After failure_threshold
+    consecutive failures it opens and rejects all calls. Once
+    reset_timeout_seconds have passed it is half-open and lets
+    half_open_max_calls trial calls through: a success closes it again, a
+    failure opens it for another period.
+
+    If a state store is given, the state is loaded from and saved to it, so it
+    survives across invocations and containers.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout_seconds: float = 30,
+        half_open_max_calls: int = 1,
+        state_store: 'S3CircuitStateStore | None' = None,
+        clock: Callable[[], float] = time.time,
+        metrics: Metrics | None = None
+    ):
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout_seconds = reset_timeout_seconds
+        self._half_open_max_calls = half_open_max_calls
+        self._state_store = state_store
+        self._clock = clock
+        self._metrics = metrics or shared_metrics()
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._half_open_calls = 0
+        self._save_lock = threading.Lock()
+        self._changes = 0
+        self._saved_change = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._half_open_if_timed_out()
+            return self._state
+
+    def allow_request(self) -> bool:
+        return self.state != self.OPEN
+
+    def load(self) -> None:
+        if self._state_store is not None:
+            stored = self._state_store.load()
+            if stored is not None:
+                with self._lock:
+                    self._state = stored['state']
+                    self._failures = stored['failures']
+                    self._opened_at = stored['opened_at']
+                    self._half_open_calls = 0
+
+    def call(self, send: Callable[[], T], is_failure: Callable[[T], bool] = lambda _: False) -> T:
+        self._acquire()
+        try:
+            result = send()
+        except Exception as e:
+            self._record(success=False)
+            raise e
+        self._record(success=not is_failure(result))
+        return result
+
+    def _acquire(self) -> None:
+        with self._lock:
+            self._half_open_if_timed_out()
+            if self._state == self.OPEN or (
+                self._state == self.HALF_OPEN
+                and self._half_open_calls >= self._half_open_max_calls):
+                raise CircuitOpenException(self._name)
+            if self._state == self.HALF_OPEN:
+                self._half_open_calls += 1
+
+    def _record(self, success: bool) -> None:
+        # Only opening and closing are saved: the failure count of a closed
+        # breaker is not worth a write per failed call, and half-open follows
+        # from opened_at once the state is loaded again.
+        with self._lock:
+            previous = self._state
+            self._update(success)
+            if self._state_store is None or self._state == previous:
+                return
+            self._changes += 1
+            change = self._changes
+            state = {'state': self._state,
+                     'failures': self._failures,
+                     'opened_at': self._opened_at}
+        self._save(change, state)
+
+    def _save(self, change: int, state: dict) -> None:
+        # Calls are not held up by the write; the save lock only keeps an
+        # older state from overwriting a newer one.
+        with self._save_lock:
+            if change > self._saved_change:
+                self._state_store.save(state)
+                self._saved_change = change
+
+    def _update(self, success: bool) -> None:
+        if success:
+            self._failures = 0
+            if self._state != self.CLOSED:
+                self._transition(self.CLOSED)
+        else:
+            self._failures += 1
+            if self._state == self.HALF_OPEN \
+                or self._failures >= self._failure_threshold:
+                self._opened_at = self._clock()
+                if self._state != self.OPEN:
+                    self._transition(self.OPEN)
+
+    def _half_open_if_timed_out(self) -> None:
+        if self._state == self.OPEN and \
+            self._clock() - self._opened_at >= self._reset_timeout_seconds:
+            self._transition(self.HALF_OPEN)
+
+    def _transition(self, state: str) -> None:
+        log.warning('Circuit breaker %s: %s -> %s', self._name, self._state, state)
+        self._metrics.count('CircuitBreakerTransition', 1,
+                            {'CircuitBreaker': self._name, 'State': state})
+        self._state = state
+        self._half_open_calls = 0
+
+
+class S3CircuitStateStore:
+    def __init__(self, s3, bucket: str, key: str):
+        self._s3 = s3
+        self._bucket = bucket
+        self._key = key
+
+    def load(self) -> dict | None:
+        try:
+            s3_object = self._s3.get_object(Bucket=self._bucket, Key=self._key)
+            return json.loads(s3_object['Body'].read().decode('utf-8'))
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            else:
+                raise e
+
+    def save(self, state: dict) -> None:
+        self._s3.put_object(
+            Body=json.dumps(state),
+            Bucket=self._bucket,
+            Key=self._key
+        )
+
+
+class Secrets:
+    def __init__(self, secretsmanager):
+        self._secretsmanager = secretsmanager
+
+    def get_secret(self, secret_name: str) -> str:
+        get_secret_value_response = \
+            self._secretsmanager.get_secret_value(SecretId=secret_name)
+
+        return get_secret_value_response['SecretString']
+
+
+class SecretCache:
+    """Keeps secrets in memory for a limited time
+
+    A secret is read from the secrets manager again once its time to live has
+    expired, or when refresh is called because the secret got rotated.
+    """
+
+    def __init__(
+        self,
+        secrets: Secrets,
+        ttl_seconds: float = 300,
+        min_refresh_interval_seconds: float = 10,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self._secrets = secrets
+        self._ttl_seconds = ttl_seconds
+        self._min_refresh_interval_seconds = min_refresh_interval_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: dict[str, tuple[str, float]] = {}
+
+    def get_secret(self, secret_name: str, force_refresh: bool = False) -> str:
+        with self._lock:
+            entry = self._entries.get(secret_name)
+            if force_refresh or entry is None \
+                or self._clock() - entry[1] >= self._ttl_seconds:
+                entry = (self._secrets.get_secret(secret_name), self._clock())
+                self._entries[secret_name] = entry
+            return entry[0]
+
+    def refresh(self, secret_name: str) -> str:
+        """Reads the secret again, unless that just happened
+
+        Used when the secret got rejected, e.g. after it was rotated. The
+        minimum interval keeps a wrong secret from flooding the secrets manager.
+        """
+
+        with self._lock:
+            entry = self._entries.get(secret_name)
+            recently_read = entry is not None and \
+                self._clock() - entry[1] < self._min_refresh_interval_seconds
+        if recently_read:
+            return entry[0]
+        return self.get_secret(secret_name, force_refresh=True)
+
+    def invalidate(self, secret_name: str | None = None) -> None:
+        with self._lock:
+            if secret_name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(secret_name, None)
@@ -0,0 +1,750 @@
+import json
+import logging
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+from unittest import TestCase
+from unittest.mock import patch, sentinel, Mock, ANY, call
+
+import boto3
+import urllib3
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+from dmm_common import Secrets, HttpSession, SecretCache, aws_client, shared_http_session, \
+    shared_secret_cache, reset_shared_warm_container, CircuitBreaker, CircuitOpenException, \
+    S3CircuitStateStore, Metrics, InMemoryMetricsSink, run_deadline, event_time, Feed, \
+    configured_feeds, configure_logging, bind_request_id, log_context, JsonFormatter, \
+    SamplingFilter, LazyJson, HttpResponse, HttpError, profiled
+
+
+
+class TestHttpSession(TestCase):
+    _url = 'https://dmm-url.com/api'
+
+    def setUp(self) -> None:
+        self._sleep = Mock()
+        self._session = HttpSession(max_retries=2, sleep=self._sleep)
+        self._session._pool.request = Mock()
+
+    @staticmethod
+    def _response(status: int, headers: dict | None = None) -> Mock:
+        return Mock(status=status, headers=headers or {}, data=b'{}')
+
+    def test_request__timeouts(self) -> None:
+        self._session = HttpSession(connect_timeout=1, read_timeout=2)
+        self._session._pool.request = Mock(return_value=self._response(200))
+
+        self._session.get(self._url, {})
+
+        timeout = self._session._pool.request.call_args.kwargs['timeout']
+        self.assertEqual((1, 2), (timeout.connect_timeout, timeout.read_timeout))
+
+    def test_request__retries_server_errors(self) -> None:
+        self._session._pool.request.side_effect = [
+            self._response(503), self._response(429), self._response(200)]
+
+        response = self._session.get(self._url, {})
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, self._sleep.call_count)
+        self.assertEqual(3, self._session.stats()['requests'])
+        self.assertEqual(2, self._session.stats()['retries'])
+
+    def test_request__bounded_retries(self) -> None:
+        self._session._pool.request.return_value = self._response(500)
+
+        response = self._session.get(self._url, {})
+
+        self.assertEqual(500, response.status_code)
+        self.assertEqual(3, self._session._pool.request.call_count)
+
+    def test_request__no_retry_on_client_error(self) -> None:
+        self._session._pool.request.return_value = self._response(404)
+
+        self.assertEqual(404, self._session.get(self._url, {}).status_code)
+        self._sleep.assert_not_called()
+
+    def test_request__honours_retry_after(self) -> None:
+        self._session._pool.request.side_effect = [
+            self._response(429, {'Retry-After': '7'}), self._response(200)]
+
+        self._session.get(self._url, {})
+
+        self._sleep.assert_called_once_with(7.0)
+
+    def test_request__retry_after_too_long(self) -> None:
+        self._session._pool.request.return_value = \
+            self._response(503, {'Retry-After': '3600'})
+
+        self.assertEqual(503, self._session.get(self._url, {}).status_code)
+        self._sleep.assert_not_called()
+
+    def test_request__retries_connection_errors(self) -> None:
+        self._session._pool.request.side_effect = [
+            urllib3.exceptions.NewConnectionError(None, 'refused'), self._response(200)]
+
+        self.assertEqual(200, self._session.get(self._url, {}).status_code)
+
+    def test_request__raises_after_retries(self) -> None:
+        self._session._pool.request.side_effect = urllib3.exceptions.ReadTimeoutError(None, self._url, 'timeout')
+
+        with self.assertRaises(urllib3.exceptions.ReadTimeoutError):
+            self._session.get(self._url, {})
+
+    def test_request__retries_end_after_max_retry_seconds(self) -> None:
+        self._session = HttpSession(max_retries=3, max_retry_seconds=1, sleep=self._sleep,
+                                    clock=Mock(side_effect=[0.0, 2.0]))
+        self._session._pool.request = Mock(return_value=self._response(503))
+
+        self.assertEqual(503, self._session.get(self._url, {}).status_code)
+        self.assertEqual(1, self._session._pool.request.call_count)
+        self._sleep.assert_not_called()
+
+    def test_request__no_attempt_after_deadline(self) -> None:
+        self._session = HttpSession(connect_timeout=1, read_timeout=2, max_retries=3,
+                                    sleep=self._sleep, clock=Mock(return_value=100.0))
+        self._session._pool.request = Mock(side_effect=urllib3.exceptions.ReadTimeoutError(
+            None, self._url, 'timeout'))
+        self._session.set_deadline(102.0)
+
+        with self.assertRaises(urllib3.exceptions.ReadTimeoutError):
+            self._session.get(self._url, {})
+        self.assertEqual(1, self._session._pool.request.call_count)
+
+        self._session.set_deadline(None)
+        with self.assertRaises(urllib3.exceptions.ReadTimeoutError):
+            self._session.get(self._url, {})
+        self.assertEqual(5, self._session._pool.request.call_count)
+
+    def test_stats__counted_by_several_threads(self) -> None:
+        self._session._pool.request.return_value = self._response(200)
+
+        threads = [threading.Thread(target=lambda: [self._session.get(self._url, {})
+                                                    for _ in range(200)])
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1600, self._session.stats()['requests'])
+
+    def test_request__round_trip(self) -> None:
+        class Handler(BaseHTTPRequestHandler):
+            def do_PUT(self) -> None:
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps({
+                    'api_key': self.headers['x-api-key'],
+                    'body': json.loads(body)}).encode('utf-8'))
+
+            def log_message(self, *args) -> None:
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            response = HttpSession().put(
+                'http://127.0.0.1:{}/api'.format(server.server_port),
+                headers={'x-api-key': 'secret'}, json={'a': 1})
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'api_key': 'secret', 'body': {'a': 1}}, response.json())
+        self.assertEqual('application/json', response.headers['content-type'])
+
+    def test_response__raise_for_status(self) -> None:
+        HttpResponse(200, {}, b'', self._url).raise_for_status()
+        with self.assertRaises(HttpError):
+            HttpResponse(404, {}, b'', self._url).raise_for_status()
+
+    def test_backoff__bounded(self) -> None:
+        for attempt in range(10):
+            self.assertLessEqual(self._session._backoff(attempt), 5.0)
+
+
+class TestSecrets(TestCase):
+    _secret_name = 'configured_name'
+    _secret_value = 'hi!_i_am_secret'
+
+    def setUp(self) -> None:
+        secretsmanager = boto3.client('secretsmanager')
+
+        self._secretsmanager_stubber = Stubber(secretsmanager)
+        self._secrets = Secrets(secretsmanager)
+
+    def tearDown(self) -> None:
+        self._secretsmanager_stubber.deactivate()
+
+    def test_get_secret(self) -> None:
+        expected_params = {
+            'SecretId': self._secret_name
+        }
+        response = {
+            'SecretString': self._secret_value
+        }
+        self._secretsmanager_stubber.add_response(
+            'get_secret_value', response, expected_params)
+        self._secretsmanager_stubber.activate()
+
+        self.assertEqual(self._secret_value,
+                         self._secrets.get_secret(self._secret_name))
+
+
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self) -> None:
+        self._now = 0.0
+        self._breaker = CircuitBreaker('test',
+                                       failure_threshold=2,
+                                       reset_timeout_seconds=10,
+                                       clock=lambda: self._now)
+
+    @staticmethod
+    def _fail() -> None:
+        raise ValueError()
+
+    def _trip(self) -> None:
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                self._breaker.call(self._fail)
+
+    def test_call__closed(self) -> None:
+        self.assertEqual(sentinel.result, self._breaker.call(lambda: sentinel.result))
+        self.assertEqual(CircuitBreaker.CLOSED, self._breaker.state)
+
+    def test_call__opens_after_threshold(self) -> None:
+        self._trip()
+
+        self.assertEqual(CircuitBreaker.OPEN, self._breaker.state)
+        send = Mock()
+        with self.assertRaises(CircuitOpenException):
+            self._breaker.call(send)
+        send.assert_not_called()
+
+    def test_call__failed_result(self) -> None:
+        for _ in range(2):
+            self._breaker.call(lambda: 503, is_failure=lambda r: r >= 500)
+
+        self.assertFalse(self._breaker.allow_request())
+
+    def test_call__success_resets_failures(self) -> None:
+        with self.assertRaises(ValueError):
+            self._breaker.call(self._fail)
+        self._breaker.call(lambda: None)
+        with self.assertRaises(ValueError):
+            self._breaker.call(self._fail)
+
+        self.assertEqual(CircuitBreaker.CLOSED, self._breaker.state)
+
+    def test_call__half_open_success_closes(self) -> None:
+        self._trip()
+        self._now = 10
+
+        self.assertEqual(CircuitBreaker.HALF_OPEN, self._breaker.state)
+        self._breaker.call(lambda: None)
+        self.assertEqual(CircuitBreaker.CLOSED, self._breaker.state)
+
+    def test_call__half_open_failure_opens(self) -> None:
+        self._trip()
+        self._now = 10
+
+        with self.assertRaises(ValueError):
+            self._breaker.call(self._fail)
+        self.assertEqual(CircuitBreaker.OPEN, self._breaker.state)
+
+    def test_call__half_open_limits_trial_calls(self) -> None:
+        self._trip()
+        self._now = 10
+
+        def nested_call() -> None:
+            self._breaker.call(lambda: None)
+
+        with self.assertRaises(CircuitOpenException):
+            self._breaker.call(nested_call)
+
+    def test_transitions_emit_metrics(self) -> None:
+        sink = InMemoryMetricsSink()
+        metrics = Metrics(sink=sink)
+        self._breaker = CircuitBreaker('test',
+                                       failure_threshold=2,
+                                       reset_timeout_seconds=10,
+                                       clock=lambda: self._now,
+                                       metrics=metrics)
+        self._trip()
+        metrics.flush()
+
+        self.assertEqual([1], sink.values('CircuitBreakerTransition',
+                                          {'CircuitBreaker': 'test',
+                                           'State': CircuitBreaker.OPEN}))
+
+
+class TestS3CircuitStateStore(TestCase):
+
+    def setUp(self) -> None:
+        self._now = 100.0
+        s3 = boto3.client('s3')
+        self._s3_stubber = Stubber(s3)
+        self._store = S3CircuitStateStore(s3, 'a_bucket', 'a_key')
+        self._breaker = CircuitBreaker('test', failure_threshold=1,
+                                       state_store=self._store,
+                                       clock=lambda: self._now)
+
+    def tearDown(self) -> None:
+        self._s3_stubber.deactivate()
+
+    def test_load(self) -> None:
+        state = json.dumps({'state': 'open', 'failures': 3,
+                            'opened_at': 95.0}).encode('utf-8')
+        self._s3_stubber.add_response(
+            'get_object',
+            {'Body': StreamingBody(BytesIO(state), len(state))},
+            {'Bucket': 'a_bucket', 'Key': 'a_key'})
+        self._s3_stubber.activate()
+
+        self._breaker.load()
+
+        self.assertFalse(self._breaker.allow_request())
+
+    def test_load__not_found(self) -> None:
+        self._s3_stubber.add_client_error('get_object', 'NoSuchKey')
+        self._s3_stubber.activate()
+
+        self._breaker.load()
+
+        self.assertTrue(self._breaker.allow_request())
+
+    def test_save_on_failure(self) -> None:
+        self._s3_stubber.add_response(
+            'put_object', {},
+            {'Bucket': 'a_bucket', 'Key': 'a_key',
+             'Body': json.dumps({'state': 'open', 'failures': 1,
+                                 'opened_at': 100.0})})
+        self._s3_stubber.activate()
+
+        with self.assertRaises(ValueError):
+            self._breaker.call(TestCircuitBreaker._fail)
+
+        self._s3_stubber.assert_no_pending_responses()
+
+    def test_save__only_when_opened_or_closed(self) -> None:
+        store = Mock()
+        self._breaker = CircuitBreaker('test', failure_threshold=2,
+                                       reset_timeout_seconds=10,
+                                       state_store=store,
+                                       clock=lambda: self._now)
+
+        with self.assertRaises(ValueError):
+            self._breaker.call(TestCircuitBreaker._fail)
+        self._breaker.call(lambda: None)
+        store.save.assert_not_called()
+
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                self._breaker.call(TestCircuitBreaker._fail)
+        self._now += 10
+        self._breaker.call(lambda: None)
+
+        self.assertEqual(
+            [call({'state': 'open', 'failures': 2, 'opened_at': 100.0}),
+             call({'state': 'closed', 'failures': 0, 'opened_at': 100.0})],
+            store.save.call_args_list)
+
+    def test_save__outside_lock(self) -> None:
+        store = Mock()
+        store.save.side_effect = \
+            lambda _: self.assertFalse(self._breaker._lock.locked())
+        self._breaker = CircuitBreaker('test', failure_threshold=1,
+                                       state_store=store,
+                                       clock=lambda: self._now)
+
+        with self.assertRaises(ValueError):
+            self._breaker.call(TestCircuitBreaker._fail)
+
+        store.save.assert_called_once()
+
+
+class TestSecretCache(TestCase):
+    _secret_name = 'a_name'
+
+    def setUp(self) -> None:
+        self._now = 0.0
+        self._secrets = Mock()
+        self._secrets.get_secret.side_effect = \
+            lambda name: 'secret_{}'.format(self._secrets.get_secret.call_count)
+        self._cache = SecretCache(self._secrets, ttl_seconds=60,
+                                  min_refresh_interval_seconds=5,
+                                  clock=lambda: self._now)
+
+    def test_get_secret__cached(self) -> None:
+        self.assertEqual('secret_1', self._cache.get_secret(self._secret_name))
+        self._now = 59
+        self.assertEqual('secret_1', self._cache.get_secret(self._secret_name))
+        self._secrets.get_secret.assert_called_once_with(self._secret_name)
+
+    def test_get_secret__expired(self) -> None:
+        self._cache.get_secret(self._secret_name)
+        self._now = 60
+        self.assertEqual('secret_2', self._cache.get_secret(self._secret_name))
+
+    def test_get_secret__force_refresh(self) -> None:
+        self._cache.get_secret(self._secret_name)
+        self.assertEqual('secret_2',
+                         self._cache.get_secret(self._secret_name, force_refresh=True))
+
+    def test_refresh(self) -> None:
+        self._cache.get_secret(self._secret_name)
+
+        self._now = 1
+        self.assertEqual('secret_1', self._cache.refresh(self._secret_name))
+        self._now = 5
+        self.assertEqual('secret_2', self._cache.refresh(self._secret_name))
+
+    def test_invalidate(self) -> None:
+        self._cache.get_secret(self._secret_name)
+        self._cache.invalidate()
+        self.assertEqual('secret_2', self._cache.get_secret(self._secret_name))
+
+
+class TestWarmContainer(TestCase):
+
+    def tearDown(self) -> None:
+        reset_shared_warm_container()
+
+    def test_aws_client__reused(self) -> None:
+        self.assertIs(aws_client('sqs'), aws_client('sqs'))
+
+    def test_shared_secret_cache__reused(self) -> None:
+        self.assertIs(shared_secret_cache(), shared_secret_cache())
+
+    def test_aws_client__created_once_by_concurrent_threads(self) -> None:
+        def client(service_name: str) -> Mock:
+            time.sleep(0.01)
+            return Mock()
+
+        with patch('boto3.client', side_effect=client) as boto3_client, \
+            ThreadPoolExecutor(max_workers=4) as executor:
+            clients = list(executor.map(lambda _: aws_client('sqs'), range(8)))
+
+        boto3_client.assert_called_once_with('sqs')
+        self.assertEqual(1, len({id(c) for c in clients}))
+
+    def test_reset_shared_warm_container(self) -> None:
+        client = aws_client('sqs')
+        session = shared_http_session()
+        secret_cache = shared_secret_cache()
+
+        reset_shared_warm_container()
+
+        self.assertIsNot(client, aws_client('sqs'))
+        self.assertIsNot(session, shared_http_session())
+        self.assertIsNot(secret_cache, shared_secret_cache())
+
+
+class TestRunDeadline(TestCase):
+
+    def test_run_deadline(self) -> None:
+        context = Mock()
+        context.get_remaining_time_in_millis.return_value = 60_000
+
+        with patch('dmm_common.time.time', Mock(return_value=100.0)):
+            self.assertEqual(155.0, run_deadline(context))
+
+    def test_run_deadline__without_context(self) -> None:
+        self.assertIsNone(run_deadline(None))
+
+
+class TestFeeds(TestCase):
+
+    @patch.dict('dmm_common.environ', {'dmm_base_url': 'https://dmm',
+                                       'dmm_api_key_secret_name': 'api_key',
+                                       'last_event_id_object_name': 'last_event_id'},
+                clear=True)
+    def test_configured_feeds__single_organization(self) -> None:
+        self.assertEqual([Feed(None, 'https://dmm', 'api_key', 'last_event_id')],
+                         configured_feeds())
+        self.assertEqual('1', configured_feeds()[0].message_group_id)
+
+    @patch.dict('dmm_common.environ', {'dmm_base_url': 'https://dmm', 'feeds': json.dumps([
+        {'name': 'org-a', 'dmm_api_key_secret_name': 'a/api_key'},
+        {'name': 'org-b', 'dmm_api_key_secret_name': 'b/api_key',
+         'dmm_base_url': 'https://other', 'last_event_id_object_name': 'b'}])}, clear=True)
+    def test_configured_feeds__several_organizations(self) -> None:
+        self.assertEqual([
+            Feed('org-a', 'https://dmm', 'a/api_key', 'poll_feed/org-a/last_event_id',
+                 'poll_feed/org-a/circuit_state'),
+            Feed('org-b', 'https://other', 'b/api_key', 'b', 'poll_feed/org-b/circuit_state')
+        ], configured_feeds())
+
+
+class TestEventTime(TestCase):
+
+    def test_event_time(self) -> None:
+        self.assertEqual(
+            datetime(2023, 7, 6, 12, 30, 1, 123456, tzinfo=timezone.utc),
+            event_time({'time': '2023-07-06T12:30:01.123456789Z'}))
+
+    def test_event_time__offset(self) -> None:
+        self.assertEqual(
+            datetime(2023, 7, 6, 10, 30, tzinfo=timezone.utc),
+            event_time({'time': '2023-07-06T12:30:00+02:00'}))
+
+    def test_event_time__missing(self) -> None:
+        self.assertIsNone(event_time({}))
+
+
+class TestLogging(TestCase):
+
+    def tearDown(self) -> None:
+        logging.getLogger('test.events').setLevel(logging.NOTSET)
+
+    def test_json_formatter__adds_correlation_ids(self) -> None:
+        record = logging.makeLogRecord({'name': 'test', 'levelname': 'INFO',
+                                        'msg': 'Sent %s', 'args': ('event',)})
+
+        with log_context(event_id='1'), log_context(data_usage_agreement_id='2'):
+            line = json.loads(JsonFormatter().format(record))
+
+        self.assertEqual('Sent event', line['message'])
+        self.assertEqual('test', line['logger'])
+        self.assertEqual('1', line['event_id'])
+        self.assertEqual('2', line['data_usage_agreement_id'])
+
+    def test_bind_request_id(self) -> None:
+        context = Mock(aws_request_id='a_request')
+        record = logging.makeLogRecord({'msg': 'message'})
+
+        bind_request_id(context)
+
+        self.assertEqual('a_request', json.loads(JsonFormatter().format(record))['request_id'])
+        bind_request_id(None)
+
+    def test_sampling_filter__keeps_all_lines_of_an_event(self) -> None:
+        sampling_filter = SamplingFilter(0.5)
+        record = logging.makeLogRecord({'levelno': logging.INFO})
+
+        kept = set()
+        for i in range(100):
+            with log_context(event_id=str(i)):
+                first = sampling_filter.filter(record)
+                self.assertEqual(first, sampling_filter.filter(record))
+                if first:
+                    kept.add(i)
+
+        self.assertTrue(0 < len(kept) < 100)
+
+    def test_sampling_filter__keeps_warnings(self) -> None:
+        record = logging.makeLogRecord({'levelno': logging.WARNING})
+
+        self.assertTrue(SamplingFilter(0).filter(record))
+
+    def test_lazy_json__only_serializes_written_lines(self) -> None:
+        value = Mock(return_value={'a': 1})
+        logger = logging.getLogger('test.events')
+        logger.setLevel(logging.WARNING)
+
+        logger.info('Trace: %s', LazyJson(value))
+
+        value.assert_not_called()
+        self.assertEqual('{"a": 1}', str(LazyJson(value)))
+
+    @patch.dict('dmm_common.environ', {'log_levels': 'test.events=warning'})
+    @patch('dmm_common._logging_configured', False)
+    def test_configure_logging__levels_from_environment(self) -> None:
+        root = logging.getLogger()
+        formatters = [handler.formatter for handler in root.handlers]
+        level = root.level
+        try:
+            configure_logging(logging.getLogger('test.events'))
+
+            self.assertEqual(logging.WARNING, logging.getLogger('test.events').level)
+            self.assertTrue(all(isinstance(handler.formatter, JsonFormatter)
+                                for handler in root.handlers))
+        finally:
+            for handler, formatter in zip(root.handlers, formatters):
+                handler.setFormatter(formatter)
+            root.setLevel(level)
+
+
+class TestProfiling(TestCase):
+
+    @staticmethod
+    def _work() -> list[str]:
+        return [json.dumps({'value': i}) for i in range(1000)]
+
+    @patch.dict('dmm_common.environ', {'profile_sample_rate': '0'})
+    @patch('dmm_common.InvocationProfiler')
+    def test_profiled__disabled(self, profiler) -> None:
+        with profiled(None, logging.getLogger('test')):
+            self._work()
+
+        profiler.assert_not_called()
+
+    @patch.dict('dmm_common.environ', {'profile_sample_rate': '1', 'profile_top': '5'})
+    def test_profiled__logs_summary(self) -> None:
+        with self.assertLogs('test', logging.INFO) as logs:
+            with profiled(None, logging.getLogger('test')):
+                # kept, so the allocations are still alive at the end of the block
+                values = self._work()
+
+        line = next(line for line in logs.output if 'Profile: ' in line)
+        summary = json.loads(line.split('Profile: ', 1)[1])
+        self.assertEqual(5, len(summary['top_own_time']))
+        self.assertTrue(any('_work' in function['function']
+                            for function in summary['top_cumulative_time']))
+        self.assertGreater(summary['peak_memory_kb'], 0)
+        self.assertEqual(1000, len(values))
+        self.assertTrue(any(allocation['site'].split(':')[0].endswith('/test_dmm_common.py')
+                            for allocation in summary['top_allocations']))
+
+    @patch.dict('dmm_common.environ', {'profile_sample_rate': '1',
+                                       'profile_bucket_name': 'a_bucket'})
+    def test_profiled__saved_to_s3(self) -> None:
+        s3 = boto3.client('s3')
+        s3_stubber = Stubber(s3)
+        for suffix in ('.json', '.prof'):
+            s3_stubber.add_response('put_object', {}, {
+                'Bucket': 'a_bucket', 'Key': 'profiles/test/{}/a_request{}'.format(
+                    datetime.now(timezone.utc).strftime('%Y-%m-%d'), suffix),
+                'Body': ANY})
+        s3_stubber.activate()
+
+        with patch.dict('dmm_common._aws_clients', {'s3': s3}):
+            with profiled(Mock(aws_request_id='a_request'), logging.getLogger('test')):
+                self._work()
+
+        s3_stubber.assert_no_pending_responses()
+
+    @patch.dict('dmm_common.environ', {'profile_sample_rate': '1'})
+    def test_profiled__raises_errors_of_block(self) -> None:
+        with self.assertRaises(ValueError):
+            with profiled(None, logging.getLogger('test')):
+                raise ValueError()
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self) -> None:
+        self._now = 0.0
+        self._sink = InMemoryMetricsSink()
+        self._metrics = Metrics(sink=self._sink, clock=lambda: self._now)
+
+    def test_flush__writes_embedded_metric_format(self) -> None:
+        self._metrics.put('Latency', 12.5, 'Milliseconds', {'Method': 'Get'})
+
+        self._metrics.flush()
+
+        [document] = self._sink.documents
+        self.assertEqual([{
+            'Namespace': 'DMMIntegration',
+            'Dimensions': [['Method']],
+            'Metrics': [{'Name': 'Latency', 'Unit': 'Milliseconds'}]
+        }], document['_aws']['CloudWatchMetrics'])
+        self.assertEqual(12.5, document['Latency'])
+        self.assertEqual('Get', document['Method'])
+
+    def test_flush__collects_values_per_dimensions(self) -> None:
+        self._metrics.put('Latency', 1, 'Milliseconds', {'Method': 'Get'})
+        self._metrics.put('Latency', 2, 'Milliseconds', {'Method': 'Get'})
+        self._metrics.put('Latency', 3, 'Milliseconds', {'Method': 'Put'})
+
+        self._metrics.flush()
+
+        self.assertEqual(2, len(self._sink.documents))
+        self.assertEqual([1, 2], self._sink.values('Latency', {'Method': 'Get'}))
+        self.assertEqual([3], self._sink.values('Latency', {'Method': 'Put'}))
+
+    def test_flush__splits_long_histograms(self) -> None:
+        for i in range(150):
+            self._metrics.put('Latency', i, 'Milliseconds')
+        self._metrics.count('Calls')
+
+        self._metrics.flush()
+
+        self.assertEqual(2, len(self._sink.documents))
+        self.assertEqual(list(range(150)), self._sink.values('Latency'))
+        self.assertEqual([1], self._sink.values('Calls'))
+
+    def test_flush__clears_metrics(self) -> None:
+        self._metrics.count('Calls')
+
+        self._metrics.flush()
+        self._metrics.flush()
+
+        self.assertEqual(1, len(self._sink.documents))
+
+    def test_count__sums_up(self) -> None:
+        self._metrics.count('Events', 2)
+        self._metrics.count('Events', 3)
+
+        self._metrics.flush()
+
+        self.assertEqual([5], self._sink.values('Events'))
+
+    def test_timer(self) -> None:
+        with self._metrics.timer('Latency', error_metric='Errors'):
+            self._now = 0.25
+
+        self._metrics.flush()
+
+        self.assertEqual([250], self._sink.values('Latency'))
+        self.assertEqual([], self._sink.values('Errors'))
+
+    def test_timer__counts_errors(self) -> None:
+        with self.assertRaises(ValueError):
+            with self._metrics.timer('Latency', {'Method': 'Get'}, error_metric='Errors'):
+                raise ValueError()
+
+        self._metrics.flush()
+
+        self.assertEqual([1], self._sink.values('Errors', {'Method': 'Get'}))
+        self.assertEqual(1, len(self._sink.values('Latency', {'Method': 'Get'})))
+
+    def test_spans(self) -> None:
+        with self._metrics.timer('Latency', {'Method': 'Get'}):
+            self._now = 0.5
+
+        self.assertEqual([{'name': 'Latency', 'Method': 'Get', 'start': 0.0,
+                           'duration_ms': 500}], self._metrics.spans())
+        self._metrics.flush()
+        self.assertEqual([], self._metrics.spans())
+
+    def test_spans__of_thread(self) -> None:
+        with self._metrics.timer('Latency'):
+            pass
+
+        def time_other() -> None:
+            with self._metrics.timer('Other'):
+                pass
+
+        thread = threading.Thread(target=time_other)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(['Latency', 'Other'], [span['name'] for span in self._metrics.spans()])
+        self.assertEqual(['Latency'], [span['name'] for span in
+                                       self._metrics.spans(threading.get_ident())])
+
+    def test_latency_summary(self) -> None:
+        for i in range(1, 101):
+            self._metrics.put('Latency', i, 'Milliseconds', {'Method': 'Get'})
+        self._metrics.count('Calls')
+
+        self.assertEqual({'Latency[Method=Get]': {
+            'count': 100, 'p50': 50, 'p90': 90, 'p99': 99, 'max': 100
+        }}, self._metrics.latency_summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
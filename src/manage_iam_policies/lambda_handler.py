@@ -1,189 +1,933 @@
 import json
 import logging
-from datetime import datetime
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import datetime, timezone
 from os import environ
-from typing import TypeAlias
+from typing import Callable, Iterable, NamedTuple, TypeAlias
 
-import boto3
-import requests
 from botocore.exceptions import ClientError
 
+from dmm_common import CircuitBreaker, DMMEvent, Feed, HttpResponse, HttpSession, LazyJson, \
+    Metrics, aws_client, bind_request_id, configure_logging, configured_feeds, event_time, \
+    log_context, profiled, reset_shared_warm_container, run_deadline, shared_http_session, \
+    shared_metrics, shared_secret_cache
+
 DataUsageAgreement: TypeAlias = dict[str, dict[str, str]]
 Port: TypeAlias = dict[str, dict[str, str]]
 DataProduct: TypeAlias = dict[str, dict[str, str] | list[Port]]
-DMMEvent: TypeAlias = dict[str, str | dict]
-
-
-def lambda_handler(event, context):
-    logging.getLogger().setLevel(logging.INFO)
-
-    # get configuration
-    dmm_base_url = environ['dmm_base_url']
-    dmm_api_key_secret_name = environ['dmm_api_key_secret_name']
-
-    # create iam manager
-    iam = boto3.client('iam')
-    iam_manager = AWSIAMManager(iam)
 
-    # create client for Data Mesh Manager
-    secretsmanager = boto3.client('secretsmanager')
-    secrets = Secrets(secretsmanager)
-    dmm_api_key = secrets.get_secret(dmm_api_key_secret_name)
-    dmm_client = DMMClient(dmm_base_url, dmm_api_key)
+log = logging.getLogger('manage_iam_policies')
+# lines per event, which can be sampled or silenced separately
+event_log = logging.getLogger('manage_iam_policies.events')
 
-    # create event handler
-    event_handler = EventHandler(dmm_client, iam_manager)
 
-    # handle dmm events from lambda event
-    dmm_events = list(map(lambda e: json.loads(e['body']), event['Records']))
-    for dmm_event in dmm_events:
-        event_handler.handle(dmm_event)
-
-    return
+def lambda_handler(event, context):
+    configure_logging(event_log)
+    bind_request_id(context)
+
+    # profile a share of all invocations, if enabled
+    with profiled(context, log):
+        # requests to Data Mesh Manager are not retried beyond the timeout
+        shared_http_session().set_deadline(run_deadline(context))
+
+        # create iam manager, for roles in other accounts as well if enabled
+        iam_manager = AWSIAMManager(aws_client('iam'),
+                                    account_clients=shared_account_clients())
+
+        ledger = agreement_ledger()
+
+        # delay and eventually dead-letter records which could not be handled
+        failed_record_handler = FailedRecordHandler(
+            aws_client('sqs'),
+            environ.get('dead_letter_queue_url'),
+            int(environ.get('max_receive_count', 5)),
+            int(environ.get('redelivery_base_delay_seconds', 60)),
+            int(environ.get('redelivery_max_delay_seconds', 3600)))
+
+        # updates of data usage agreements are applied from the outbox, if
+        # enabled, after their access change
+        outbox_queue_url = environ.get('outbox_queue_url') or None
+        outbox_failed_record_handler = FailedRecordHandler(
+            aws_client('sqs'),
+            environ.get('outbox_dead_letter_queue_url'),
+            int(environ.get('outbox_max_receive_count', 10)),
+            int(environ.get('outbox_redelivery_base_delay_seconds', 30)),
+            int(environ.get('redelivery_max_delay_seconds', 3600)))
+
+        # handle dmm events from lambda event, those of each organization
+        # with its own client for Data Mesh Manager
+        try:
+            records_of_feeds, batch_item_failures = records_by_feed(
+                event['Records'], configured_feeds(), failed_record_handler)
+            for feed, records in records_of_feeds:
+                secret_cache = shared_secret_cache()
+                dmm_client = DMMClient(
+                    feed.dmm_base_url,
+                    secret_cache.get_secret(feed.dmm_api_key_secret_name),
+                    int(environ.get('dmm_max_concurrency', 8)),
+                    refresh_api_key=lambda name=feed.dmm_api_key_secret_name:
+                    secret_cache.refresh(name),
+                    circuit_breaker=shared_circuit_breaker(feed),
+                    document_cache=shared_document_cache(feed))
+
+                outbox_records = [record for record in records if is_outbox_record(record)]
+                if len(outbox_records) > 0:
+                    batch_item_failures += drain_outbox(outbox_records,
+                                                        dmm_client,
+                                                        outbox_failed_record_handler)
+
+                event_records = [record for record in records if not is_outbox_record(record)]
+                if len(event_records) == 0:
+                    continue
+                # before the events are handled, so they see the changes
+                dmm_client.invalidate(invalidated_documents(event_records))
+
+                # create event handler
+                outbox = None if outbox_queue_url is None else \
+                    DMMOutbox(aws_client('sqs'), outbox_queue_url, feed.name)
+                event_handler = EventHandler(dmm_client, iam_manager, ledger,
+                                             max_account_concurrency=int(
+                                                 environ.get('max_account_concurrency', 8)),
+                                             outbox=outbox,
+                                             claims_expire_at=invocation_end(context),
+                                             claim_wait_seconds=float(
+                                                 environ.get('ledger_claim_wait_seconds', 2)))
+
+                batch_item_failures += handle_records(event_records,
+                                                      event_handler,
+                                                      failed_record_handler)
+        finally:
+            log.info('Latencies: %s', LazyJson(shared_metrics().latency_summary))
+            shared_metrics().flush()
+
+        log.info('HTTP session: %s', shared_http_session().stats())
+
+        return {'batchItemFailures': batch_item_failures}
+
+
+def invocation_end(context) -> float | None:
+    """Returns the time at which the invocation is stopped at the latest"""
+
+    if not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return time.time() + context.get_remaining_time_in_millis() / 1000
+
+
+def records_by_feed(
+    records: list[dict],
+    feeds: list['Feed'],
+    failed_record_handler: 'FailedRecordHandler'
+) -> tuple[list[tuple['Feed', list[dict]]], list[dict[str, str]]]:
+    """Groups the records by the feed poll_feed read them from and returns
+    them with the failed records of unknown feeds
+
+    Records without a feed are from the first feed, which is the single one
+    unless several are configured.
+    """
+
+    feeds_by_name = {feed.name: feed for feed in feeds}
+    batch_item_failures = []
+    grouped_records: dict[str | None, tuple[Feed, list[dict]]] = {}
+    for record in records:
+        feed_name = record.get('messageAttributes', {}).get('dmm-feed', {}).get('stringValue')
+        feed = feeds[0] if feed_name is None else feeds_by_name.get(feed_name)
+        if feed is None:
+            error = UnknownFeedException(feed_name)
+            log.error('Failed to handle record %s: %s', record['messageId'], error)
+            if failed_record_handler.failed(record, error):
+                batch_item_failures.append({'itemIdentifier': record['messageId']})
+            continue
+        grouped_records.setdefault(feed.name, (feed, []))[1].append(record)
+
+    return list(grouped_records.values()), batch_item_failures
+
+
+def invalidated_documents(records: list[dict]) -> list[str]:
+    """Returns the paths of the documents in Data Mesh Manager which the
+    events of the records changed, as poll_feed recognized them
+    """
+
+    paths = (record.get('messageAttributes', {}).get('dmm-invalidates', {}).get('stringValue')
+             for record in records)
+    return [path for path in paths if path is not None]
+
+
+class UnknownFeedException(Exception):
+    def __init__(self, feed_name: str):
+        super().__init__('Feed {} is not configured'.format(feed_name))
+
+
+def handle_records(
+    records: list[dict],
+    event_handler: 'EventHandler',
+    failed_record_handler: 'FailedRecordHandler'
+) -> list[dict[str, str]]:
+    """Handles the dmm events of all records as one batch and returns the
+    failed records
+
+    Only records whose event failed are returned. The records after it in a
+    fifo message group were handled as well, and returning them would apply
+    them again. As all events of a data usage agreement in the batch fail
+    together, and the failed record blocks its message group until it is
+    received again, the order of the events of an agreement is kept.
+    """
+
+    received_at = datetime.now(timezone.utc)
+    dmm_events = list(map(lambda r: json.loads(r['body']), records))
+    trace_contexts = {dmm_event.get('id'): trace_context(record, received_at)
+                      for record, dmm_event in zip(records, dmm_events)}
+    failures = event_handler.handle_batch(dmm_events, trace_contexts)
+
+    batch_item_failures = []
+    for record, dmm_event in zip(records, dmm_events):
+        error = failures.get(dmm_event.get('id'))
+        if error is not None and failed_record_handler.failed(record, error):
+            batch_item_failures.append({'itemIdentifier': record['messageId']})
+
+    return batch_item_failures
+
+
+def is_outbox_record(record: dict) -> bool:
+    return 'dmm-outbox' in record.get('messageAttributes', {})
+
+
+def drain_outbox(
+    records: list[dict],
+    dmm_client: 'DMMClient',
+    failed_record_handler: 'FailedRecordHandler',
+    metrics: 'Metrics | None' = None
+) -> list[dict[str, str]]:
+    """Applies the updates of data usage agreements from the outbox and
+    returns the failed records
+
+    All updates of an agreement in the batch are merged in their order and
+    applied with a single write, as each would replace the same top-level
+    fields. If the write fails, all records of the agreement are retried.
+    """
+
+    metrics = metrics or shared_metrics()
+    now = time.time()
+    records_by_agreement: dict[str, list[dict]] = {}
+    values: dict[str, dict] = {}
+    for record in records:
+        update = json.loads(record['body'])
+        data_usage_agreement_id = update['data_usage_agreement_id']
+        records_by_agreement.setdefault(data_usage_agreement_id, []).append(record)
+        values[data_usage_agreement_id] = {**values.get(data_usage_agreement_id, {}),
+                                           **update['value']}
+        sent_at = record['attributes'].get('SentTimestamp')
+        if sent_at is not None:
+            metrics.put('OutboxDelay', now * 1000 - int(sent_at), 'Milliseconds')
+
+    metrics.count('OutboxUpdates', len(records))
+    batch_item_failures = []
+    for data_usage_agreement_id, agreement_records in records_by_agreement.items():
+        try:
+            with log_context(data_usage_agreement_id=data_usage_agreement_id):
+                dmm_client.patch_data_usage_agreement(data_usage_agreement_id,
+                                                      values[data_usage_agreement_id])
+                event_log.info('Applied %s updates from the outbox', len(agreement_records))
+        except Exception as e:
+            log.exception('Failed to update data usage agreement %s', data_usage_agreement_id)
+            metrics.count('OutboxErrors', 1)
+            batch_item_failures += [{'itemIdentifier': record['messageId']}
+                                    for record in agreement_records
+                                    if failed_record_handler.failed(record, e)]
+    metrics.count('OutboxWrites', len(records_by_agreement))
+    return batch_item_failures
+
+
+# reused by all invocations of a warm container
+_circuit_breakers: dict[str, 'CircuitBreaker'] = {}
+_document_caches: dict[str, 'DocumentCache'] = {}
+_policy_compiler: 'PolicyCompiler | None' = None
+_account_clients: 'AccountClients | None' = None
+
+
+def shared_circuit_breaker(feed: 'Feed') -> 'CircuitBreaker':
+    # one per feed, so an unavailable organization does not stop the others
+    name = 'dmm' if feed.name is None else 'dmm-{}'.format(feed.name)
+    if name not in _circuit_breakers:
+        _circuit_breakers[name] = CircuitBreaker(
+            name,
+            failure_threshold=int(environ.get('dmm_circuit_failure_threshold', 5)),
+            reset_timeout_seconds=float(
+                environ.get('dmm_circuit_reset_timeout_seconds', 30)),
+            half_open_max_calls=int(
+                environ.get('dmm_circuit_half_open_max_calls', 1)))
+    return _circuit_breakers[name]
+
+
+def shared_document_cache(feed: 'Feed') -> 'DocumentCache | None':
+    # documents are kept until the feed reports a change or their time to live
+    # expires, as other warm containers do not see the change
+    max_size = int(environ.get('dmm_document_cache_size', 10000))
+    if max_size <= 0:
+        return None
+    name = 'dmm' if feed.name is None else 'dmm-{}'.format(feed.name)
+    if name not in _document_caches:
+        ttl_seconds = float(environ.get('dmm_document_cache_ttl_seconds') or 300)
+        if not 0 < ttl_seconds <= DocumentCache.max_ttl_seconds:
+            raise ValueError('dmm_document_cache_ttl_seconds must be more than 0 and at most {}'
+                             .format(DocumentCache.max_ttl_seconds))
+        _document_caches[name] = DocumentCache(max_size, ttl_seconds)
+    return _document_caches[name]
+
+
+def shared_policy_compiler() -> 'PolicyCompiler':
+    global _policy_compiler
+    if _policy_compiler is None:
+        _policy_compiler = PolicyCompiler()
+    return _policy_compiler
+
+
+def shared_account_clients() -> 'AccountClients | None':
+    # required to manage roles in other accounts than the one of the function
+    global _account_clients
+    target_account_role_name = environ.get('target_account_role_name')
+    if not target_account_role_name:
+        return None
+    if _account_clients is None:
+        _account_clients = AccountClients(
+            aws_client('sts'),
+            target_account_role_name,
+            own_account_id=environ.get('own_account_id') or None,
+            external_id=environ.get('target_account_external_id') or None,
+            partition=environ.get('aws_partition') or 'aws')
+    return _account_clients
+
+
+def agreement_ledger() -> 'DynamoDBAgreementLedger | None':
+    # required when events can arrive out of order, e.g. from a standard queue
+    ledger_table_name = environ.get('ledger_table_name')
+    if not ledger_table_name:
+        return None
+    return DynamoDBAgreementLedger(aws_client('dynamodb'), ledger_table_name)
+
+
+def reset_warm_container() -> None:
+    """Drops all clients, secrets, breaker states, documents, metrics,
+    compiled policies and assumed roles kept between invocations
+    """
+
+    global _policy_compiler, _account_clients
+    reset_shared_warm_container()
+    _circuit_breakers.clear()
+    _document_caches.clear()
+    _policy_compiler = None
+    _account_clients = None
+
+
+def trace_context(record: dict, received_at: datetime) -> dict[str, datetime | None]:
+    """Returns when the event of a record was polled from the feed, sent to
+    the queue and received by this function
+    """
+
+    def epoch_millis(value: str | None) -> datetime | None:
+        return None if value is None else \
+            datetime.fromtimestamp(int(value) / 1000, timezone.utc)
+
+    message_attributes = record.get('messageAttributes', {})
+
+    def message_attribute(name: str) -> str | None:
+        return message_attributes.get(name, {}).get('stringValue')
+
+    return {
+        'polled_at': epoch_millis(message_attribute('dmm-poll-time')),
+        # records from older versions of poll_feed only have the sent time
+        'enqueued_at': epoch_millis(message_attribute('dmm-enqueue-time')
+                                    or record['attributes'].get('SentTimestamp')),
+        'received_at': received_at
+    }
+
+
+class DocumentCache:
+    """Keeps documents of Data Mesh Manager by their url until they are
+    invalidated or their time to live expires
+
+    poll_feed tells which documents an event changed, so documents can be
+    kept across invocations. An invalidation only reaches the cache of the
+    container that handles the event, other warm containers keep reading
+    the old document until its time to live expires, so a shared cache has
+    one of at most max_ttl_seconds. Revocations read their documents again
+    anyway. The least recently read documents are dropped beyond the maximum
+    size. Documents that were not found are not kept, as they may be created
+    at any time.
+    """
+
+    max_ttl_seconds = 3600
+
+    def __init__(self, max_size: int = 10000, ttl_seconds: float | None = None,
+        clock: Callable[[], float] = time.monotonic,
+        metrics: Metrics | None = None):
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._metrics = metrics or shared_metrics()
+        self._lock = threading.Lock()
+        self._documents: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+
+    def get(self, url: str, fetch: Callable[[], dict | None]) -> dict | None:
+        with self._lock:
+            entry = self._documents.get(url)
+            if entry is not None and (self._ttl_seconds is None
+                                      or self._clock() - entry[1] < self._ttl_seconds):
+                self._documents.move_to_end(url)
+                self._metrics.count('DocumentCacheHits')
+                return entry[0]
+
+        self._metrics.count('DocumentCacheMisses')
+        document = fetch()
+        if document is not None:
+            self.put(url, document)
+        return document
+
+    def put(self, url: str, document: dict) -> None:
+        with self._lock:
+            self._documents[url] = (document, self._clock())
+            self._documents.move_to_end(url)
+            if len(self._documents) > self._max_size:
+                self._documents.popitem(last=False)
+
+    def invalidate(self, url: str) -> None:
+        with self._lock:
+            if self._documents.pop(url, None) is not None:
+                self._metrics.count('DocumentCacheInvalidations')
 
 
 class DMMClient:
-    def __init__(self, base_url: str, api_key: str):
+    """Client for the Data Mesh Manager API
+
+    Documents read by this client are kept in its document cache, which is
+    either its own for a single invocation or one shared by the invocations
+    of a warm container. Several documents can be fetched concurrently,
+    either directly or by prefetching everything a batch of events refers to.
+    """
+
+    def __init__(self, base_url: str, api_key: str, max_concurrency: int = 8,
+        session: HttpSession | None = None,
+        refresh_api_key: Callable[[], str] | None = None,
+        circuit_breaker: CircuitBreaker | None = None,
+        metrics: Metrics | None = None,
+        document_cache: DocumentCache | None = None):
         self._base_url = base_url
         self._api_key = api_key
+        self._session = session or shared_http_session()
+        self._refresh_api_key = refresh_api_key
+        self._circuit_breaker = circuit_breaker
+        self._metrics = metrics or shared_metrics()
+        self._refresh_lock = threading.Lock()
+        self._max_concurrency = max_concurrency
+        self._documents = document_cache or DocumentCache(metrics=self._metrics)
 
     def get_data_usage_agreement(self, data_usage_agreement_id: str) -> DataUsageAgreement | None:
-        response = self._get(self._data_usage_agreement_url(data_usage_agreement_id))
+        return self._cached(self._data_usage_agreement_url(data_usage_agreement_id),
+                            lambda: self._fetch_data_usage_agreement(data_usage_agreement_id))
+
+    def get_data_usage_agreements(self, data_usage_agreement_ids: Iterable[str]) \
+        -> dict[str, DataUsageAgreement | None]:
+        return self._get_concurrently(self.get_data_usage_agreement,
+                                      data_usage_agreement_ids)
+
+    def _fetch_data_usage_agreement(self, data_usage_agreement_id: str) -> DataUsageAgreement | None:
+        response = self._get(self._data_usage_agreement_url(data_usage_agreement_id),
+                             'GetDataUsageAgreement')
 
         if response.status_code == 404:
-            logging.warning(
-                'No data_usage_agreement with id {}'.format(data_usage_agreement_id))
+            log.warning('No data_usage_agreement with id %s', data_usage_agreement_id)
             return None
         else:
             response.raise_for_status()
             return response.json()
 
     def patch_data_usage_agreement(self, data_usage_agreement_id: str, value: dict) -> None:
+        # patches the version read for this batch, which the feed event of
+        # the agreement made the handling container read again
         current = self.get_data_usage_agreement(data_usage_agreement_id)
-        self._put(self._data_usage_agreement_url(data_usage_agreement_id), {**current, **value})
+        url = self._data_usage_agreement_url(data_usage_agreement_id)
+        updated = {**current, **value}
+        self._put(url, updated, 'PutDataUsageAgreement')
+        self._documents.put(url, updated)
 
     def _data_usage_agreement_url(self, data_usage_agreement_id) -> str:
         return '{base_url}/api/datausageagreements/{id}'.format(
             base_url=self._base_url, id=data_usage_agreement_id)
 
     def get_dataproduct(self, dataproduct_id) -> DataProduct | None:
-        response = self._get(self._dataproduct_url(dataproduct_id))
+        return self._cached(self._dataproduct_url(dataproduct_id),
+                            lambda: self._fetch_dataproduct(dataproduct_id))
+
+    def get_dataproducts(self, dataproduct_ids: Iterable[str]) \
+        -> dict[str, DataProduct | None]:
+        return self._get_concurrently(self.get_dataproduct, dataproduct_ids)
+
+    def _fetch_dataproduct(self, dataproduct_id) -> DataProduct | None:
+        response = self._get(self._dataproduct_url(dataproduct_id), 'GetDataProduct')
 
         if response.status_code == 404:
-            logging.warning(
-                'No dataproduct with id {}'.format(dataproduct_id))
+            log.warning('No dataproduct with id %s', dataproduct_id)
             return None
         else:
             response.raise_for_status()
-            return response.json()
+            return self._selected_fields(response.body)
+
+    # only the custom fields and output ports are used, so descriptions,
+    # models, links and the like of large data products are skipped
+    _decoder = json.JSONDecoder()
+    _whitespace = re.compile(r'[ \t\n\r]*')
+
+    @classmethod
+    def _selected_fields(cls, body: bytes) -> DataProduct:
+        """Decodes the used fields of a data product one top-level value and
+        one output port at a time, so that at most one of them is decoded as
+        a whole at once instead of the entire document
+
+        The API of Data Mesh Manager cannot return selected fields. All ports
+        are kept, as a kept provider serves the agreements of all its ports.
+        """
+
+        text = body.decode('utf-8')
+        selected = {}
+        members = 0
+        index = cls._expect(text, 0, '{')
+        while not cls._at(text, index, '}'):
+            if members > 0:
+                index = cls._expect(text, index, ',')
+            members += 1
+            key, index = json.decoder.scanstring(text, cls._expect(text, index, '"'))
+            index = cls._skip_whitespace(text, cls._expect(text, index, ':'))
+            if key == 'outputPorts' and cls._at(text, index, '['):
+                selected['outputPorts'], index = cls._selected_ports(text, index)
+                continue
+            value, index = cls._decoder.raw_decode(text, index)
+            if key == 'custom':
+                selected['custom'] = value
+            elif key == 'info':
+                selected['info'] = {'id': value.get('id')}
+        return selected
+
+    @classmethod
+    def _selected_ports(cls, text: str, index: int) -> tuple[list[Port], int]:
+        ports = []
+        index = cls._expect(text, index, '[')
+        while not cls._at(text, index, ']'):
+            if len(ports) > 0:
+                index = cls._expect(text, index, ',')
+            port, index = cls._decoder.raw_decode(text, cls._skip_whitespace(text, index))
+            ports.append({key: port[key] for key in ('id', 'custom') if key in port})
+        return ports, cls._expect(text, index, ']')
+
+    @classmethod
+    def _at(cls, text: str, index: int, character: str) -> bool:
+        return text.startswith(character, cls._skip_whitespace(text, index))
+
+    @classmethod
+    def _expect(cls, text: str, index: int, character: str) -> int:
+        index = cls._skip_whitespace(text, index)
+        if not text.startswith(character, index):
+            raise json.JSONDecodeError('Expecting {!r}'.format(character), text, index)
+        return index + 1
+
+    @classmethod
+    def _skip_whitespace(cls, text: str, index: int) -> int:
+        return cls._whitespace.match(text, index).end()
 
     def _dataproduct_url(self, dataproduct_id) -> str:
         return '{base_url}/api/dataproducts/{id}'.format(
             base_url=self._base_url, id=dataproduct_id)
 
-    def _get(self, url):
-        return requests.get(
+    def prefetch(self, data_usage_agreement_ids: Iterable[str],
+        revoked_ids: Iterable[str] = ()) -> None:
+        """Fetches the given data usage agreements and the data products they
+        refer to, so that later reads are served without a round trip
+
+        Of the agreements with revoked_ids only the consumer data product is
+        fetched, and both are read again even if they are kept, as a
+        revocation must not miss a consumer role that was changed after
+        another container read it. Failures are only logged here, the
+        affected documents are requested again when they are actually read.
+        """
+
+        revoked_ids = set(revoked_ids)
+        self.invalidate('datausageagreements/{}'.format(data_usage_agreement_id)
+                        for data_usage_agreement_id in revoked_ids)
+        data_usage_agreements = self._prefetch_concurrently(
+            self.get_data_usage_agreement, data_usage_agreement_ids)
+
+        dataproduct_ids = set()
+        revoked_dataproduct_ids = set()
+        for data_usage_agreement_id, data_usage_agreement in data_usage_agreements.items():
+            if data_usage_agreement is None:
+                continue
+            dataproduct_ids.add(data_usage_agreement['consumer']['dataProductId'])
+            if data_usage_agreement_id in revoked_ids:
+                revoked_dataproduct_ids.add(data_usage_agreement['consumer']['dataProductId'])
+            else:
+                dataproduct_ids.add(data_usage_agreement['provider']['dataProductId'])
+
+        self.invalidate('dataproducts/{}'.format(dataproduct_id)
+                        for dataproduct_id in revoked_dataproduct_ids)
+        self._prefetch_concurrently(self.get_dataproduct, dataproduct_ids)
+
+    def invalidate(self, paths: Iterable[str]) -> None:
+        """Drops the cached documents at the given paths of the api, e.g.
+        dataproducts/<id>, so they are read again
+        """
+
+        for path in paths:
+            self._documents.invalidate('{base_url}/api/{path}'.format(
+                base_url=self._base_url, path=path))
+
+    def _cached(self, url: str, fetch: Callable[[], dict | None]) -> dict | None:
+        return self._documents.get(url, fetch)
+
+    def _get_concurrently(self, get: Callable[[str], dict | None],
+        ids: Iterable[str]) -> dict[str, dict | None]:
+        unique_ids = list(dict.fromkeys(ids))
+        if len(unique_ids) <= 1:
+            return {i: get(i) for i in unique_ids}
+
+        # keeps the correlation ids of the log lines in the worker threads
+        context = copy_context()
+        with ThreadPoolExecutor(
+            max_workers=min(self._max_concurrency, len(unique_ids))) as executor:
+            return dict(zip(unique_ids, executor.map(
+                lambda i: context.copy().run(get, i), unique_ids)))
+
+    def _prefetch_concurrently(self, get: Callable[[str], dict | None],
+        ids: Iterable[str]) -> dict[str, dict | None]:
+        def get_or_none(document_id: str) -> dict | None:
+            try:
+                return get(document_id)
+            except Exception as e:
+                log.warning('Prefetch of %s failed: %s', document_id, e)
+                return None
+
+        return self._get_concurrently(get_or_none, ids)
+
+    def _get(self, url, method: str):
+        return self._authorized(method, lambda: self._session.get(
             url=url,
             headers={'x-api-key': self._api_key,
-                     'accept': 'application/json'})
+                     'accept': 'application/json'}))
 
-    def _put(self, url, body):
-        return requests.put(
+    def _put(self, url, body, method: str):
+        return self._authorized(method, lambda: self._session.put(
             url=url,
             headers={'x-api-key': self._api_key,
                      'accept': 'application/json',
                      'Content-Type': 'application/json'},
             json=body
-        )
+        ))
+
+    def _authorized(self, method: str,
+        send: Callable[[], HttpResponse]) -> HttpResponse:
+        dimensions = {'Method': method}
+        with self._metrics.timer('DMMCallLatency', dimensions,
+                                 error_metric='DMMCallErrors'):
+            if self._circuit_breaker is None:
+                response = self._authorized_send(send)
+            else:
+                response = self._circuit_breaker.call(
+                    lambda: self._authorized_send(send),
+                    is_failure=self._is_failure)
+        if self._is_failure(response):
+            self._metrics.count('DMMCallErrors', 1, dimensions)
+        return response
+
+    @staticmethod
+    def _is_failure(response: HttpResponse) -> bool:
+        return response.status_code >= 500 or response.status_code == 429
+
+    def _authorized_send(self, send: Callable[[], HttpResponse]) -> HttpResponse:
+        api_key = self._api_key
+        response = send()
+        if response.status_code in (401, 403) and self._refresh_api_key_changed(api_key):
+            response = send()
+        return response
+
+    def _refresh_api_key_changed(self, rejected_api_key: str) -> bool:
+        # the api key might have been rotated since it was read
+        if self._refresh_api_key is None:
+            return False
+        with self._refresh_lock:
+            if self._api_key == rejected_api_key:
+                self._api_key = self._refresh_api_key()
+            if self._api_key == rejected_api_key:
+                return False
+        log.warning('DMM rejected the api key, retrying with the rotated one')
+        return True
+
+
+class AccountClients:
+    """Keeps an IAM client per AWS account, with the credentials of a role
+    assumed in that account
+
+    Credentials of STS expire, so a client is replaced once its credentials
+    expire within the refresh margin. Roles of different accounts are assumed
+    independently, so a slow account does not hold up the others.
+    """
+
+    def __init__(
+        self,
+        sts,
+        role_name: str,
+        own_account_id: str | None = None,
+        external_id: str | None = None,
+        session_name: str = 'dmm-integration',
+        partition: str = 'aws',
+        duration_seconds: int = 3600,
+        refresh_margin_seconds: float = 300,
+        client_factory: Callable[[dict], object] | None = None,
+        metrics: Metrics | None = None,
+        clock: Callable[[], float] = time.time
+    ):
+        self._sts = sts
+        self._role_name = role_name
+        self.own_account_id = own_account_id
+        self._external_id = external_id
+        self._session_name = session_name
+        self._partition = partition
+        self._duration_seconds = duration_seconds
+        self._refresh_margin_seconds = refresh_margin_seconds
+        self._client_factory = client_factory or self._iam_client
+        self._metrics = metrics or shared_metrics()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._account_locks: dict[str, threading.Lock] = {}
+        # clients of different accounts are created by the worker threads of
+        # the event handler, boto3 does not create clients thread-safely
+        self._client_lock = threading.Lock()
+        self._entries: dict[str, tuple[object, float]] = {}
+
+    def iam(self, account_id: str):
+        """Returns an IAM client for the account, assuming the role again if
+        its credentials are about to expire
+        """
 
+        with self._lock:
+            account_lock = self._account_locks.setdefault(account_id, threading.Lock())
+        with account_lock:
+            entry = self._entries.get(account_id)
+            if entry is None or self._clock() >= entry[1] - self._refresh_margin_seconds:
+                credentials = self._assume_role(account_id)
+                with self._client_lock:
+                    client = self._client_factory(credentials)
+                entry = (client, credentials['Expiration'].timestamp())
+                self._entries[account_id] = entry
+            return entry[0]
+
+    def role_arn(self, account_id: str) -> str:
+        return 'arn:{}:iam::{}:role/{}'.format(self._partition, account_id, self._role_name)
+
+    def _assume_role(self, account_id: str) -> dict:
+        parameters = {'RoleArn': self.role_arn(account_id),
+                      'RoleSessionName': self._session_name,
+                      'DurationSeconds': self._duration_seconds}
+        if self._external_id is not None:
+            parameters['ExternalId'] = self._external_id
+        with self._metrics.timer('STSCallLatency', {'Method': 'AssumeRole'},
+                                 error_metric='STSCallErrors'):
+            return self._sts.assume_role(**parameters)['Credentials']
 
-class Secrets:
-    def __init__(self, secretsmanager):
-        self._secretsmanager = secretsmanager
+    @staticmethod
+    def _iam_client(credentials: dict):
+        # a session of its own, the default session of boto3 is shared with the
+        # clients created by aws_client
+        import boto3.session
+        return boto3.session.Session(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken']).client('iam')
 
-    def get_secret(self, secret_name: str) -> str:
-        get_secret_value_response = \
-            self._secretsmanager.get_secret_value(SecretId=secret_name)
 
-        return get_secret_value_response['SecretString']
+class AccountNotManagedException(Exception):
+    def __init__(self, account_id: str):
+        super().__init__('Roles of account {} are not managed, set target_account_role_name'
+                         .format(account_id))
 
 
 class AWSIAMManager:
-    def __init__(self, iam):
+    def __init__(self, iam, metrics: Metrics | None = None,
+        policy_compiler: 'PolicyCompiler | None' = None,
+        account_clients: AccountClients | None = None):
         self._iam = iam
+        self._metrics = metrics or shared_metrics()
+        self._policy_compiler = policy_compiler or shared_policy_compiler()
+        self._account_clients = account_clients
 
     def remove_access(self,
         data_usage_agreement_id: str,
-        consumer_role_name: str):
+        consumer_role_name: str,
+        consumer_account_id: str | None = None):
+        iam = self._iam_of(consumer_account_id)
         try:
-            self._iam.delete_role_policy(
-                RoleName=consumer_role_name,
-                PolicyName=self._policy_name(data_usage_agreement_id), )
+            with self._metrics.timer('IAMCallLatency', {'Method': 'DeleteRolePolicy'}):
+                iam.delete_role_policy(
+                    RoleName=consumer_role_name,
+                    PolicyName=self._policy_name(data_usage_agreement_id), )
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchEntity':
-                logging.warning('Policy for {} not found.'
-                                .format(data_usage_agreement_id))
+                log.warning('Policy for %s not found.', data_usage_agreement_id)
             else:
+                self._metrics.count('IAMCallErrors', 1, {'Method': 'DeleteRolePolicy'})
                 raise e
 
     def grant_access(self,
         data_usage_agreement_id: str,
         consumer_role_name: str,
         output_port_type: str,
-        output_port_arn: [str]) -> str:
+        output_port_arn: [str],
+        consumer_account_id: str | None = None) -> str:
         """Gives access to an AWS resource and returns the name of the
         corresponding policy
 
         works only for S3 buckets at this point
         """
 
+        iam = self._iam_of(consumer_account_id)
         policy_name = self._policy_name(data_usage_agreement_id)
-        policy_statements = self._policy_statements(output_port_type,
-                                                    output_port_arn)
-        policy_document = self._policy_document(policy_statements)
+        policy_document = self._policy_compiler.compile(output_port_type,
+                                                        output_port_arn)
+        self._metrics.put('PolicyDocumentSize', len(policy_document), 'Bytes')
 
-        self._iam.put_role_policy(
-            RoleName=consumer_role_name,
-            PolicyName=policy_name,
-            PolicyDocument=json.dumps(policy_document)
-        )
+        with self._metrics.timer('IAMCallLatency', {'Method': 'PutRolePolicy'},
+                                 error_metric='IAMCallErrors'):
+            iam.put_role_policy(
+                RoleName=consumer_role_name,
+                PolicyName=policy_name,
+                PolicyDocument=policy_document
+            )
 
         return policy_name
 
+    def _iam_of(self, account_id: str | None):
+        # roles without an account are in the account of the function
+        if account_id is None:
+            return self._iam
+        if self._account_clients is None:
+            raise AccountNotManagedException(account_id)
+        if account_id == self._account_clients.own_account_id:
+            return self._iam
+        return self._account_clients.iam(account_id)
+
     @staticmethod
     def _policy_name(data_usage_agreement_id: str) -> str:
         return 'DMM_DataUsageAgreement_{}'.format(data_usage_agreement_id)
 
     @staticmethod
-    def _policy_document(policy_statements: [dict]) -> dict:
+    def _managed_by_tag() -> dict[str, str]:
+        return {
+            'Key': 'managed-by',
+            'Value': 'dmm-integration'
+        }
+
+    @staticmethod
+    def _contract_id_tag(data_usage_agreement_id: str) -> dict[str, str]:
+        return {
+            'Key': 'dmm-integration-contract',
+            'Value': data_usage_agreement_id
+        }
+
+    @staticmethod
+    def _policy_version() -> str:
+        return datetime.today().strftime('%Y-%m-%d')
+
+
+class Arn(NamedTuple):
+    """An ARN with the parts the policy compiler needs, the value is kept
+    as it is
+    """
+
+    value: str
+    partition: str
+    service: str
+    resource: str
+
+    @staticmethod
+    def parse(value: str) -> 'Arn | None':
+        # arn:partition:service:region:account-id:resource
+        parts = value.split(':', 5)
+        if len(parts) < 3 or parts[0] != 'arn' or not parts[1].startswith('aws'):
+            return None
+        return Arn(value, parts[1], parts[2], parts[5] if len(parts) == 6 else '')
+
+
+class PolicyCompiler:
+    """Compiles the ARNs of an output port into a minified policy document
+
+    Documents are kept by the type and ARNs of their output port, so ports
+    granted to several consumers are only compiled once per container.
+    Duplicate ARNs and ARNs already matched by a wildcard of the same
+    statement are left out, to stay further below the size limit of IAM.
+    """
+
+    def __init__(self, max_size: int = 256):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._documents: OrderedDict[tuple, str] = OrderedDict()
+
+    def compile(self, output_port_type: str, output_port_arn: list[str]) -> str:
+        fingerprint = (output_port_type, tuple(output_port_arn))
+        with self._lock:
+            if fingerprint in self._documents:
+                self._documents.move_to_end(fingerprint)
+                return self._documents[fingerprint]
+
+        policy_document = json.dumps(
+            self._policy_document(self._policy_statements(output_port_type,
+                                                          output_port_arn)),
+            separators=(',', ':'))
+
+        with self._lock:
+            self._documents[fingerprint] = policy_document
+            if len(self._documents) > self._max_size:
+                self._documents.popitem(last=False)
+        return policy_document
+
+    @staticmethod
+    def _policy_document(policy_statements: list[dict]) -> dict:
         return {
             'Version': '2012-10-17',
-            'Statement': policy_statements
+            'Statement': [{**statement, 'Resource': PolicyCompiler._compact(statement['Resource'])}
+                          for statement in policy_statements]
         }
 
     # create required policy statements based on the service defined in arn
     @staticmethod
-    def _policy_statements(output_port_type: str, output_port_arn: [str]):
+    def _policy_statements(output_port_type: str, output_port_arn: list[str]) -> list[dict]:
+        arns_by_service = PolicyCompiler._arns_by_service(output_port_arn)
         match output_port_type:
             case 's3_bucket':
-                policy_statements = AWSIAMManager._s3_bucket_statements(
-                    output_port_arn)
+                policy_statements = PolicyCompiler._s3_bucket_statements(
+                    arns_by_service)
             case 'glue_table':
-                policy_statements = AWSIAMManager._glue_table_statements(
-                    output_port_arn)
+                policy_statements = PolicyCompiler._glue_table_statements(
+                    arns_by_service)
             case _:
                 raise UnsupportedOutputPortException(output_port_type)
         return policy_statements
 
     @staticmethod
-    def _s3_bucket_statements(output_port_arn):
-        s3_arn = AWSIAMManager._filter_arn_by_service(output_port_arn, 's3')
-        policy_statements = [AWSIAMManager._s3_bucket_statement(s3_arn)]
-        return policy_statements
+    def _arns_by_service(output_port_arn: list[str]) -> dict[str, list[Arn]]:
+        arns_by_service: dict[str, list[Arn]] = {}
+        for value in output_port_arn:
+            arn = Arn.parse(value)
+            if arn is None:
+                log.warning('Ignoring invalid ARN %s', value)
+                continue
+            arns_by_service.setdefault(arn.service, []).append(arn)
+        return arns_by_service
 
     @staticmethod
-    def _s3_bucket_statement(bucket_arn: [str]) -> dict:
-        return {
+    def _s3_bucket_statements(arns_by_service: dict[str, list[Arn]]) -> list[dict]:
+        bucket_arn = [arn.value for arn in arns_by_service.get('s3', [])]
+        return [{
             'Effect': 'Allow',
             'Action': [
                 's3:GetBucketLocation',
@@ -192,80 +936,187 @@ class AWSIAMManager:
             ],
             'Resource': [
                 *bucket_arn,
-                *list(map(lambda a: '{}/*'.format(a), bucket_arn))
+                *['{}/*'.format(a) for a in bucket_arn]
             ]
-        }
+        }]
 
-    @staticmethod
     # access to glue tables by using an athena query
-    def _glue_table_statements(output_port_arn):
-        s3_arn = AWSIAMManager._filter_arn_by_service(output_port_arn, 's3')
-        glue_arn = AWSIAMManager._filter_arn_by_service(output_port_arn, 'glue')
-        athena_arn = AWSIAMManager._filter_arn_by_service(output_port_arn,
-                                                          'athena')
-
-        policy_statements = [
-            *AWSIAMManager._s3_folder_statements(s3_arn),
-            AWSIAMManager._glue_statement(glue_arn),
-            AWSIAMManager._athena_statement(athena_arn)]
-        return policy_statements
-
-    @staticmethod
-    def _s3_folder_statements(s3_arn):
-        bucket_statement = {
-            'Effect': 'Allow',
-            'Action': [
-                's3:ListBucket'
-            ],
-            'Resource': list(map(lambda a: a.split('/')[0], s3_arn))
-        }
-        folder_statement = {
-            'Effect': 'Allow',
-            'Action': [
-                's3:GetObject'
-            ],
-            'Resource': list(map(lambda a: '{}/*'.format(a), s3_arn))
-        }
-        return bucket_statement, folder_statement
-
     @staticmethod
-    def _glue_statement(arn: [str]) -> dict:
-        return {
-            'Effect': 'Allow',
-            'Action': ['glue:GetTable'],
-            'Resource': arn
-        }
+    def _glue_table_statements(arns_by_service: dict[str, list[Arn]]) -> list[dict]:
+        s3_arn = [arn.value for arn in arns_by_service.get('s3', [])]
+        return [
+            {
+                'Effect': 'Allow',
+                'Action': ['s3:ListBucket'],
+                'Resource': [a.split('/')[0] for a in s3_arn]
+            },
+            {
+                'Effect': 'Allow',
+                'Action': ['s3:GetObject'],
+                'Resource': ['{}/*'.format(a) for a in s3_arn]
+            },
+            {
+                'Effect': 'Allow',
+                'Action': ['glue:GetTable'],
+                'Resource': [arn.value for arn in arns_by_service.get('glue', [])]
+            },
+            {
+                'Effect': 'Allow',
+                'Action': ['athena:StartQueryExecution'],
+                'Resource': [arn.value for arn in arns_by_service.get('athena', [])]
+            }
+        ]
 
     @staticmethod
-    def _athena_statement(workgroup_arn: [str]) -> dict:
-        return {
-            'Effect': 'Allow',
-            'Action': ['athena:StartQueryExecution'],
-            'Resource': workgroup_arn
-        }
+    def _compact(resources: list[str]) -> list[str]:
+        """Drops duplicates and resources matched by a trailing wildcard of
+        another resource, keeping the order
 
-    @staticmethod
-    def _filter_arn_by_service(arn_list: [str], service_name: str) -> [str]:
-        return list(arn for arn in arn_list if
-                    arn.startswith('arn:aws:{}'.format(service_name)))
+        Siblings are not merged into a new wildcard, as it would also match
+        resources which are not part of the output port.
+        """
 
-    @staticmethod
-    def _managed_by_tag() -> dict[str, str]:
-        return {
-            'Key': 'managed-by',
-            'Value': 'dmm-integration'
+        unique_resources = list(dict.fromkeys(resources))
+        wildcard_prefixes = {resource[:-1] for resource in unique_resources
+                             if resource.endswith('*')}
+        if len(wildcard_prefixes) == 0:
+            return unique_resources
+
+        def is_covered(resource: str) -> bool:
+            # a wildcard does not cover itself
+            end = len(resource) - 1 if resource.endswith('*') else len(resource)
+            return any(resource[:i] in wildcard_prefixes for i in range(end + 1)
+                       if resource[:i] + '*' != resource)
+
+        return [resource for resource in unique_resources if not is_covered(resource)]
+
+
+class FailedRecordHandler:
+    """Delays the redelivery of failed sqs records
+
+    A record which failed max_receive_count times is moved to the dead-letter
+    queue, whatever the error, so that it does not block its message group
+    any longer. The redelivery from a standard queue is delayed exponentially.
+    In a fifo queue, all events of a feed share a message group, so a delayed
+    record holds back all events after it, revocations included. Its
+    redelivery is therefore only delayed by the base delay.
+    """
+
+    _max_visibility_timeout_seconds = 43200
+
+    def __init__(
+        self,
+        sqs,
+        dead_letter_queue_url: str | None,
+        max_receive_count: int = 5,
+        base_delay_seconds: int = 60,
+        max_delay_seconds: int = 3600
+    ):
+        self._sqs = sqs
+        self._dead_letter_queue_url = dead_letter_queue_url
+        self._max_receive_count = max_receive_count
+        self._base_delay_seconds = base_delay_seconds
+        self._max_delay_seconds = min(max_delay_seconds,
+                                      self._max_visibility_timeout_seconds)
+
+    def failed(self, record: dict, error: Exception) -> bool:
+        """Returns whether the record is still part of the queue"""
+
+        receive_count = int(record['attributes']['ApproximateReceiveCount'])
+        if self._dead_letter_queue_url is not None \
+            and receive_count >= self._max_receive_count:
+            self._dead_letter(record, error)
+            return False
+
+        self._delay(record, self.redelivery_delay(
+            receive_count, fifo=record['eventSourceARN'].endswith('.fifo')))
+        return True
+
+    def redelivery_delay(self, receive_count: int, fifo: bool = False) -> int:
+        if fifo:
+            return min(self._base_delay_seconds, self._max_delay_seconds)
+        return min(self._base_delay_seconds * 2 ** (receive_count - 1),
+                   self._max_delay_seconds)
+
+    def _delay(self, record: dict, delay_seconds: int) -> None:
+        try:
+            self._sqs.change_message_visibility(
+                QueueUrl=self._queue_url(record['eventSourceARN']),
+                ReceiptHandle=record['receiptHandle'],
+                VisibilityTimeout=delay_seconds)
+        except ClientError as e:
+            # the record is redelivered after the default visibility timeout
+            log.warning('Could not delay message %s: %s', record['messageId'], e)
+
+    def _dead_letter(self, record: dict, error: Exception) -> None:
+        log.error('Moving message %s to the dead-letter queue after %s attempts',
+                  record['messageId'], record['attributes']['ApproximateReceiveCount'])
+
+        # keep the attributes of the record and add the reason of its failure
+        message_attributes = {
+            name: {'DataType': attribute['dataType'],
+                   'StringValue': attribute['stringValue']}
+            for name, attribute in record.get('messageAttributes', {}).items()
+            if 'stringValue' in attribute}
+        message_attributes['dmm-error'] = {
+            'DataType': 'String',
+            'StringValue': '{}: {}'.format(type(error).__name__, error)[:1024]}
+
+        message = {
+            'QueueUrl': self._dead_letter_queue_url,
+            'MessageBody': record['body'],
+            'MessageAttributes': message_attributes
         }
+        if self._dead_letter_queue_url.endswith('.fifo'):
+            message['MessageGroupId'] = record['attributes']['MessageGroupId']
+            message['MessageDeduplicationId'] = record['messageId']
+
+        self._sqs.send_message(**message)
 
     @staticmethod
-    def _contract_id_tag(data_usage_agreement_id: str) -> dict[str, str]:
-        return {
-            'Key': 'dmm-integration-contract',
-            'Value': data_usage_agreement_id
+    def _queue_url(queue_arn: str) -> str:
+        _, partition, _, region, account_id, queue_name = queue_arn.split(':')
+        domain = 'amazonaws.com.cn' if partition == 'aws-cn' else 'amazonaws.com'
+        return 'https://sqs.{region}.{domain}/{account_id}/{queue_name}'.format(
+            region=region, domain=domain, account_id=account_id,
+            queue_name=queue_name)
+
+
+class DMMOutbox:
+    """Queues the updates of data usage agreements in Data Mesh Manager,
+    which are applied later by drain_outbox
+
+    An access change is then done as soon as its IAM change is, and a failing
+    or slow Data Mesh Manager neither delays it nor causes it to be redone.
+    In a fifo queue, the updates of an agreement are in a message group of
+    their own, so they are applied in their order.
+    """
+
+    def __init__(self, sqs, queue_url: str, feed_name: str | None = None,
+        metrics: Metrics | None = None):
+        self._sqs = sqs
+        self._queue_url = queue_url
+        self._feed_name = feed_name
+        self._metrics = metrics or shared_metrics()
+
+    def add(self, data_usage_agreement_id: str, value: dict, event_id: str) -> None:
+        message_attributes = {'dmm-outbox': {'DataType': 'String',
+                                             'StringValue': 'patch_data_usage_agreement'}}
+        if self._feed_name is not None:
+            message_attributes['dmm-feed'] = {'DataType': 'String',
+                                              'StringValue': self._feed_name}
+        message = {
+            'QueueUrl': self._queue_url,
+            'MessageBody': json.dumps({'data_usage_agreement_id': data_usage_agreement_id,
+                                       'value': value}),
+            'MessageAttributes': message_attributes
         }
+        if self._queue_url.endswith('.fifo'):
+            message['MessageGroupId'] = data_usage_agreement_id
+            message['MessageDeduplicationId'] = event_id
 
-    @staticmethod
-    def _policy_version() -> str:
-        return datetime.today().strftime('%Y-%m-%d')
+        with self._metrics.timer('OutboxSendLatency', error_metric='OutboxSendErrors'):
+            self._sqs.send_message(**message)
 
 
 class UnsupportedOutputPortException(Exception):
@@ -273,95 +1124,598 @@ class UnsupportedOutputPortException(Exception):
         super().__init__("Unsupported output port: {}".format(service_name))
 
 
+class AgreementClaimedException(Exception):
+    def __init__(self, data_usage_agreement_id: str, event_id: str):
+        super().__init__("Data usage agreement {} is claimed by event {}"
+                         .format(data_usage_agreement_id, event_id))
+
+
+class InMemoryAgreementLedger:
+    """Remembers the last event applied to each data usage agreement
+
+    An event claims its data usage agreement before it is applied, so that
+    no other event of the agreement is applied at the same time. Only lives as
+    long as the container, so it is meant for tests and local runs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: dict[str, dict] = {}
+
+    def get(self, data_usage_agreement_id: str) -> dict | None:
+        with self._lock:
+            return self._entries.get(data_usage_agreement_id)
+
+    def get_many(self, data_usage_agreement_ids: Iterable[str]) -> dict[str, dict | None]:
+        return {i: self.get(i) for i in data_usage_agreement_ids}
+
+    def claim(self, data_usage_agreement_id: str, event_id: str, version: int,
+        claimed_until: float) -> bool:
+        """Claims the agreement for the event until the given time, unless a
+        later event was recorded or another event holds an unexpired claim
+        """
+
+        with self._lock:
+            entry = self._entries.get(data_usage_agreement_id)
+            if entry is not None and entry['event_id'] != event_id and (
+                entry['version'] > version
+                or entry.get('claimed_until', 0) >= time.time()):
+                return False
+            self._entries[data_usage_agreement_id] = {'event_id': event_id,
+                                                      'version': version,
+                                                      'claimed_until': claimed_until}
+            return True
+
+    def record(self, data_usage_agreement_id: str, event_id: str, version: int) -> bool:
+        """Stores the event as applied and releases its claim, unless another
+        event claimed the agreement or a later one was recorded in the meantime
+        """
+
+        with self._lock:
+            entry = self._entries.get(data_usage_agreement_id)
+            if entry is not None and entry['event_id'] != event_id and (
+                entry['version'] > version or 'claimed_until' in entry):
+                return False
+            self._entries[data_usage_agreement_id] = {'event_id': event_id,
+                                                      'version': version}
+            return True
+
+
+class DynamoDBAgreementLedger:
+    """Remembers the last event applied to each data usage agreement in a
+    DynamoDB table with the string hash key 'agreement_id'
+    """
+
+    _max_batch_get_keys = 100
+
+    def __init__(self, dynamodb, table_name: str):
+        self._dynamodb = dynamodb
+        self._table_name = table_name
+
+    def get(self, data_usage_agreement_id: str) -> dict | None:
+        response = self._dynamodb.get_item(
+            TableName=self._table_name,
+            Key={'agreement_id': {'S': data_usage_agreement_id}},
+            ConsistentRead=True)
+        return self._entry(response['Item']) if 'Item' in response else None
+
+    def get_many(self, data_usage_agreement_ids: Iterable[str]) -> dict[str, dict | None]:
+        ids = list(dict.fromkeys(data_usage_agreement_ids))
+        entries: dict[str, dict | None] = {i: None for i in ids}
+
+        for start in range(0, len(ids), self._max_batch_get_keys):
+            request_items = {self._table_name: {
+                'Keys': [{'agreement_id': {'S': i}}
+                         for i in ids[start:start + self._max_batch_get_keys]],
+                'ConsistentRead': True}}
+            while request_items:
+                response = self._dynamodb.batch_get_item(RequestItems=request_items)
+                for item in response['Responses'].get(self._table_name, []):
+                    entries[item['agreement_id']['S']] = self._entry(item)
+                request_items = response.get('UnprocessedKeys')
+
+        return entries
+
+    def claim(self, data_usage_agreement_id: str, event_id: str, version: int,
+        claimed_until: float) -> bool:
+        """Claims the agreement for the event until the given time, unless a
+        later event was recorded or another event holds an unexpired claim
+        """
+
+        return self._put_item(
+            {'agreement_id': {'S': data_usage_agreement_id},
+             'event_id': {'S': event_id},
+             'version': {'N': str(version)},
+             'claimed_until': {'N': str(claimed_until)}},
+            'attribute_not_exists(agreement_id) OR event_id = :event_id '
+            'OR (version <= :version '
+            'AND (attribute_not_exists(claimed_until) OR claimed_until < :now))',
+            {':event_id': {'S': event_id},
+             ':version': {'N': str(version)},
+             ':now': {'N': str(time.time())}})
+
+    def record(self, data_usage_agreement_id: str, event_id: str, version: int) -> bool:
+        """Stores the event as applied and releases its claim, unless another
+        event claimed the agreement or a later one was recorded in the meantime
+        """
+
+        return self._put_item(
+            {'agreement_id': {'S': data_usage_agreement_id},
+             'event_id': {'S': event_id},
+             'version': {'N': str(version)}},
+            'attribute_not_exists(agreement_id) OR event_id = :event_id '
+            'OR (version <= :version AND attribute_not_exists(claimed_until))',
+            {':event_id': {'S': event_id},
+             ':version': {'N': str(version)}})
+
+    def _put_item(self, item: dict, condition_expression: str,
+        expression_attribute_values: dict) -> bool:
+        try:
+            self._dynamodb.put_item(
+                TableName=self._table_name,
+                Item=item,
+                ConditionExpression=condition_expression,
+                ExpressionAttributeValues=expression_attribute_values)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            else:
+                raise e
+
+    @staticmethod
+    def _entry(item: dict) -> dict:
+        entry = {'event_id': item['event_id']['S'],
+                 'version': int(item['version']['N'])}
+        if 'claimed_until' in item:
+            entry['claimed_until'] = float(item['claimed_until']['N'])
+        return entry
+
+
+class BatchPlan:
+    """Operations planned for a batch of events
+
+    Every step contains the operations for one data usage agreement and the
+    ids of all events it covers. Events which could not be planned are kept
+    with their error.
+    """
+
+    def __init__(self):
+        self.steps: list[dict] = []
+        self.failures: dict[str, Exception] = {}
+
+    def steps_by_consumer_role(self) -> dict[str, list[dict]]:
+        steps_by_consumer_role = {}
+        for step in self.steps:
+            steps_by_consumer_role.setdefault(step['consumer_role_name'], []).append(step)
+        return steps_by_consumer_role
+
+    def steps_by_consumer_account(self) -> dict[str | None, list[dict]]:
+        """Returns the steps by the account of their consumer role, None for
+        the account of the function, grouped by consumer role within an account
+        """
+
+        steps_by_consumer_account = {}
+        for steps in self.steps_by_consumer_role().values():
+            for step in steps:
+                steps_by_consumer_account.setdefault(
+                    step.get('consumer_account_id'), []).append(step)
+        return steps_by_consumer_account
+
+
 class EventHandler:
-    def __init__(self, dmm_client: DMMClient, aws_iam_manager: AWSIAMManager):
+    _data_usage_agreement_event_types = (
+        'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent',
+        'com.datamesh-manager.events.DataUsageAgreementActivatedEvent')
+    # the maximum timeout of a function, if the end of the invocation is unknown
+    _max_claim_seconds = 900
+    _claim_retry_interval_seconds = 0.1
+
+    def __init__(self, dmm_client: DMMClient, aws_iam_manager: AWSIAMManager,
+        ledger: InMemoryAgreementLedger | DynamoDBAgreementLedger | None = None,
+        metrics: Metrics | None = None,
+        max_account_concurrency: int = 8,
+        outbox: DMMOutbox | None = None,
+        claims_expire_at: float | None = None,
+        claim_wait_seconds: float = 0):
         self._dmm_client = dmm_client
         self._aws_iam_manager = aws_iam_manager
+        self._ledger = ledger
+        self._claims_expire_at = claims_expire_at
+        self._claim_wait_seconds = claim_wait_seconds
+        self._metrics = metrics or shared_metrics()
+        self._max_account_concurrency = max_account_concurrency
+        self._outbox = outbox
+        self._ledger_entries: dict[str, dict | None] = {}
+        self._trace_contexts: dict[str, dict[str, datetime | None]] = {}
 
     def handle(self, event: DMMEvent) -> None:
-        logging.info('Handle event: {}'.format(event))
+        failures = self.handle_batch([event])
+        if len(failures) > 0:
+            raise next(iter(failures.values()))
+
+    def handle_batch(self, events: list[DMMEvent],
+        trace_contexts: dict[str, dict[str, datetime | None]] | None = None) \
+        -> dict[str, Exception]:
+        """Handles all events and returns the errors of the failed ones by event id
+
+        The trace contexts by event id are used to trace the events from
+        their creation in Data Mesh Manager until their access change is applied.
+        """
+
+        self._trace_contexts = trace_contexts or {}
+        self._metrics.put('BatchSize', len(events), 'Count')
+        with self._metrics.timer('BatchLatency'):
+            batch_plan = self.plan(events)
+            failures = {**batch_plan.failures, **self.execute(batch_plan)}
+        self._metrics.count('EventErrors', len(failures))
+        return failures
+
+    def plan(self, events: list[DMMEvent]) -> BatchPlan:
+        """Plans the operations for a batch of events
+
+        Duplicates are dropped and all events of the same data usage agreement
+        are collapsed into the latest one, as only the final state matters.
+        All required documents are fetched at once, those of revocations
+        without the document cache.
+        """
+
+        batch_plan = BatchPlan()
+
+        events_by_data_usage_agreement: dict[str, list[DMMEvent]] = {}
+        for event in self._new_events(events):
+            events_by_data_usage_agreement.setdefault(event['data']['id'], []).append(event)
+        # max keeps the first of equal versions, so prefer later positions
+        latest_events = {data_usage_agreement_id: max(reversed(agreement_events),
+                                                      key=self._version)
+                         for data_usage_agreement_id, agreement_events
+                         in events_by_data_usage_agreement.items()}
+
+        revoked_ids = [data_usage_agreement_id
+                       for data_usage_agreement_id, latest_event in latest_events.items()
+                       if latest_event['type']
+                       == 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent']
+
+        with self._metrics.timer('PrefetchLatency'):
+            self._dmm_client.prefetch(events_by_data_usage_agreement.keys(),
+                                      revoked_ids=revoked_ids)
+
+        for data_usage_agreement_id, agreement_events in events_by_data_usage_agreement.items():
+            latest_event = latest_events[data_usage_agreement_id]
+            event_ids = [event['id'] for event in agreement_events]
+            try:
+                with log_context(event_id=latest_event['id'],
+                                 data_usage_agreement_id=latest_event['data']['id']):
+                    step = self._plan_step(latest_event)
+            except Exception as e:
+                log.exception('Failed to plan event %s', latest_event['id'])
+                batch_plan.failures.update({event_id: e for event_id in event_ids})
+                continue
+            if step is not None:
+                step['event_ids'] = event_ids
+                batch_plan.steps.append(step)
+
+        self._metrics.put('PlannedSteps', len(batch_plan.steps), 'Count')
+        return batch_plan
+
+    def execute(self, batch_plan: BatchPlan) -> dict[str, Exception]:
+        """Executes the planned operations and returns the errors of the failed
+        events by event id
+
+        The steps of different consumer accounts are executed concurrently,
+        the steps of one account one after another.
+        """
+
+        steps_by_consumer_account = list(batch_plan.steps_by_consumer_account().values())
+        if len(steps_by_consumer_account) <= 1:
+            return {failed_event_id: e
+                    for steps in steps_by_consumer_account
+                    for failed_event_id, e in self._execute_steps(steps).items()}
+
+        # keeps the correlation ids of the log lines in the worker threads
+        context = copy_context()
+        failures = {}
+        with ThreadPoolExecutor(max_workers=min(self._max_account_concurrency,
+                                                len(steps_by_consumer_account))) as executor:
+            for account_failures in executor.map(
+                lambda steps: context.copy().run(self._execute_steps, steps),
+                steps_by_consumer_account):
+                failures.update(account_failures)
+        return failures
+
+    def _execute_steps(self, steps: list[dict]) -> dict[str, Exception]:
+        failures = {}
+        for step in steps:
+            try:
+                with log_context(event_id=step['event']['id'],
+                                 data_usage_agreement_id=step['event']['data']['id']):
+                    self._execute_step(step)
+            except Exception as e:
+                log.exception('Failed to handle event %s', step['event']['id'])
+                failures.update({event_id: e for event_id in step['event_ids']})
+        return failures
+
+    def _new_events(self, events: list[DMMEvent]) -> list[DMMEvent]:
+        unique_events = {}
+        for event in events:
+            if event['type'] in self._data_usage_agreement_event_types:
+                unique_events.setdefault(event['id'], event)
+
+        if self._ledger is not None:
+            self._ledger_entries.update(self._ledger.get_many(
+                event['data']['id'] for event in unique_events.values()
+                if event['data']['id'] not in self._ledger_entries))
+
+        return [event for event in unique_events.values() if self._is_new(event)]
+
+    def _plan_step(self, event: DMMEvent) -> dict | None:
+        event_log.info('Plan %s', event['type'])
+        event_log.debug('Event: %s', event)
+        match event['type']:
+            case 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent':
+                return self._deactivated_event(event)
+            case 'com.datamesh-manager.events.DataUsageAgreementActivatedEvent':
+                return self._activated_event(event)
+
+    def _execute_step(self, step: dict) -> None:
+        event = step['event']
+        if not self._claim(event):
+            return
+        # steps of other accounts may be executed at the same time
+        thread_id = threading.get_ident()
+        first_span = len(self._metrics.spans(thread_id))
+        policy_name = None
+        for operation in step['operations']:
+            match operation['operation']:
+                case 'grant_access':
+                    policy_name = self._aws_iam_manager.grant_access(
+                        operation['data_usage_agreement_id'],
+                        operation['consumer_role_name'],
+                        operation['output_port_type'],
+                        operation['output_port_arn'],
+                        operation.get('consumer_account_id'))
+                case 'remove_access':
+                    self._aws_iam_manager.remove_access(
+                        operation['data_usage_agreement_id'],
+                        operation['consumer_role_name'],
+                        operation.get('consumer_account_id'))
+                case 'tag_data_usage_agreement':
+                    value = self._aws_tag_value(operation['active'], policy_name)
+                    if self._outbox is None:
+                        self._dmm_client.patch_data_usage_agreement(
+                            operation['data_usage_agreement_id'], value)
+                    else:
+                        self._outbox.add(operation['data_usage_agreement_id'], value,
+                                         event['id'])
+
+        self._record(event)
         match event['type']:
             case 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent':
-                logging.info('Deactivate')
-                self._deactivated_event(event)
+                event_log.info('Deactivated')
+                self._emit_trace(event, 'revoke', self._metrics.spans(thread_id)[first_span:])
             case 'com.datamesh-manager.events.DataUsageAgreementActivatedEvent':
-                logging.info('Activate')
-                self._activated_event(event)
+                event_log.info('Activated')
+                self._emit_trace(event, 'grant', self._metrics.spans(thread_id)[first_span:])
 
-    def _deactivated_event(self, event: DMMEvent):
+    def _emit_trace(self, event: DMMEvent, access_change: str, spans: list[dict]) -> None:
+        """Records the time from the change in Data Mesh Manager until it is
+        applied, split into its stages, and logs it with the spans of all calls
+        made to apply it
+        """
+
+        applied_at = datetime.now(timezone.utc)
+        time_of_event = event_time(event)
+        trace_context = self._trace_contexts.get(event['id'], {})
+        stages = {
+            'FeedDelay': (time_of_event, trace_context.get('polled_at')),
+            'QueueDwellTime': (trace_context.get('enqueued_at'),
+                               trace_context.get('received_at')),
+            'ProcessingTime': (trace_context.get('received_at'), applied_at),
+            # the total time to permission
+            'AccessChangeLatency': (time_of_event, applied_at)
+        }
+
+        dimensions = {'AccessChange': access_change}
+        self._metrics.count('AccessChanges', 1, dimensions)
+        trace = {'event_id': event['id'],
+                 'data_usage_agreement_id': event['data']['id'],
+                 'access_change': access_change}
+        for name, (start, end) in stages.items():
+            if start is not None and end is not None:
+                duration = (end - start).total_seconds() * 1000
+                self._metrics.put(name, duration, 'Milliseconds', dimensions)
+                trace[name] = round(duration, 3)
+
+        origin = spans[0]['start'] if len(spans) > 0 else 0
+        trace['spans'] = [
+            {**{key: value for key, value in span.items() if key != 'start'},
+             'offset_ms': round((span['start'] - origin) * 1000, 3),
+             'duration_ms': round(span['duration_ms'], 3)}
+            for span in spans]
+        event_log.info('Trace: %s', LazyJson(lambda: trace))
+
+    # ordering and idempotency for queues without ordering guarantees
+
+    def _is_new(self, event: DMMEvent) -> bool:
+        """Returns false for duplicates and events older than the last one applied"""
+
+        if self._ledger is None:
+            return True
+
+        data_usage_agreement_id = event['data']['id']
+        if data_usage_agreement_id not in self._ledger_entries:
+            self._ledger_entries[data_usage_agreement_id] = \
+                self._ledger.get(data_usage_agreement_id)
+        entry = self._ledger_entries[data_usage_agreement_id]
+
+        if entry is None:
+            return True
+        elif entry['event_id'] == event['id']:
+            # a claim without record is left by an attempt which did not finish
+            if 'claimed_until' in entry:
+                return True
+            event_log.info('Skipping duplicate event %s', event['id'])
+            return False
+        elif entry['version'] > self._version(event):
+            event_log.info('Skipping event %s, event %s is newer',
+                           event['id'], entry['event_id'])
+            return False
+        else:
+            return True
+
+    def _claim(self, event: DMMEvent) -> bool:
+        """Claims the data usage agreement of the event before its access is
+        changed, so that no other event of the agreement is applied at the
+        same time, and returns false if a newer event was applied or claimed it
+
+        If an older event holds the claim, e.g. one from the other queue of the
+        priority lane, the event waits for its release up to the configured
+        time, and fails to be retried later otherwise.
+        """
+
+        if self._ledger is None:
+            return True
+
+        data_usage_agreement_id = event['data']['id']
+        version = self._version(event)
+        # the claim expires with the invocation, in case it is stopped
+        claimed_until = self._claims_expire_at or time.time() + self._max_claim_seconds
+        wait_until = time.time() + self._claim_wait_seconds
+        while not self._ledger.claim(data_usage_agreement_id, event['id'], version,
+                                     claimed_until):
+            entry = self._ledger.get(data_usage_agreement_id)
+            self._ledger_entries[data_usage_agreement_id] = entry
+            if entry is not None and entry['version'] > version:
+                event_log.info('Skipping event %s, event %s is newer',
+                               event['id'], entry['event_id'])
+                return False
+            if time.time() + self._claim_retry_interval_seconds > wait_until:
+                raise AgreementClaimedException(
+                    data_usage_agreement_id, 'unknown' if entry is None else entry['event_id'])
+            time.sleep(self._claim_retry_interval_seconds)
+        return True
+
+    def _record(self, event: DMMEvent) -> None:
+        if self._ledger is None:
+            return
+
+        data_usage_agreement_id = event['data']['id']
+        version = self._version(event)
+        if self._ledger.record(data_usage_agreement_id, event['id'], version):
+            self._ledger_entries[data_usage_agreement_id] = {
+                'event_id': event['id'], 'version': version}
+        else:
+            # only possible once the claim expired, a newer event took it over
+            # and may have been applied before this one
+            self._ledger_entries.pop(data_usage_agreement_id, None)
+            entry = self._ledger.get(data_usage_agreement_id)
+            raise AgreementClaimedException(data_usage_agreement_id,
+                                            'unknown' if entry is None else entry['event_id'])
+
+    @staticmethod
+    def _version(event: DMMEvent) -> int:
+        # microseconds since epoch, events without time are the oldest
+        time_of_event = event_time(event)
+        if time_of_event is None:
+            return 0
+        return int(time_of_event.timestamp() * 1_000_000)
+
+    def _deactivated_event(self, event: DMMEvent) -> dict | None:
         data_usage_agreement = self._dmm_client.get_data_usage_agreement(event['data']['id'])
         # aws resource specific code from here
         if data_usage_agreement is not None:
             consumer_dataproduct = self._dmm_client.get_dataproduct(
                 data_usage_agreement['consumer']['dataProductId'])
-            self._aws_deactivated_event(data_usage_agreement, consumer_dataproduct)
+            return self._aws_deactivated_event(event, data_usage_agreement,
+                                               consumer_dataproduct)
 
-            logging.info('Deactivated: {}'.format(event['id']))
-
-    def _activated_event(self, event: DMMEvent):
+    def _activated_event(self, event: DMMEvent) -> dict | None:
         data_usage_agreement_id = event['data']['id']
         data_usage_agreement = self._dmm_client.get_data_usage_agreement(data_usage_agreement_id)
 
         if data_usage_agreement is not None:
-            consumer_dataproduct = self._dmm_client.get_dataproduct(
-                data_usage_agreement['consumer']['dataProductId'])
-            provider_dataproduct = self._dmm_client.get_dataproduct(
-                data_usage_agreement['provider']['dataProductId'])
-
-            self._aws_activated_event(data_usage_agreement,
-                                      consumer_dataproduct,
-                                      provider_dataproduct)
-
-            logging.info('Activated: {}'.format(event['id']))
+            # consumer and provider are independent, so fetch them concurrently
+            consumer_dataproduct_id = data_usage_agreement['consumer']['dataProductId']
+            provider_dataproduct_id = data_usage_agreement['provider']['dataProductId']
+            dataproducts = self._dmm_client.get_dataproducts(
+                [consumer_dataproduct_id, provider_dataproduct_id])
+            consumer_dataproduct = dataproducts[consumer_dataproduct_id]
+            provider_dataproduct = dataproducts[provider_dataproduct_id]
+
+            return self._aws_activated_event(event,
+                                             data_usage_agreement,
+                                             consumer_dataproduct,
+                                             provider_dataproduct)
 
     # aws resource specific code from here
 
     def _aws_deactivated_event(self,
+        event: DMMEvent,
         data_usage_agreement: DataUsageAgreement,
-        consumer_dataproduct: DataProduct):
+        consumer_dataproduct: DataProduct) -> dict:
 
         data_usage_agreement_id = data_usage_agreement['info']['id']
         consumer_role_name = self._aws_consumer_role_name(consumer_dataproduct)
-        self._aws_iam_manager.remove_access(data_usage_agreement_id, consumer_role_name)
+        consumer_account_id = self._aws_consumer_account_id(consumer_dataproduct)
 
-        self._dmm_client.patch_data_usage_agreement(data_usage_agreement_id, {
-            'tags': ['aws-integration', 'aws-integration-inactive']
-        })
+        return {
+            'event': event,
+            'consumer_role_name': consumer_role_name,
+            'consumer_account_id': consumer_account_id,
+            'operations': [
+                {'operation': 'remove_access',
+                 'data_usage_agreement_id': data_usage_agreement_id,
+                 'consumer_role_name': consumer_role_name,
+                 'consumer_account_id': consumer_account_id},
+                {'operation': 'tag_data_usage_agreement',
+                 'data_usage_agreement_id': data_usage_agreement_id,
+                 'active': False}
+            ]
+        }
 
     def _aws_activated_event(self,
+        event: DMMEvent,
         data_usage_agreement: DataUsageAgreement,
         consumer_dataproduct: DataProduct,
-        provider_dataproduct: DataProduct):
-
-        data_usage_agreement_id = data_usage_agreement['info']['id']
-
-        # grant access to aws_resource to consumer
-        policy_name = self._aws_grant_access(data_usage_agreement,
-                                             consumer_dataproduct,
-                                             provider_dataproduct)
-
-        self._dmm_client.patch_data_usage_agreement(data_usage_agreement_id, {
-            'custom': {'aws-policy-name': policy_name},
-            'tags': ['aws-integration', 'aws-integration-active']
-        })
-
-    def _aws_grant_access(self,
-        data_usage_agreement: DataUsageAgreement,
-        consumer_dataproduct: DataProduct,
-        provider_dataproduct: DataProduct) -> str:
+        provider_dataproduct: DataProduct) -> dict:
 
         # implementation for s3 bucket
         data_usage_agreement_id = data_usage_agreement['info']['id']
         consumer_role_name = self._aws_consumer_role_name(consumer_dataproduct)
+        consumer_account_id = self._aws_consumer_account_id(consumer_dataproduct)
         output_port = self._aws_s3_bucket_output_port(
             provider_dataproduct,
             data_usage_agreement['provider']['outputPortId'])
 
-        return self._aws_iam_manager.grant_access(
-            data_usage_agreement_id,
-            consumer_role_name,
-            self._output_port_type(output_port),
-            self._output_port_arn(output_port))
+        # grant access to aws_resource to consumer
+        return {
+            'event': event,
+            'consumer_role_name': consumer_role_name,
+            'consumer_account_id': consumer_account_id,
+            'operations': [
+                {'operation': 'grant_access',
+                 'data_usage_agreement_id': data_usage_agreement_id,
+                 'consumer_role_name': consumer_role_name,
+                 'consumer_account_id': consumer_account_id,
+                 'output_port_type': self._output_port_type(output_port),
+                 'output_port_arn': self._output_port_arn(output_port)},
+                {'operation': 'tag_data_usage_agreement',
+                 'data_usage_agreement_id': data_usage_agreement_id,
+                 'active': True}
+            ]
+        }
+
+    @staticmethod
+    def _aws_tag_value(active: bool, policy_name: str | None) -> dict:
+        if active:
+            return {
+                'custom': {'aws-policy-name': policy_name},
+                'tags': ['aws-integration', 'aws-integration-active']
+            }
+        else:
+            return {
+                'tags': ['aws-integration', 'aws-integration-inactive']
+            }
 
     @staticmethod
     def _output_port_type(output_port: dict) -> str:
@@ -386,6 +1740,15 @@ class EventHandler:
 
         return consumer_role_name
 
+    @staticmethod
+    def _aws_consumer_account_id(consumer_dataproduct: DataProduct) -> str | None:
+        # optional, the role is in the account of the function without it
+        consumer_account_id = consumer_dataproduct['custom'].get('aws-account-id')
+        if consumer_account_id is not None \
+            and re.fullmatch(r'\d{12}', str(consumer_account_id)) is None:
+            raise ValueError('Invalid aws-account-id: {}'.format(consumer_account_id))
+        return None if consumer_account_id is None else str(consumer_account_id)
+
     @staticmethod
     def _aws_s3_bucket_output_port(
         provider_dataproduct: DataProduct,
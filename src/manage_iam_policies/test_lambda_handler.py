@@ -1,13 +1,34 @@
 import json
+import os
+import sys
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from unittest import TestCase
-from unittest.mock import patch, sentinel, Mock
+from unittest.mock import patch, sentinel, Mock, ANY
 
 import boto3
+from botocore.exceptions import ClientError
 from botocore.stub import Stubber
 
-from lambda_handler import Secrets, DMMClient, AWSIAMManager, EventHandler, \
-    UnsupportedOutputPortException, RequiredCustomFieldNotSet
+# the shared module is next to the handler in the bundle, in src/common otherwise
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+
+from call_accounting import CallAccounting  # noqa: E402
+from dmm_common import HttpSession, aws_client, shared_http_session, \
+    shared_secret_cache, CircuitBreaker, CircuitOpenException, Metrics, \
+    InMemoryMetricsSink, HttpError, Feed  # noqa: E402
+from lambda_handler import DMMClient, AWSIAMManager, EventHandler, \
+    UnsupportedOutputPortException, RequiredCustomFieldNotSet, \
+    reset_warm_container, FailedRecordHandler, handle_records, BatchPlan, \
+    InMemoryAgreementLedger, DynamoDBAgreementLedger, AgreementClaimedException, \
+    trace_context, Arn, \
+    PolicyCompiler, shared_policy_compiler, AccountClients, shared_account_clients, \
+    AccountNotManagedException, records_by_feed, UnknownFeedException, \
+    DocumentCache, shared_document_cache, invalidated_documents, DMMOutbox, \
+    drain_outbox, is_outbox_record  # noqa: E402
 
 
 class TestDMMClient(TestCase):
@@ -15,6 +36,19 @@ class TestDMMClient(TestCase):
     _api_key = 'supersecret'
     _data_usage_agreement_id = '123'
     _dataproduct_id = '987'
+    _dataproduct = {
+        'dataProductSpecification': '0.0.1',
+        'info': {'id': '987', 'name': 'Provider', 'description': 'A large data product'},
+        'owner': {'teamId': 'team'},
+        'custom': {'aws-role-name': 'role'},
+        'outputPorts': [{'id': 'port', 'name': 'Port', 'description': 'A port',
+                         'custom': {'output-port-type': 's3_bucket'},
+                         'model': {'fields': [{'name': 'column'}] * 100}}],
+        'links': {'documentation': 'https://docs'}}
+    _selected_dataproduct = {
+        'info': {'id': '987'},
+        'custom': {'aws-role-name': 'role'},
+        'outputPorts': [{'id': 'port', 'custom': {'output-port-type': 's3_bucket'}}]}
 
     def setUp(self) -> None:
         self._client = DMMClient(self._base_url, self._api_key)
@@ -27,6 +61,10 @@ class TestDMMClient(TestCase):
         def json(self) -> str:
             return self._body
 
+        @property
+        def body(self) -> bytes:
+            return json.dumps(self._body).encode('utf-8')
+
         def raise_for_status(self) -> None:
             if self.status_code >= 400:
                 raise Exception()
@@ -36,10 +74,14 @@ class TestDMMClient(TestCase):
     @staticmethod
     def mock_get__api_key(**kwargs) -> MockResponse:
         if kwargs['headers']['x-api-key'] == TestDMMClient._api_key:
-            return TestDMMClient.MockResponse(sentinel.expected, 200)
+            return TestDMMClient.MockResponse(TestDMMClient._document(kwargs['url']), 200)
         else:
             return TestDMMClient.MockResponse(sentinel.something, 500)
 
+    @staticmethod
+    def _document(url: str):
+        return TestDMMClient._dataproduct if '/dataproducts/' in url else sentinel.expected
+
     # get_data_usage_agreement
 
     @staticmethod
@@ -53,7 +95,7 @@ class TestDMMClient(TestCase):
         else:
             return TestDMMClient.MockResponse(None, 200)
 
-    @patch('requests.get', Mock(side_effect=mock_get_data_usage_agreement))
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_data_usage_agreement))
     def test_get_data_usage_agreement(self) -> None:
         self.assertEqual(sentinel.expected,
                          self._client.get_data_usage_agreement(self._data_usage_agreement_id))
@@ -62,7 +104,7 @@ class TestDMMClient(TestCase):
     def mock_get_data_usage_agreement_not_found(**kwargs) -> MockResponse:
         return TestDMMClient.MockResponse(sentinel.something, 404)
 
-    @patch('requests.get', Mock(side_effect=mock_get_data_usage_agreement_not_found))
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_data_usage_agreement_not_found))
     def test_get_data_usage_agreement_not_found(self) -> None:
         self.assertEqual(None,
                          self._client.get_data_usage_agreement(self._data_usage_agreement_id))
@@ -71,12 +113,12 @@ class TestDMMClient(TestCase):
     def mock_get_data_usage_agreement_other_error() -> MockResponse:
         return TestDMMClient.MockResponse(sentinel.something, 500)
 
-    @patch('requests.get', Mock(side_effect=mock_get_data_usage_agreement_other_error))
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_data_usage_agreement_other_error))
     def test_get_data_usage_agreement_other_error(self) -> None:
         with self.assertRaises(Exception):
             self._client.get_data_usage_agreement(self._data_usage_agreement_id)
 
-    @patch('requests.get', Mock(side_effect=mock_get__api_key))
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get__api_key))
     def test_get_data_usage_agreement_api_key(self) -> None:
         self.assertEqual(sentinel.expected,
                          self._client.get_data_usage_agreement(self._data_usage_agreement_id))
@@ -108,12 +150,22 @@ class TestDMMClient(TestCase):
 
         return TestDMMClient.MockResponse(None, 200)
 
-    @patch('requests.get', Mock(side_effect=mock_get_data_usage_agreement__patch))
-    @patch('requests.put', Mock(side_effect=mock_put_data_usage_agreement__patch))
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_data_usage_agreement__patch))
+    @patch('lambda_handler.HttpSession.put', Mock(side_effect=mock_put_data_usage_agreement__patch))
     def test_patch_data_usage_agreement(self) -> None:
         value = {'key2': 'value2_updated', 'key3': 'value3'}
         self._client.patch_data_usage_agreement(self._data_usage_agreement_id, value)
 
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_data_usage_agreement__patch))
+    @patch('lambda_handler.HttpSession.put', Mock(side_effect=mock_put_data_usage_agreement__patch))
+    def test_patch_data_usage_agreement__read_agreement_is_not_read_again(self) -> None:
+        self._client.get_data_usage_agreement(self._data_usage_agreement_id)
+
+        value = {'key2': 'value2_updated', 'key3': 'value3'}
+        self._client.patch_data_usage_agreement(self._data_usage_agreement_id, value)
+
+        self.assertEqual(1, HttpSession.get.call_count)
+
     # get_dataproduct
 
     @staticmethod
@@ -123,20 +175,20 @@ class TestDMMClient(TestCase):
             id=TestDMMClient._dataproduct_id)
 
         if kwargs['url'] == expected_url:
-            return TestDMMClient.MockResponse(sentinel.expected, 200)
+            return TestDMMClient.MockResponse(TestDMMClient._dataproduct, 200)
         else:
-            return TestDMMClient.MockResponse(None, 200)
+            return TestDMMClient.MockResponse({}, 200)
 
-    @patch('requests.get', Mock(side_effect=mock_get_dataproduct))
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_dataproduct))
     def test_get_dataproduct(self) -> None:
-        self.assertEqual(sentinel.expected,
+        self.assertEqual(self._selected_dataproduct,
                          self._client.get_dataproduct(self._dataproduct_id))
 
     @staticmethod
     def mock_get_dataproduct_not_found(**kwargs) -> MockResponse:
         return TestDMMClient.MockResponse(sentinel.something, 404)
 
-    @patch('requests.get', Mock(side_effect=mock_get_dataproduct_not_found))
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_dataproduct_not_found))
     def test_get_dataproduct_not_found(self) -> None:
         self.assertEqual(None,
                          self._client.get_dataproduct(self._dataproduct_id))
@@ -145,43 +197,293 @@ class TestDMMClient(TestCase):
     def mock_get_dataproduct_other_error(**kwargs) -> MockResponse:
         return TestDMMClient.MockResponse(sentinel.something, 500)
 
-    @patch('requests.get', Mock(side_effect=mock_get_dataproduct_other_error))
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_dataproduct_other_error))
     def test_get_dataproduct_other_error(self) -> None:
         with self.assertRaises(Exception):
             self._client.get_dataproduct(self._dataproduct_id)
 
-    @patch('requests.get', Mock(side_effect=mock_get__api_key))
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get__api_key))
     def test_get_dataproduct_api_key(self) -> None:
-        self.assertEqual(sentinel.expected,
+        self.assertEqual(self._selected_dataproduct,
                          self._client.get_dataproduct(self._dataproduct_id))
 
+    # rotated api key
+
+    @staticmethod
+    def mock_get__rotated_api_key(**kwargs) -> MockResponse:
+        if kwargs['headers']['x-api-key'] == 'rotated':
+            return TestDMMClient.MockResponse(TestDMMClient._document(kwargs['url']), 200)
+        else:
+            return TestDMMClient.MockResponse(None, 401)
+
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get__rotated_api_key))
+    def test_get_dataproduct__rotated_api_key(self) -> None:
+        refresh_api_key = Mock(return_value='rotated')
+        client = DMMClient(self._base_url, self._api_key,
+                           refresh_api_key=refresh_api_key)
+
+        self.assertEqual(self._selected_dataproduct, client.get_dataproduct(self._dataproduct_id))
+        self.assertEqual(sentinel.expected, client.get_data_usage_agreement('other'))
+        refresh_api_key.assert_called_once()
 
-class TestSecrets(TestCase):
-    _secret_name = 'configured_name'
-    _secret_value = 'hi!_i_am_secret'
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get__rotated_api_key))
+    def test_get_dataproduct__api_key_not_rotated(self) -> None:
+        client = DMMClient(self._base_url, self._api_key,
+                           refresh_api_key=lambda: self._api_key)
+
+        with self.assertRaises(Exception):
+            client.get_dataproduct(self._dataproduct_id)
+        self.assertEqual(1, HttpSession.get.call_count)
+
+    # circuit breaker
+
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_dataproduct_other_error))
+    def test_get_dataproduct__circuit_open(self) -> None:
+        client = DMMClient(self._base_url, self._api_key,
+                           circuit_breaker=CircuitBreaker('dmm', failure_threshold=1))
+
+        with self.assertRaises(Exception):
+            client.get_dataproduct(self._dataproduct_id)
+        with self.assertRaises(CircuitOpenException):
+            client.get_dataproduct('other')
+        self.assertEqual(1, HttpSession.get.call_count)
+
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_dataproduct_not_found))
+    def test_get_dataproduct__not_found_keeps_circuit_closed(self) -> None:
+        breaker = CircuitBreaker('dmm', failure_threshold=1)
+        client = DMMClient(self._base_url, self._api_key, circuit_breaker=breaker)
+
+        client.get_dataproduct(self._dataproduct_id)
+
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+
+    # concurrent reads
+
+    @staticmethod
+    def mock_get_documents(**kwargs) -> MockResponse:
+        documents = {
+            '{}/api/datausageagreements/a1'.format(TestDMMClient._base_url): {
+                'consumer': {'dataProductId': 'c1'},
+                'provider': {'dataProductId': 'p1'}},
+            '{}/api/datausageagreements/a2'.format(TestDMMClient._base_url): {
+                'consumer': {'dataProductId': 'c1'},
+                'provider': {'dataProductId': 'p2'}},
+            '{}/api/dataproducts/c1'.format(TestDMMClient._base_url): {'info': {'id': 'c1'}},
+            '{}/api/dataproducts/p1'.format(TestDMMClient._base_url): {'info': {'id': 'p1'}},
+            '{}/api/dataproducts/c2'.format(TestDMMClient._base_url): {
+                'custom': {}, 'tags': ['consumer']},
+            '{}/api/dataproducts/p3'.format(TestDMMClient._base_url): {
+                'info': {'id': 'p3', 'name': 'Provider'},
+                'outputPorts': [{'id': 'port', 'server': {'bucket': 'bucket'}}]},
+        }
+        if kwargs['url'] in documents:
+            return TestDMMClient.MockResponse(documents[kwargs['url']], 200)
+        else:
+            return TestDMMClient.MockResponse(None, 404)
+
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_documents))
+    def test_get_dataproducts(self) -> None:
+        self.assertEqual({'c1': {'info': {'id': 'c1'}}, 'p1': {'info': {'id': 'p1'}}, 'p2': None},
+                         self._client.get_dataproducts(['c1', 'p1', 'p2', 'c1']))
+
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_documents))
+    def test_get_dataproduct__selected_fields_only(self) -> None:
+        self.assertEqual({'custom': {}}, self._client.get_dataproduct('c2'))
+        self.assertEqual({'info': {'id': 'p3'}, 'outputPorts': [{'id': 'port'}]},
+                         self._client.get_dataproduct('p3'))
+
+    def test_selected_fields(self) -> None:
+        body = b''' { "links" : {"a": "}]"}, "info": {"id": "p", "name": "{"},
+            "outputPorts" : [ {"id": "a", "model": [1, 2]} ,{"custom": {"b": "c"}} ],
+            "custom": {"aws-role-name": "role"}, "description": null } '''
+
+        self.assertEqual({'info': {'id': 'p'},
+                          'outputPorts': [{'id': 'a'}, {'custom': {'b': 'c'}}],
+                          'custom': {'aws-role-name': 'role'}},
+                         DMMClient._selected_fields(body))
+        self.assertEqual({}, DMMClient._selected_fields(b'{}'))
+        self.assertEqual({'outputPorts': []}, DMMClient._selected_fields(b'{"outputPorts": []}'))
+        self.assertEqual({}, DMMClient._selected_fields(b'{"outputPorts": null}'))
+        self.assertEqual(self._selected_dataproduct, DMMClient._selected_fields(
+            json.dumps(self._dataproduct, indent=2).encode('utf-8')))
+
+    def test_selected_fields__invalid(self) -> None:
+        for body in [b'', b'[]', b'{"info": {}', b'{"a": 1 "b": 2}', b'{"outputPorts": [{} {}]}']:
+            with self.assertRaises(ValueError):
+                DMMClient._selected_fields(body)
+
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_dataproduct))
+    def test_get_dataproduct__cached(self) -> None:
+        self._client.get_dataproduct(self._dataproduct_id)
+        self._client.get_dataproduct(self._dataproduct_id)
+
+        self.assertEqual(1, HttpSession.get.call_count)
+
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_dataproduct))
+    def test_get_dataproduct__invalidated(self) -> None:
+        self._client.get_dataproduct(self._dataproduct_id)
+        self._client.invalidate(['dataproducts/{}'.format(self._dataproduct_id),
+                                 'datausageagreements/other'])
+        self._client.get_dataproduct(self._dataproduct_id)
+
+        self.assertEqual(2, HttpSession.get.call_count)
+
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_dataproduct))
+    def test_get_dataproduct__shared_document_cache(self) -> None:
+        document_cache = DocumentCache()
+
+        DMMClient(self._base_url, self._api_key,
+                  document_cache=document_cache).get_dataproduct(self._dataproduct_id)
+        DMMClient(self._base_url, self._api_key,
+                  document_cache=document_cache).get_dataproduct(self._dataproduct_id)
+
+        self.assertEqual(1, HttpSession.get.call_count)
+
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_documents))
+    def test_prefetch(self) -> None:
+
+        self._client.prefetch(['a1', 'a2', 'a1', 'a3'])
+        self.assertEqual(6, HttpSession.get.call_count)
+
+        self.assertEqual({'info': {'id': 'p1'}}, self._client.get_dataproduct('p1'))
+        self.assertIsNone(self._client.get_dataproduct('p2'))
+        self.assertIsNone(self._client.get_data_usage_agreement('a3'))
+        # documents that were not found are read again
+        self.assertEqual(8, HttpSession.get.call_count)
+
+    @staticmethod
+    def mock_get_documents_failing(**kwargs) -> MockResponse:
+        return TestDMMClient.MockResponse(None, 500)
+
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_documents_failing))
+    def test_prefetch__failure_is_not_cached(self) -> None:
+
+        self._client.prefetch(['a1'])
+        with self.assertRaises(Exception):
+            self._client.get_data_usage_agreement('a1')
+        self.assertEqual(2, HttpSession.get.call_count)
+
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_documents_failing))
+    def test_metrics(self) -> None:
+        sink = InMemoryMetricsSink()
+        metrics = Metrics(sink=sink)
+        client = DMMClient(self._base_url, self._api_key, metrics=metrics)
+
+        with self.assertRaises(Exception):
+            client.get_dataproduct(self._dataproduct_id)
+        metrics.flush()
+
+        self.assertEqual(1, len(sink.values('DMMCallLatency', {'Method': 'GetDataProduct'})))
+        self.assertEqual([1], sink.values('DMMCallErrors', {'Method': 'GetDataProduct'}))
+
+
+class TestDocumentCache(TestCase):
 
     def setUp(self) -> None:
-        secretsmanager = boto3.client('secretsmanager')
+        self._sink = InMemoryMetricsSink()
+        self._metrics = Metrics(sink=self._sink)
+        self._now = 0.0
+        self._fetch = Mock(side_effect=lambda: {'fetched': self._fetch.call_count})
+
+    def _cache(self, **kwargs) -> DocumentCache:
+        return DocumentCache(clock=lambda: self._now, metrics=self._metrics, **kwargs)
+
+    def test_get__kept_until_invalidated(self) -> None:
+        cache = self._cache()
+
+        cache.get('url', self._fetch)
+        self._now = 1e6
+        self.assertEqual({'fetched': 1}, cache.get('url', self._fetch))
+        cache.invalidate('url')
+        cache.invalidate('other')
+        self.assertEqual({'fetched': 2}, cache.get('url', self._fetch))
+
+        self._metrics.flush()
+        self.assertEqual([1], self._sink.values('DocumentCacheHits'))
+        self.assertEqual([2], self._sink.values('DocumentCacheMisses'))
+        self.assertEqual([1], self._sink.values('DocumentCacheInvalidations'))
+
+    def test_get__not_found_is_not_kept(self) -> None:
+        cache = self._cache()
+        fetch = Mock(return_value=None)
+
+        self.assertIsNone(cache.get('url', fetch))
+        self.assertEqual({'fetched': 1}, cache.get('url', self._fetch))
+
+        self.assertEqual(1, fetch.call_count)
+
+    def test_get__ttl(self) -> None:
+        cache = self._cache(ttl_seconds=60)
+
+        cache.get('url', self._fetch)
+        self._now = 59
+        cache.get('url', self._fetch)
+        self._now = 60
+        cache.get('url', self._fetch)
+
+        self.assertEqual(2, self._fetch.call_count)
+
+    def test_put__drops_least_recently_read(self) -> None:
+        cache = self._cache(max_size=2)
+        cache.put('a', {'id': 'a'})
+        cache.put('b', {'id': 'b'})
+
+        cache.get('a', self._fetch)
+        cache.put('c', {'id': 'c'})
+
+        self.assertEqual({'id': 'a'}, cache.get('a', self._fetch))
+        self.assertEqual({'id': 'c'}, cache.get('c', self._fetch))
+        self.assertEqual({'fetched': 1}, cache.get('b', self._fetch))
 
-        self._secretsmanager_stubber = Stubber(secretsmanager)
-        self._secrets = Secrets(secretsmanager)
+
+class TestWarmContainer(TestCase):
 
     def tearDown(self) -> None:
-        self._secretsmanager_stubber.deactivate()
+        reset_warm_container()
 
-    def test_get_secret(self) -> None:
-        expected_params = {
-            'SecretId': self._secret_name
-        }
-        response = {
-            'SecretString': self._secret_value
-        }
-        self._secretsmanager_stubber.add_response(
-            'get_secret_value', response, expected_params)
-        self._secretsmanager_stubber.activate()
+    def test_reset_warm_container(self) -> None:
+        client = aws_client('sqs')
+        session = shared_http_session()
+        secret_cache = shared_secret_cache()
+
+        reset_warm_container()
+
+        self.assertIsNot(client, aws_client('sqs'))
+        self.assertIsNot(session, shared_http_session())
+        self.assertIsNot(secret_cache, shared_secret_cache())
+
+    def test_shared_policy_compiler__reused(self) -> None:
+        self.assertIs(shared_policy_compiler(), shared_policy_compiler())
+
+    def test_shared_document_cache__per_feed(self) -> None:
+        feed_a = Feed('org-a', 'https://dmm', 'a/api_key')
+        feed_b = Feed('org-b', 'https://dmm', 'b/api_key')
+
+        self.assertIs(shared_document_cache(feed_a), shared_document_cache(feed_a))
+        self.assertIsNot(shared_document_cache(feed_a), shared_document_cache(feed_b))
+        cache = shared_document_cache(feed_a)
+        reset_warm_container()
+        self.assertIsNot(cache, shared_document_cache(feed_a))
+
+    @patch.dict('os.environ', {'dmm_document_cache_size': '0'})
+    def test_shared_document_cache__disabled(self) -> None:
+        self.assertIsNone(shared_document_cache(Feed(None, 'https://dmm', 'api_key')))
 
-        self.assertEqual(self._secret_value,
-                         self._secrets.get_secret(self._secret_name))
+    def test_shared_document_cache__ttl(self) -> None:
+        feed = Feed(None, 'https://dmm', 'api_key')
+
+        self.assertEqual(300, shared_document_cache(feed)._ttl_seconds)
+        reset_warm_container()
+        for ttl_seconds in ['-1', '0', '3601']:
+            with patch.dict('os.environ', {'dmm_document_cache_ttl_seconds': ttl_seconds}):
+                with self.assertRaises(ValueError):
+                    shared_document_cache(feed)
+
+    @patch.dict('os.environ', {'target_account_role_name': 'dmm-integration',
+                               'aws_partition': 'aws-us-gov'})
+    def test_shared_account_clients__partition(self) -> None:
+        self.assertEqual('arn:aws-us-gov:iam::111111111111:role/dmm-integration',
+                         shared_account_clients().role_arn('111111111111'))
 
 
 class TestAWSIAMManager(TestCase):
@@ -237,6 +539,47 @@ class TestAWSIAMManager(TestCase):
         self._iam_manager.remove_access(self._data_usage_agreement_id,
                                         self._consumer_role_name)
 
+    def test_remove_access__metrics(self) -> None:
+        sink = InMemoryMetricsSink()
+        metrics = Metrics(sink=sink)
+        iam = boto3.client('iam')
+        iam_stubber = Stubber(iam)
+        iam_stubber.add_client_error('delete_role_policy', service_error_code='NoSuchEntity')
+        iam_stubber.add_client_error('delete_role_policy', service_error_code='Throttling')
+        iam_stubber.activate()
+        iam_manager = AWSIAMManager(iam, metrics)
+
+        iam_manager.remove_access(self._data_usage_agreement_id, self._consumer_role_name)
+        with self.assertRaises(ClientError):
+            iam_manager.remove_access(self._data_usage_agreement_id, self._consumer_role_name)
+        metrics.flush()
+
+        self.assertEqual(2, len(sink.values('IAMCallLatency', {'Method': 'DeleteRolePolicy'})))
+        self.assertEqual([1], sink.values('IAMCallErrors', {'Method': 'DeleteRolePolicy'}))
+
+    def test_grant_access__other_account(self) -> None:
+        local_iam = Mock()
+        account_iam = Mock()
+        account_clients = Mock(own_account_id='000000000000')
+        account_clients.iam.return_value = account_iam
+        iam_manager = AWSIAMManager(local_iam, account_clients=account_clients)
+
+        iam_manager.grant_access(self._data_usage_agreement_id, self._consumer_role_name,
+                                 's3_bucket', [self._s3_output_port_bucket_arn], '111111111111')
+        iam_manager.remove_access(self._data_usage_agreement_id, self._consumer_role_name,
+                                  '000000000000')
+
+        account_clients.iam.assert_called_once_with('111111111111')
+        account_iam.put_role_policy.assert_called_once()
+        local_iam.delete_role_policy.assert_called_once()
+        local_iam.put_role_policy.assert_not_called()
+
+    def test_grant_access__other_account_not_managed(self) -> None:
+        with self.assertRaises(AccountNotManagedException):
+            self._iam_manager.grant_access(self._data_usage_agreement_id,
+                                           self._consumer_role_name, 's3_bucket',
+                                           [self._s3_output_port_bucket_arn], '111111111111')
+
     def test_grant_access_unsupported(self) -> None:
         with self.assertRaises(UnsupportedOutputPortException):
             self._iam_manager.grant_access(self._data_usage_agreement_id,
@@ -268,7 +611,7 @@ class TestAWSIAMManager(TestCase):
                             ]
                         }
                     ]
-                })
+                }, separators=(',', ':'))
             }
         )
 
@@ -334,7 +677,7 @@ class TestAWSIAMManager(TestCase):
                             ]
                         }
                     ]
-                })
+                }, separators=(',', ':'))
             }
         )
 
@@ -356,6 +699,631 @@ class TestAWSIAMManager(TestCase):
         self._iam_stubber.assert_no_pending_responses()
 
 
+class TestAccountClients(TestCase):
+    _expiration = datetime(2024, 1, 1, 13, tzinfo=timezone.utc)
+
+    def setUp(self) -> None:
+        self._now = self._expiration.timestamp() - 3600
+        self._sts = Mock()
+        self._sts.assume_role.side_effect = lambda **kwargs: {'Credentials': {
+            'AccessKeyId': kwargs['RoleArn'], 'SecretAccessKey': 'secret',
+            'SessionToken': 'token', 'Expiration': self._expiration}}
+        self._account_clients = AccountClients(
+            self._sts, 'dmm-integration', client_factory=lambda c: c['AccessKeyId'],
+            metrics=Metrics(sink=InMemoryMetricsSink()), clock=lambda: self._now)
+
+    def test_iam__assumes_role_in_account(self) -> None:
+        client = self._account_clients.iam('111111111111')
+
+        self.assertEqual('arn:aws:iam::111111111111:role/dmm-integration', client)
+        self._sts.assume_role.assert_called_once_with(
+            RoleArn='arn:aws:iam::111111111111:role/dmm-integration',
+            RoleSessionName='dmm-integration', DurationSeconds=3600)
+
+    def test_iam__cached_per_account(self) -> None:
+        self._account_clients.iam('111111111111')
+        self._account_clients.iam('111111111111')
+        self._account_clients.iam('222222222222')
+
+        self.assertEqual(2, self._sts.assume_role.call_count)
+
+    def test_iam__assumed_again_before_expiration(self) -> None:
+        self._account_clients.iam('111111111111')
+        self._now = self._expiration.timestamp() - 301
+        self._account_clients.iam('111111111111')
+        self.assertEqual(1, self._sts.assume_role.call_count)
+
+        self._now = self._expiration.timestamp() - 300
+        self._account_clients.iam('111111111111')
+        self.assertEqual(2, self._sts.assume_role.call_count)
+
+    def test_iam__clients_created_one_at_a_time(self) -> None:
+        creating = []
+        overlapping = []
+
+        def client_factory(credentials: dict) -> str:
+            creating.append(credentials['AccessKeyId'])
+            overlapping.append(len(creating) > 1)
+            time.sleep(0.01)
+            creating.remove(credentials['AccessKeyId'])
+            return credentials['AccessKeyId']
+
+        account_clients = AccountClients(self._sts, 'dmm-integration',
+                                         client_factory=client_factory,
+                                         metrics=Metrics(sink=InMemoryMetricsSink()),
+                                         clock=lambda: self._now)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(account_clients.iam, [str(i) * 12 for i in range(1, 9)]))
+
+        self.assertEqual([False] * 8, overlapping)
+
+    def test_iam__client_with_credentials(self) -> None:
+        client = AccountClients._iam_client({'AccessKeyId': 'key', 'SecretAccessKey': 'secret',
+                                             'SessionToken': 'token'})
+
+        self.assertEqual('iam', client.meta.service_model.service_name)
+        self.assertEqual('key', client._request_signer._credentials.access_key)
+
+    def test_iam__external_id(self) -> None:
+        account_clients = AccountClients(self._sts, 'dmm-integration', external_id='external',
+                                         client_factory=Mock(), clock=lambda: self._now)
+
+        account_clients.iam('111111111111')
+
+        self.assertEqual('external', self._sts.assume_role.call_args.kwargs['ExternalId'])
+
+
+class TestArn(TestCase):
+
+    def test_parse(self) -> None:
+        self.assertEqual(
+            Arn('arn:aws:glue:eu-central-1:123:table/db/t', 'aws', 'glue', 'table/db/t'),
+            Arn.parse('arn:aws:glue:eu-central-1:123:table/db/t'))
+
+    def test_parse__other_partitions(self) -> None:
+        self.assertEqual('s3', Arn.parse('arn:aws-cn:s3:::bucket').service)
+        self.assertEqual('aws-us-gov', Arn.parse('arn:aws-us-gov:s3:::bucket').partition)
+
+    def test_parse__invalid(self) -> None:
+        self.assertIsNone(Arn.parse('aws:arn:iam:one:two:three'))
+        self.assertIsNone(Arn.parse('arn:aws'))
+
+
+class TestPolicyCompiler(TestCase):
+
+    def setUp(self) -> None:
+        self._policy_compiler = PolicyCompiler(max_size=2)
+
+    def test_compile__minified(self) -> None:
+        policy_document = self._policy_compiler.compile('s3_bucket', ['arn:aws:s3:::bucket'])
+
+        self.assertNotIn(' ', policy_document)
+        self.assertEqual(['arn:aws:s3:::bucket', 'arn:aws:s3:::bucket/*'],
+                         json.loads(policy_document)['Statement'][0]['Resource'])
+
+    def test_compile__other_partition(self) -> None:
+        policy_document = json.loads(self._policy_compiler.compile(
+            'glue_table', ['arn:aws-cn:s3:::bucket/folder',
+                           'arn:aws-cn:glue:cn-north-1:123:table/db/t',
+                           'arn:aws-cn:athena:cn-north-1:123:workgroup/primary']))
+
+        self.assertEqual([['arn:aws-cn:s3:::bucket'], ['arn:aws-cn:s3:::bucket/folder/*'],
+                          ['arn:aws-cn:glue:cn-north-1:123:table/db/t'],
+                          ['arn:aws-cn:athena:cn-north-1:123:workgroup/primary']],
+                         [statement['Resource'] for statement in policy_document['Statement']])
+
+    def test_compile__memoized(self) -> None:
+        arns = ['arn:aws:s3:::bucket']
+        policy_document = self._policy_compiler.compile('s3_bucket', arns)
+
+        with patch.object(PolicyCompiler, '_policy_statements') as policy_statements:
+            self.assertIs(policy_document, self._policy_compiler.compile('s3_bucket', list(arns)))
+        policy_statements.assert_not_called()
+
+    def test_compile__least_recently_used_evicted(self) -> None:
+        first = self._policy_compiler.compile('s3_bucket', ['arn:aws:s3:::one'])
+        self._policy_compiler.compile('s3_bucket', ['arn:aws:s3:::two'])
+        self._policy_compiler.compile('s3_bucket', ['arn:aws:s3:::three'])
+
+        self.assertIsNot(first, self._policy_compiler.compile('s3_bucket', ['arn:aws:s3:::one']))
+
+    def test_compile__compacted(self) -> None:
+        policy_document = json.loads(self._policy_compiler.compile(
+            'glue_table', ['arn:aws:s3:::bucket/folder',
+                           'arn:aws:s3:::bucket/folder/table',
+                           'arn:aws:s3:::bucket/folder',
+                           'arn:aws:s3:::bucket/other',
+                           'arn:aws:glue:eu-central-1:123:table/db/*',
+                           'arn:aws:glue:eu-central-1:123:table/db/t',
+                           'arn:aws:glue:eu-central-1:123:table/dbx/t']))
+        statements = policy_document['Statement']
+
+        self.assertEqual(['arn:aws:s3:::bucket'], statements[0]['Resource'])
+        self.assertEqual(['arn:aws:s3:::bucket/folder/*', 'arn:aws:s3:::bucket/other/*'],
+                         statements[1]['Resource'])
+        self.assertEqual(['arn:aws:glue:eu-central-1:123:table/db/*',
+                          'arn:aws:glue:eu-central-1:123:table/dbx/t'],
+                         statements[2]['Resource'])
+
+
+class TestFailedRecordHandler(TestCase):
+    _queue_arn = 'arn:aws:sqs:eu-central-1:123456789012:dmm-events.fifo'
+    _queue_url = 'https://sqs.eu-central-1.amazonaws.com/123456789012/dmm-events.fifo'
+    _dead_letter_queue_url = \
+        'https://sqs.eu-central-1.amazonaws.com/123456789012/dmm-events-dlq.fifo'
+    _standard_queue_arn = 'arn:aws:sqs:eu-central-1:123456789012:dmm-events'
+    _standard_queue_url = 'https://sqs.eu-central-1.amazonaws.com/123456789012/dmm-events'
+
+    def setUp(self) -> None:
+        sqs = boto3.client('sqs')
+        self._sqs_stubber = Stubber(sqs)
+        self._handler = FailedRecordHandler(sqs, self._dead_letter_queue_url,
+                                            max_receive_count=4,
+                                            base_delay_seconds=60,
+                                            max_delay_seconds=300)
+
+    def tearDown(self) -> None:
+        self._sqs_stubber.deactivate()
+
+    def _record(self, receive_count: int) -> dict:
+        return sqs_record('a_message_id', {'id': 'an_event_id'}, receive_count,
+                          message_group_id='1',
+                          message_attributes={'an-attribute': 'a_value'},
+                          queue_arn=self._queue_arn)
+
+    def _expect_delay(self, queue_url: str, visibility_timeout: int) -> None:
+        self._sqs_stubber.add_response(
+            'change_message_visibility', {},
+            {'QueueUrl': queue_url,
+             'ReceiptHandle': 'receipt_handle_a_message_id',
+             'VisibilityTimeout': visibility_timeout})
+
+    def test_redelivery_delay(self) -> None:
+        self.assertEqual([60, 120, 240, 300, 300],
+                         [self._handler.redelivery_delay(c) for c in range(1, 6)])
+        self.assertEqual([60, 60, 60, 60, 60],
+                         [self._handler.redelivery_delay(c, fifo=True) for c in range(1, 6)])
+
+    def test_failed__delays_redelivery(self) -> None:
+        self._expect_delay(self._standard_queue_url, 120)
+        self._sqs_stubber.activate()
+
+        record = sqs_record('a_message_id', {'id': 'an_event_id'}, 2,
+                            queue_arn=self._standard_queue_arn)
+        self.assertTrue(self._handler.failed(record, ValueError()))
+        self._sqs_stubber.assert_no_pending_responses()
+
+    def test_failed__fifo_delays_redelivery_by_base_delay(self) -> None:
+        self._expect_delay(self._queue_url, 60)
+        self._sqs_stubber.activate()
+
+        self.assertTrue(self._handler.failed(self._record(3), ValueError()))
+        self._sqs_stubber.assert_no_pending_responses()
+
+    def test_failed__visibility_not_changed(self) -> None:
+        self._sqs_stubber.add_client_error('change_message_visibility',
+                                           'ReceiptHandleIsInvalid')
+        self._sqs_stubber.activate()
+
+        self.assertTrue(self._handler.failed(self._record(1), ValueError()))
+
+    def test_failed__dead_letter(self) -> None:
+        self._sqs_stubber.add_response(
+            'send_message', {},
+            {'QueueUrl': self._dead_letter_queue_url,
+             'MessageBody': '{"id": "an_event_id"}',
+             'MessageAttributes': {
+                 'an-attribute': {'DataType': 'String', 'StringValue': 'a_value'},
+                 'dmm-error': {'DataType': 'String',
+                               'StringValue': 'ValueError: broken'}},
+             'MessageGroupId': '1',
+             'MessageDeduplicationId': 'a_message_id'})
+        self._sqs_stubber.activate()
+
+        self.assertFalse(self._handler.failed(self._record(4), ValueError('broken')))
+        self._sqs_stubber.assert_no_pending_responses()
+
+    def test_failed__transient_error_is_dead_lettered(self) -> None:
+        for _ in range(3):
+            self._expect_delay(self._queue_url, 60)
+        self._sqs_stubber.add_response('send_message', {}, {
+            'QueueUrl': self._dead_letter_queue_url,
+            'MessageBody': '{"id": "an_event_id"}',
+            'MessageAttributes': ANY,
+            'MessageGroupId': '1',
+            'MessageDeduplicationId': 'a_message_id'})
+        self._sqs_stubber.activate()
+
+        still_queued = [self._handler.failed(self._record(receive_count),
+                                             CircuitOpenException('dmm'))
+                        for receive_count in range(1, 5)]
+
+        self.assertEqual([True, True, True, False], still_queued)
+        self._sqs_stubber.assert_no_pending_responses()
+
+    def test_failed__without_dead_letter_queue(self) -> None:
+        sqs = Mock()
+        handler = FailedRecordHandler(sqs, None, max_receive_count=4)
+
+        self.assertTrue(handler.failed(self._record(10), ValueError()))
+        sqs.send_message.assert_not_called()
+
+
+class TestHandleRecords(TestCase):
+
+    def setUp(self) -> None:
+        self._event_handler = Mock()
+        self._failed_record_handler = mock_failed_record_handler()
+
+    @staticmethod
+    def _record(event_id: str, message_group_id: str | None = '1') -> dict:
+        return sqs_record('message_{}'.format(event_id), {'id': event_id},
+                          message_group_id=message_group_id)
+
+    def _fail_on(self, *event_ids: str) -> None:
+        self._event_handler.handle_batch.return_value = {
+            event_id: ValueError() for event_id in event_ids}
+
+    def test_handle_records(self) -> None:
+        self._fail_on()
+        records = [self._record('1'), self._record('2')]
+
+        self.assertEqual([], handle_records(records, self._event_handler,
+                                            self._failed_record_handler))
+        self._event_handler.handle_batch.assert_called_once_with(
+            [{'id': '1'}, {'id': '2'}], ANY)
+        self._failed_record_handler.failed.assert_not_called()
+
+    def test_handle_records__fifo_group_reports_only_failed_records(self) -> None:
+        self._fail_on('2')
+        records = [self._record('1'), self._record('2'), self._record('3'),
+                   self._record('4', '2')]
+
+        result = handle_records(records, self._event_handler,
+                                self._failed_record_handler)
+
+        # the records after the failed one were handled and are not applied again
+        self.assertEqual([{'itemIdentifier': 'message_2'}], result)
+        self._failed_record_handler.failed.assert_called_once_with(records[1], ANY)
+
+    def test_handle_records__without_message_group(self) -> None:
+        self._fail_on('1')
+        records = [self._record('1', None), self._record('2', None)]
+
+        result = handle_records(records, self._event_handler,
+                                self._failed_record_handler)
+
+        self.assertEqual([{'itemIdentifier': 'message_1'}], result)
+        self._failed_record_handler.failed.assert_called_once()
+
+    def test_handle_records__dead_lettered_record_is_not_returned(self) -> None:
+        self._fail_on('1')
+        self._failed_record_handler = mock_failed_record_handler(still_queued=False)
+        records = [self._record('1'), self._record('2')]
+
+        self.assertEqual([], handle_records(records, self._event_handler,
+                                            self._failed_record_handler))
+        self._failed_record_handler.failed.assert_called_once()
+
+
+class TestDMMOutbox(TestCase):
+
+    def setUp(self) -> None:
+        self._sqs = Mock()
+
+    def test_add__fifo(self) -> None:
+        outbox = DMMOutbox(self._sqs, 'https://sqs/dmm-outbox.fifo', 'org-a')
+
+        outbox.add('a1', {'tags': ['aws-integration']}, 'event_1')
+
+        self._sqs.send_message.assert_called_once_with(
+            QueueUrl='https://sqs/dmm-outbox.fifo',
+            MessageBody=json.dumps({'data_usage_agreement_id': 'a1',
+                                    'value': {'tags': ['aws-integration']}}),
+            MessageAttributes={
+                'dmm-outbox': {'DataType': 'String',
+                               'StringValue': 'patch_data_usage_agreement'},
+                'dmm-feed': {'DataType': 'String', 'StringValue': 'org-a'}},
+            MessageGroupId='a1',
+            MessageDeduplicationId='event_1')
+
+    def test_add__standard_queue(self) -> None:
+        DMMOutbox(self._sqs, 'https://sqs/dmm-outbox').add('a1', {}, 'event_1')
+
+        kwargs = self._sqs.send_message.call_args.kwargs
+        self.assertNotIn('MessageGroupId', kwargs)
+        self.assertEqual(['dmm-outbox'], list(kwargs['MessageAttributes']))
+
+
+class TestDrainOutbox(TestCase):
+
+    def setUp(self) -> None:
+        self._dmm_client = Mock()
+        self._failed_record_handler = mock_failed_record_handler()
+        self._sink = InMemoryMetricsSink()
+        self._metrics = Metrics(sink=self._sink)
+
+    @staticmethod
+    def _record(message_id: str, data_usage_agreement_id: str, value: dict) -> dict:
+        return sqs_record(message_id, {'data_usage_agreement_id': data_usage_agreement_id,
+                                       'value': value},
+                          message_attributes={'dmm-outbox': 'patch_data_usage_agreement'})
+
+    def test_drain_outbox__merges_updates_of_an_agreement(self) -> None:
+        records = [
+            self._record('1', 'a1', {'custom': {'aws-policy-name': 'p'},
+                                     'tags': ['aws-integration-active']}),
+            self._record('2', 'a2', {'tags': ['aws-integration-active']}),
+            self._record('3', 'a1', {'tags': ['aws-integration-inactive']})]
+
+        self.assertEqual([], drain_outbox(records, self._dmm_client,
+                                          self._failed_record_handler, self._metrics))
+
+        self.assertEqual(
+            [(('a1', {'custom': {'aws-policy-name': 'p'},
+                      'tags': ['aws-integration-inactive']}),),
+             (('a2', {'tags': ['aws-integration-active']}),)],
+            [(c.args,) for c in self._dmm_client.patch_data_usage_agreement.call_args_list])
+        self._metrics.flush()
+        self.assertEqual([3], self._sink.values('OutboxUpdates'))
+        self.assertEqual([2], self._sink.values('OutboxWrites'))
+
+    def test_drain_outbox__fails_all_records_of_a_failed_agreement(self) -> None:
+        def patch_data_usage_agreement(data_usage_agreement_id: str, value: dict) -> None:
+            if data_usage_agreement_id == 'a1':
+                raise HttpError(503, 'url')
+
+        self._dmm_client.patch_data_usage_agreement.side_effect = patch_data_usage_agreement
+        records = [self._record('1', 'a1', {}), self._record('2', 'a2', {}),
+                   self._record('3', 'a1', {})]
+
+        with self.assertLogs('manage_iam_policies', 'ERROR'):
+            result = drain_outbox(records, self._dmm_client,
+                                  self._failed_record_handler, self._metrics)
+
+        self.assertEqual([{'itemIdentifier': '1'}, {'itemIdentifier': '3'}], result)
+        self.assertEqual(2, self._failed_record_handler.failed.call_count)
+
+    def test_is_outbox_record(self) -> None:
+        self.assertTrue(is_outbox_record(self._record('1', 'a1', {})))
+        self.assertFalse(is_outbox_record({'messageId': '1', 'body': '{}'}))
+
+
+class TestRecordsByFeed(TestCase):
+    _feeds = [Feed('org-a', 'https://dmm', 'a/api_key'), Feed('org-b', 'https://dmm', 'b/api_key')]
+
+    def setUp(self) -> None:
+        self._failed_record_handler = mock_failed_record_handler()
+
+    @staticmethod
+    def _record(message_id: str, feed_name: str | None) -> dict:
+        return sqs_record(message_id, message_attributes=None if feed_name is None
+                          else {'dmm-feed': feed_name})
+
+    def test_records_by_feed(self) -> None:
+        records = [self._record('1', 'org-b'), self._record('2', None),
+                   self._record('3', 'org-a'), self._record('4', 'org-b')]
+
+        records_of_feeds, failures = records_by_feed(records, self._feeds,
+                                                     self._failed_record_handler)
+
+        self.assertEqual([('org-b', ['1', '4']), ('org-a', ['2', '3'])],
+                         [(feed.name, [record['messageId'] for record in feed_records])
+                          for feed, feed_records in records_of_feeds])
+        self.assertEqual([], failures)
+
+    def test_records_by_feed__unknown_feed(self) -> None:
+        with self.assertLogs('manage_iam_policies', 'ERROR'):
+            records_of_feeds, failures = records_by_feed(
+                [self._record('1', 'org-c')], self._feeds, self._failed_record_handler)
+
+        self.assertEqual([], records_of_feeds)
+        self.assertEqual([{'itemIdentifier': '1'}], failures)
+        self.assertIsInstance(self._failed_record_handler.failed.call_args.args[1],
+                              UnknownFeedException)
+
+
+class TestInvalidatedDocuments(TestCase):
+
+    def test_invalidated_documents(self) -> None:
+        records = [
+            {'messageId': '1', 'messageAttributes': {
+                'dmm-invalidates': {'dataType': 'String', 'stringValue': 'dataproducts/p1'}}},
+            {'messageId': '2', 'messageAttributes': {}},
+            {'messageId': '3'},
+            {'messageId': '4', 'messageAttributes': {
+                'dmm-invalidates': {'dataType': 'String',
+                                    'stringValue': 'datausageagreements/a1'}}}]
+
+        self.assertEqual(['dataproducts/p1', 'datausageagreements/a1'],
+                         invalidated_documents(records))
+
+
+class TestTraceContext(TestCase):
+    _received_at = datetime(2023, 7, 6, 12, 0, 10, tzinfo=timezone.utc)
+
+    def test_trace_context(self) -> None:
+        record = {
+            'attributes': {'SentTimestamp': '1688644801000'},
+            'messageAttributes': {
+                'dmm-poll-time': {'stringValue': '1688644800500', 'dataType': 'Number'},
+                'dmm-enqueue-time': {'stringValue': '1688644800750', 'dataType': 'Number'}
+            }
+        }
+
+        self.assertEqual({
+            'polled_at': datetime(2023, 7, 6, 12, 0, 0, 500000, tzinfo=timezone.utc),
+            'enqueued_at': datetime(2023, 7, 6, 12, 0, 0, 750000, tzinfo=timezone.utc),
+            'received_at': self._received_at
+        }, trace_context(record, self._received_at))
+
+    def test_trace_context__without_message_attributes(self) -> None:
+        record = {'attributes': {'SentTimestamp': '1688644801000'}}
+
+        self.assertEqual({
+            'polled_at': None,
+            'enqueued_at': datetime(2023, 7, 6, 12, 0, 1, tzinfo=timezone.utc),
+            'received_at': self._received_at
+        }, trace_context(record, self._received_at))
+
+
+class TestInMemoryAgreementLedger(TestCase):
+
+    def setUp(self) -> None:
+        self._ledger = InMemoryAgreementLedger()
+
+    def test_record(self) -> None:
+        self.assertTrue(self._ledger.record('a', 'event_1', 1))
+        self.assertTrue(self._ledger.record('a', 'event_2', 2))
+
+        self.assertEqual({'event_id': 'event_2', 'version': 2}, self._ledger.get('a'))
+        self.assertEqual({'a': {'event_id': 'event_2', 'version': 2}, 'b': None},
+                         self._ledger.get_many(['a', 'b']))
+
+    def test_record__older(self) -> None:
+        self._ledger.record('a', 'event_2', 2)
+
+        self.assertFalse(self._ledger.record('a', 'event_1', 1))
+        self.assertEqual('event_2', self._ledger.get('a')['event_id'])
+
+    def test_record__claimed_by_another_event(self) -> None:
+        self._ledger.claim('a', 'event_1', 1, time.time() + 60)
+
+        self.assertFalse(self._ledger.record('a', 'event_2', 2))
+        self.assertTrue(self._ledger.record('a', 'event_1', 1))
+        self.assertEqual({'event_id': 'event_1', 'version': 1}, self._ledger.get('a'))
+
+    def test_claim(self) -> None:
+        self._ledger.record('a', 'event_1', 1)
+
+        self.assertTrue(self._ledger.claim('a', 'event_2', 2, 100.0))
+        self.assertEqual({'event_id': 'event_2', 'version': 2, 'claimed_until': 100.0},
+                         self._ledger.get('a'))
+
+    def test_claim__older(self) -> None:
+        self._ledger.record('a', 'event_2', 2)
+
+        self.assertFalse(self._ledger.claim('a', 'event_1', 1, time.time() + 60))
+
+    def test_claim__claimed_by_another_event(self) -> None:
+        self._ledger.claim('a', 'event_1', 1, time.time() + 60)
+
+        self.assertFalse(self._ledger.claim('a', 'event_2', 2, time.time() + 60))
+        self.assertTrue(self._ledger.claim('a', 'event_1', 1, time.time() + 60))
+
+    def test_claim__expired(self) -> None:
+        self._ledger.claim('a', 'event_1', 1, time.time() - 1)
+
+        self.assertTrue(self._ledger.claim('a', 'event_2', 2, time.time() + 60))
+
+
+class TestDynamoDBAgreementLedger(TestCase):
+    _table_name = 'a_table'
+
+    def setUp(self) -> None:
+        dynamodb = boto3.client('dynamodb')
+        self._dynamodb_stubber = Stubber(dynamodb)
+        self._ledger = DynamoDBAgreementLedger(dynamodb, self._table_name)
+
+    def tearDown(self) -> None:
+        self._dynamodb_stubber.deactivate()
+
+    @staticmethod
+    def _item(agreement_id: str, event_id: str, version: int) -> dict:
+        return {'agreement_id': {'S': agreement_id},
+                'event_id': {'S': event_id},
+                'version': {'N': str(version)}}
+
+    def test_get(self) -> None:
+        self._dynamodb_stubber.add_response(
+            'get_item', {'Item': self._item('a', 'event_1', 1)},
+            {'TableName': self._table_name,
+             'Key': {'agreement_id': {'S': 'a'}},
+             'ConsistentRead': True})
+        self._dynamodb_stubber.activate()
+
+        self.assertEqual({'event_id': 'event_1', 'version': 1}, self._ledger.get('a'))
+
+    def test_get__not_found(self) -> None:
+        self._dynamodb_stubber.add_response('get_item', {})
+        self._dynamodb_stubber.activate()
+
+        self.assertIsNone(self._ledger.get('a'))
+
+    def test_get_many(self) -> None:
+        keys = {'Keys': [{'agreement_id': {'S': 'a'}}, {'agreement_id': {'S': 'b'}}],
+                'ConsistentRead': True}
+        self._dynamodb_stubber.add_response(
+            'batch_get_item',
+            {'Responses': {self._table_name: []},
+             'UnprocessedKeys': {self._table_name: keys}},
+            {'RequestItems': {self._table_name: keys}})
+        self._dynamodb_stubber.add_response(
+            'batch_get_item',
+            {'Responses': {self._table_name: [self._item('b', 'event_1', 1)]}},
+            {'RequestItems': {self._table_name: keys}})
+        self._dynamodb_stubber.activate()
+
+        self.assertEqual({'a': None, 'b': {'event_id': 'event_1', 'version': 1}},
+                         self._ledger.get_many(['a', 'b', 'a']))
+
+    def test_get__claimed(self) -> None:
+        self._dynamodb_stubber.add_response(
+            'get_item', {'Item': {**self._item('a', 'event_1', 1),
+                                  'claimed_until': {'N': '100.5'}}})
+        self._dynamodb_stubber.activate()
+
+        self.assertEqual({'event_id': 'event_1', 'version': 1, 'claimed_until': 100.5},
+                         self._ledger.get('a'))
+
+    def test_record(self) -> None:
+        self._dynamodb_stubber.add_response(
+            'put_item', {},
+            {'TableName': self._table_name,
+             'Item': self._item('a', 'event_1', 1),
+             'ConditionExpression': 'attribute_not_exists(agreement_id) '
+                                    'OR event_id = :event_id '
+                                    'OR (version <= :version '
+                                    'AND attribute_not_exists(claimed_until))',
+             'ExpressionAttributeValues': {':event_id': {'S': 'event_1'},
+                                           ':version': {'N': '1'}}})
+        self._dynamodb_stubber.activate()
+
+        self.assertTrue(self._ledger.record('a', 'event_1', 1))
+
+    def test_claim(self) -> None:
+        self._dynamodb_stubber.add_response(
+            'put_item', {},
+            {'TableName': self._table_name,
+             'Item': {**self._item('a', 'event_1', 1),
+                      'claimed_until': {'N': '100.5'}},
+             'ConditionExpression': 'attribute_not_exists(agreement_id) '
+                                    'OR event_id = :event_id '
+                                    'OR (version <= :version AND '
+                                    '(attribute_not_exists(claimed_until) '
+                                    'OR claimed_until < :now))',
+             'ExpressionAttributeValues': {':event_id': {'S': 'event_1'},
+                                           ':version': {'N': '1'},
+                                           ':now': {'N': ANY}}})
+        self._dynamodb_stubber.activate()
+
+        self.assertTrue(self._ledger.claim('a', 'event_1', 1, 100.5))
+
+    def test_claim__claimed_by_another_event(self) -> None:
+        self._dynamodb_stubber.add_client_error(
+            'put_item', 'ConditionalCheckFailedException')
+        self._dynamodb_stubber.activate()
+
+        self.assertFalse(self._ledger.claim('a', 'event_1', 1, 100.5))
+
+    def test_record__older(self) -> None:
+        self._dynamodb_stubber.add_client_error(
+            'put_item', 'ConditionalCheckFailedException')
+        self._dynamodb_stubber.activate()
+
+        self.assertFalse(self._ledger.record('a', 'event_1', 1))
+
+
 class TestEventHandler(TestCase):
     _event_id = '123-123-123-123'
     _data_usage_agreement_id = '999-888-777'
@@ -372,6 +1340,11 @@ class TestEventHandler(TestCase):
         'type': 'com.datamesh-manager.events.DataUsageAgreementActivatedEvent',
         'data': {'id': _data_usage_agreement_id}
     }
+    _deactivated_event = {
+        'id': 'deactivated',
+        'type': 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent',
+        'data': {'id': _data_usage_agreement_id}
+    }
 
     @patch('lambda_handler.AWSIAMManager')
     @patch('lambda_handler.DMMClient')
@@ -408,7 +1381,8 @@ class TestEventHandler(TestCase):
 
         self._iam_manager.remove_access.assert_called_with(
             self._data_usage_agreement_id,
-            self._consumer_role_name)
+            self._consumer_role_name,
+            None)
 
         self._dmm_client.patch_data_usage_agreement.assert_called_with(
             self._data_usage_agreement_id,
@@ -432,7 +1406,8 @@ class TestEventHandler(TestCase):
 
     def test_handle__activated(self) -> None:
         self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
-        self._dmm_client.get_dataproduct = self._mock_get_dataproduct
+        self._dmm_client.get_dataproducts = \
+            self._mock_get_dataproducts(self._mock_get_dataproduct)
         self._iam_manager.grant_access.return_value = self._policy_name
 
         self._event_handler.handle(self._activated_event)
@@ -441,7 +1416,8 @@ class TestEventHandler(TestCase):
             self._data_usage_agreement_id,
             self._consumer_role_name,
             self._output_port_type,
-            [self._output_port_arn])
+            [self._output_port_arn],
+            None)
         self._dmm_client.patch_data_usage_agreement.assert_called_with(
             self._data_usage_agreement_id,
             {
@@ -450,18 +1426,265 @@ class TestEventHandler(TestCase):
             }
         )
 
+    def test_handle__activated__outbox(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproducts = \
+            self._mock_get_dataproducts(self._mock_get_dataproduct)
+        self._iam_manager.grant_access.return_value = self._policy_name
+        outbox = Mock()
+        event_handler = EventHandler(self._dmm_client, self._iam_manager, outbox=outbox)
+
+        event_handler.handle(self._activated_event)
+
+        self._iam_manager.grant_access.assert_called_once()
+        self._dmm_client.patch_data_usage_agreement.assert_not_called()
+        outbox.add.assert_called_once_with(
+            self._data_usage_agreement_id,
+            {
+                'custom': {'aws-policy-name': self._policy_name},
+                'tags': ['aws-integration', 'aws-integration-active']
+            },
+            self._event_id)
+
+    def test_handle__activated__fetches_dataproducts_at_once(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproducts = Mock(
+            side_effect=self._mock_get_dataproducts(self._mock_get_dataproduct))
+
+        self._event_handler.handle(self._activated_event)
+
+        self._dmm_client.get_dataproducts.assert_called_once_with(
+            [self._consumer_dataproduct_id, self._provider_dataproduct_id])
+        self._dmm_client.get_dataproduct.assert_not_called()
+
+    def test_plan__prefetches(self) -> None:
+        other_event = {
+            'id': 'other',
+            'type': 'com.datamesh-manager.events.OtherEvent',
+            'data': {'id': 'other_id'}
+        }
+        deactivated_event = {
+            'id': 'deactivated',
+            'type': 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent',
+            'data': {'id': 'deactivated_id'}
+        }
+
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproducts = \
+            self._mock_get_dataproducts(self._mock_get_dataproduct)
+
+        batch_plan = self._event_handler.plan(
+            [self._activated_event, other_event, deactivated_event])
+
+        prefetched_ids = self._dmm_client.prefetch.call_args.args[0]
+        self.assertEqual([self._data_usage_agreement_id, 'deactivated_id'],
+                         list(prefetched_ids))
+        self.assertEqual(['deactivated_id'],
+                         self._dmm_client.prefetch.call_args.kwargs['revoked_ids'])
+        self.assertEqual({}, batch_plan.failures)
+
+    def test_handle__ledger_skips_duplicates(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproducts = \
+            self._mock_get_dataproducts(self._mock_get_dataproduct)
+        event_handler = EventHandler(self._dmm_client, self._iam_manager,
+                                     InMemoryAgreementLedger())
+
+        event_handler.handle(self._activated_event)
+        event_handler.handle(self._activated_event)
+
+        self._iam_manager.grant_access.assert_called_once()
+
+    def test_handle__ledger_skips_older_events(self) -> None:
+        ledger = InMemoryAgreementLedger()
+        event_handler = EventHandler(self._dmm_client, self._iam_manager, ledger)
+        deactivated_event = {
+            'id': 'a_newer_event',
+            'type': 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent',
+            'time': '2023-07-06T12:00:01Z',
+            'data': {'id': self._data_usage_agreement_id}
+        }
+        ledger.record(self._data_usage_agreement_id, 'a_newer_event',
+                      EventHandler._version(deactivated_event))
+
+        event_handler.handle({**self._activated_event, 'time': '2023-07-06T12:00:00Z'})
+
+        self._dmm_client.get_data_usage_agreement.assert_not_called()
+        self._iam_manager.grant_access.assert_not_called()
+
+    def test_handle__ledger_records_applied_events(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproducts = \
+            self._mock_get_dataproducts(self._mock_get_dataproduct)
+        ledger = InMemoryAgreementLedger()
+        event_handler = EventHandler(self._dmm_client, self._iam_manager, ledger)
+
+        event_handler.handle({**self._activated_event, 'time': '1970-01-01T00:00:01Z'})
+
+        self.assertEqual({'event_id': self._event_id, 'version': 1_000_000},
+                         ledger.get(self._data_usage_agreement_id))
+
+    def test_handle__ledger_retries_claimed_events(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproducts = \
+            self._mock_get_dataproducts(self._mock_get_dataproduct)
+        ledger = InMemoryAgreementLedger()
+        # an attempt which was stopped before it recorded the event
+        ledger.claim(self._data_usage_agreement_id, self._event_id, 0, time.time() - 1)
+        event_handler = EventHandler(self._dmm_client, self._iam_manager, ledger)
+
+        event_handler.handle(self._activated_event)
+
+        self._iam_manager.grant_access.assert_called_once()
+        self.assertEqual({'event_id': self._event_id, 'version': 0},
+                         ledger.get(self._data_usage_agreement_id))
+
+    def test_execute__newer_event_executed_first(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproduct = self._mock_get_dataproduct
+        self._dmm_client.get_dataproducts = \
+            self._mock_get_dataproducts(self._mock_get_dataproduct)
+        ledger = InMemoryAgreementLedger()
+        activating_handler = EventHandler(self._dmm_client, self._iam_manager, ledger)
+        deactivating_handler = EventHandler(self._dmm_client, self._iam_manager, ledger)
+        activation_plan = activating_handler.plan(
+            [{**self._activated_event, 'time': '2023-07-06T12:00:00Z'}])
+        deactivation_plan = deactivating_handler.plan(
+            [{**self._deactivated_event, 'time': '2023-07-06T12:00:05Z'}])
+
+        self.assertEqual({}, deactivating_handler.execute(deactivation_plan))
+        self.assertEqual({}, activating_handler.execute(activation_plan))
+
+        self._iam_manager.remove_access.assert_called_once()
+        self._iam_manager.grant_access.assert_not_called()
+        self.assertEqual('deactivated', ledger.get(self._data_usage_agreement_id)['event_id'])
+
+    def test_execute__newer_event_executed_during_older_one(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproduct = self._mock_get_dataproduct
+        self._dmm_client.get_dataproducts = \
+            self._mock_get_dataproducts(self._mock_get_dataproduct)
+        ledger = InMemoryAgreementLedger()
+        activating_handler = EventHandler(self._dmm_client, self._iam_manager, ledger)
+        deactivating_handler = EventHandler(self._dmm_client, self._iam_manager, ledger)
+        activation_plan = activating_handler.plan(
+            [{**self._activated_event, 'time': '2023-07-06T12:00:00Z'}])
+        deactivation_plan = deactivating_handler.plan(
+            [{**self._deactivated_event, 'time': '2023-07-06T12:00:05Z'}])
+        deactivation_failures = {}
+        self._iam_manager.grant_access.side_effect = lambda *args: \
+            deactivation_failures.update(deactivating_handler.execute(deactivation_plan))
+
+        with self.assertLogs('manage_iam_policies', 'ERROR'):
+            self.assertEqual({}, activating_handler.execute(activation_plan))
+
+        # waits for the activation and is retried after it
+        self.assertIsInstance(deactivation_failures['deactivated'], AgreementClaimedException)
+        self._iam_manager.remove_access.assert_not_called()
+        self.assertEqual({}, deactivating_handler.execute(deactivation_plan))
+        self._iam_manager.remove_access.assert_called_once()
+        self.assertEqual('deactivated', ledger.get(self._data_usage_agreement_id)['event_id'])
+
+    def test_execute__waits_for_the_claim_of_an_older_event(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproduct = self._mock_get_dataproduct
+        ledger = InMemoryAgreementLedger()
+        # an activation in the other queue of the priority lane
+        ledger.claim(self._data_usage_agreement_id, self._event_id, 0, time.time() + 60)
+        event_handler = EventHandler(self._dmm_client, self._iam_manager, ledger,
+                                     claim_wait_seconds=5)
+        deactivation_plan = event_handler.plan(
+            [{**self._deactivated_event, 'time': '2023-07-06T12:00:05Z'}])
+        release = threading.Timer(
+            0.2, lambda: ledger.record(self._data_usage_agreement_id, self._event_id, 0))
+        release.start()
+
+        self.assertEqual({}, event_handler.execute(deactivation_plan))
+
+        release.join()
+        self._iam_manager.remove_access.assert_called_once()
+        self.assertEqual('deactivated', ledger.get(self._data_usage_agreement_id)['event_id'])
+
+    def test_plan__ledger_skips_older_events(self) -> None:
+        ledger = InMemoryAgreementLedger()
+        ledger.record(self._data_usage_agreement_id, self._event_id, 0)
+        event_handler = EventHandler(self._dmm_client, self._iam_manager, ledger)
+
+        event_handler.plan([self._activated_event])
+
+        self.assertEqual([], list(self._dmm_client.prefetch.call_args.args[0]))
+
+    def test_handle__emits_latency(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproduct = self._mock_get_dataproduct
+        sink = InMemoryMetricsSink()
+        metrics = Metrics(sink=sink)
+        event_handler = EventHandler(self._dmm_client, self._iam_manager,
+                                     metrics=metrics)
+        event = {
+            'id': self._event_id,
+            'type': 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent',
+            'time': datetime.now(timezone.utc).isoformat(),
+            'data': {'id': self._data_usage_agreement_id}
+        }
+
+        event_handler.handle(event)
+        metrics.flush()
+
+        [latency] = sink.values('AccessChangeLatency', {'AccessChange': 'revoke'})
+        self.assertLess(latency, 60_000)
+        self.assertEqual([1], sink.values('BatchSize'))
+        self.assertEqual([0], sink.values('EventErrors'))
+
+    def test_handle_batch__traces_events(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproduct = self._mock_get_dataproduct
+        sink = InMemoryMetricsSink()
+        metrics = Metrics(sink=sink)
+        iam_manager = AWSIAMManager(Mock(), metrics)
+        event_handler = EventHandler(self._dmm_client, iam_manager, metrics=metrics)
+        now = datetime.now(timezone.utc)
+        trace_contexts = {self._event_id: {
+            'polled_at': now - timedelta(seconds=3),
+            'enqueued_at': now - timedelta(seconds=2),
+            'received_at': now - timedelta(seconds=1)}}
+        event = {
+            'id': self._event_id,
+            'type': 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent',
+            'time': (now - timedelta(seconds=4)).isoformat(),
+            'data': {'id': self._data_usage_agreement_id}
+        }
+
+        with self.assertLogs(level='INFO') as logs:
+            event_handler.handle_batch([event], trace_contexts)
+        metrics.flush()
+
+        [trace] = [json.loads(line.split('Trace: ', 1)[1])
+                   for line in logs.output if 'Trace: ' in line]
+        self.assertEqual(self._event_id, trace['event_id'])
+        self.assertEqual(['IAMCallLatency'], [span['name'] for span in trace['spans']])
+        self.assertEqual('DeleteRolePolicy', trace['spans'][0]['Method'])
+        self.assertAlmostEqual(1000, sink.values('FeedDelay')[0], delta=1)
+        self.assertAlmostEqual(1000, sink.values('QueueDwellTime')[0], delta=1)
+        self.assertGreaterEqual(sink.values('ProcessingTime')[0], 1000)
+        self.assertGreaterEqual(sink.values('AccessChangeLatency')[0], 4000)
+
     def test_handle__activated__consumer_role_not_set(self) -> None:
         self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
-        self._dmm_client.get_dataproduct = self._mock_get_dataproduct_no_role
+        self._dmm_client.get_dataproducts = \
+            self._mock_get_dataproducts(self._mock_get_dataproduct_no_role)
 
-        with self.assertRaises(RequiredCustomFieldNotSet):
+        with self.assertRaises(RequiredCustomFieldNotSet), \
+            self.assertLogs('manage_iam_policies', 'ERROR'):
             self._event_handler.handle(self._activated_event)
 
     def test_handle__activated__provider_arn_not_set(self) -> None:
         self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
-        self._dmm_client.get_dataproduct = self._mock_get_dataproduct_no_arn
+        self._dmm_client.get_dataproducts = \
+            self._mock_get_dataproducts(self._mock_get_dataproduct_no_arn)
 
-        with self.assertRaises(RequiredCustomFieldNotSet):
+        with self.assertRaises(RequiredCustomFieldNotSet), \
+            self.assertLogs('manage_iam_policies', 'ERROR'):
             self._event_handler.handle(self._activated_event)
 
     def test_handle__activated__contract_not_found(self) -> None:
@@ -472,6 +1695,139 @@ class TestEventHandler(TestCase):
         self._iam_manager.grant_access.assert_not_called()
         self._dmm_client.patch_data_usage_agreement.assert_not_called()
 
+    def test_handle_batch__collapses_events_of_an_agreement(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproduct = self._mock_get_dataproduct
+        deactivated_event = {
+            'id': 'deactivated',
+            'type': 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent',
+            'time': '2023-07-06T12:00:01Z',
+            'data': {'id': self._data_usage_agreement_id}
+        }
+
+        failures = self._event_handler.handle_batch(
+            [deactivated_event, {**self._activated_event, 'time': '2023-07-06T12:00:00Z'}])
+
+        self.assertEqual({}, failures)
+        self._iam_manager.grant_access.assert_not_called()
+        self._iam_manager.remove_access.assert_called_once()
+        self._dmm_client.patch_data_usage_agreement.assert_called_once()
+
+    def test_handle_batch__drops_duplicates(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproducts = \
+            self._mock_get_dataproducts(self._mock_get_dataproduct)
+
+        self._event_handler.handle_batch([self._activated_event, self._activated_event])
+
+        self._iam_manager.grant_access.assert_called_once()
+
+    def test_handle_batch__isolates_failures_per_agreement(self) -> None:
+        self._dmm_client.get_dataproducts = \
+            self._mock_get_dataproducts(self._mock_get_dataproduct)
+        unknown_port_event = {
+            'id': 'unknown_port',
+            'type': 'com.datamesh-manager.events.DataUsageAgreementActivatedEvent',
+            'data': {'id': 'unknown_agreement'}
+        }
+        self._dmm_client.get_data_usage_agreement = Mock(side_effect=lambda i: (
+            self._mock_get_data_usage_agreement(self._data_usage_agreement_id)
+            if i == self._data_usage_agreement_id else {
+                'info': {'id': i},
+                'consumer': {'dataProductId': self._consumer_dataproduct_id},
+                'provider': {'dataProductId': self._provider_dataproduct_id,
+                             'outputPortId': 'unknown_port'}}))
+
+        with self.assertLogs('manage_iam_policies', 'ERROR'):
+            failures = self._event_handler.handle_batch(
+                [unknown_port_event, self._activated_event])
+
+        self.assertEqual(['unknown_port'], list(failures.keys()))
+        self._iam_manager.grant_access.assert_called_once()
+
+    def test_handle_batch__fails_all_events_of_a_failed_agreement(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproducts = \
+            self._mock_get_dataproducts(self._mock_get_dataproduct)
+        self._iam_manager.grant_access.side_effect = ValueError()
+
+        with self.assertLogs('manage_iam_policies', 'ERROR'):
+            failures = self._event_handler.handle_batch(
+                [self._activated_event, {**self._activated_event, 'id': 'later'}])
+
+        self.assertEqual({self._event_id, 'later'}, set(failures.keys()))
+        self._dmm_client.patch_data_usage_agreement.assert_not_called()
+
+    def test_handle__consumer_account(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproducts = self._mock_get_dataproducts(
+            lambda i: {**self._mock_get_dataproduct(i), 'custom': {
+                'aws-role-name': self._consumer_role_name,
+                'aws-account-id': '111111111111'}}
+            if i == self._consumer_dataproduct_id else self._mock_get_dataproduct(i))
+        self._iam_manager.grant_access.return_value = self._policy_name
+
+        self._event_handler.handle(self._activated_event)
+
+        self.assertEqual('111111111111', self._iam_manager.grant_access.call_args.args[4])
+
+    def test_handle__invalid_consumer_account(self) -> None:
+        self._dmm_client.get_data_usage_agreement = self._mock_get_data_usage_agreement
+        self._dmm_client.get_dataproducts = self._mock_get_dataproducts(
+            lambda i: {**self._mock_get_dataproduct(i), 'custom': {
+                'aws-role-name': self._consumer_role_name, 'aws-account-id': 'other'}}
+            if i == self._consumer_dataproduct_id else self._mock_get_dataproduct(i))
+
+        with self.assertRaises(ValueError), self.assertLogs('manage_iam_policies', 'ERROR'):
+            self._event_handler.handle(self._activated_event)
+        self._iam_manager.grant_access.assert_not_called()
+
+    def test_execute__accounts_concurrently(self) -> None:
+        # both accounts have to wait for each other
+        barrier = threading.Barrier(2, timeout=5)
+        self._iam_manager.remove_access.side_effect = lambda *args: barrier.wait()
+        batch_plan = BatchPlan()
+        for i, account_id in enumerate(['111111111111', '222222222222']):
+            batch_plan.steps.append({
+                'event': {'id': 'event_{}'.format(i), 'data': {'id': 'agreement_{}'.format(i)},
+                          'type': 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent'},
+                'event_ids': ['event_{}'.format(i)],
+                'consumer_role_name': 'consumer',
+                'consumer_account_id': account_id,
+                'operations': [{'operation': 'remove_access',
+                                'data_usage_agreement_id': 'agreement_{}'.format(i),
+                                'consumer_role_name': 'consumer',
+                                'consumer_account_id': account_id}]})
+
+        failures = self._event_handler.execute(batch_plan)
+
+        self.assertEqual({}, failures)
+        self.assertEqual(2, self._iam_manager.remove_access.call_count)
+
+    def test_plan__groups_steps_by_consumer_role(self) -> None:
+        self._dmm_client.get_data_usage_agreement = Mock(side_effect=lambda i: {
+            'info': {'id': i},
+            'consumer': {'dataProductId': 'consumer_{}'.format(i[-1])},
+            'provider': {'dataProductId': self._provider_dataproduct_id}})
+        self._dmm_client.get_dataproduct = Mock(side_effect=lambda i: {
+            'custom': {'aws-role-name': 'role_{}'.format(i[-1])}})
+        events = [{
+            'id': 'event_{}'.format(i),
+            'type': 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent',
+            'data': {'id': 'agreement_{}'.format(i % 2)}
+        } for i in range(4)]
+
+        batch_plan = self._event_handler.plan(events)
+
+        self.assertEqual(
+            {'role_0': [['event_0', 'event_2']], 'role_1': [['event_1', 'event_3']]},
+            {role: [step['event_ids'] for step in steps]
+             for role, steps in batch_plan.steps_by_consumer_role().items()})
+
+    @staticmethod
+    def _mock_get_dataproducts(mock_get_dataproduct):
+        return lambda ids: {i: mock_get_dataproduct(i) for i in ids}
+
     def _mock_get_data_usage_agreement(self, data_usage_agreement_id: str):
         if data_usage_agreement_id == self._data_usage_agreement_id:
             return {
@@ -550,5 +1906,165 @@ class TestEventHandler(TestCase):
             return None
 
 
+def sqs_record(message_id: str, body: dict | None = None, receive_count: int = 1,
+    message_group_id: str | None = None, message_attributes: dict[str, str] | None = None,
+    queue_arn: str = 'arn:aws:sqs:eu-central-1:123456789012:dmm-events') -> dict:
+    """Returns the record of an sqs message with the given string message
+    attributes, as the event source mapping passes it to the function
+    """
+
+    attributes = {'ApproximateReceiveCount': str(receive_count)}
+    if message_group_id is not None:
+        attributes['MessageGroupId'] = message_group_id
+    return {'messageId': message_id,
+            'receiptHandle': 'receipt_handle_{}'.format(message_id),
+            'body': json.dumps(body or {}),
+            'attributes': attributes,
+            'messageAttributes': {name: {'dataType': 'String', 'stringValue': value}
+                                  for name, value in (message_attributes or {}).items()},
+            'eventSourceARN': queue_arn}
+
+
+def mock_failed_record_handler(still_queued: bool = True) -> Mock:
+    """Returns a FailedRecordHandler which keeps every failed record in the
+    queue, or moves it to the dead-letter queue
+    """
+
+    failed_record_handler = Mock(spec=FailedRecordHandler)
+    failed_record_handler.failed.return_value = still_queued
+    return failed_record_handler
+
+
+class TestCallBudgets(TestCase):
+    """Remote calls per event of the main scenarios, so that additional
+    calls, e.g. a write per event instead of per batch, fail here
+    """
+
+    _activated_event_type = 'com.datamesh-manager.events.DataUsageAgreementActivatedEvent'
+    _deactivated_event_type = 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent'
+
+    def setUp(self) -> None:
+        self._accounting = CallAccounting()
+        self._metrics = Metrics(sink=InMemoryMetricsSink())
+        self._documents = {
+            'dataproducts/c1': {'info': {'id': 'c1'},
+                                'custom': {'aws-role-name': 'consumer_role'}},
+            'dataproducts/p1': {'info': {'id': 'p1'},
+                                'outputPorts': [{'id': 'port', 'custom': {
+                                    'output-port-type': 's3_bucket',
+                                    'aws-s3-bucket-arn': 'arn:aws:s3:::bucket'}}]}}
+        for index in range(10):
+            self._documents['datausageagreements/a{}'.format(index)] = {
+                'info': {'id': 'a{}'.format(index)},
+                'consumer': {'dataProductId': 'c1'},
+                'provider': {'dataProductId': 'p1', 'outputPortId': 'port'}}
+        self._document_cache = DocumentCache(metrics=self._metrics)
+        self._dmm_client = DMMClient('https://dmm-url.com', 'supersecret',
+                                     session=self._accounting.dmm_documents_session(self._documents),
+                                     metrics=self._metrics,
+                                     document_cache=self._document_cache)
+
+    def _event_handler(self, **kwargs) -> EventHandler:
+        return EventHandler(self._dmm_client,
+                            AWSIAMManager(self._accounting.aws_client('iam'), self._metrics,
+                                          PolicyCompiler()),
+                            metrics=self._metrics, **kwargs)
+
+    def _events(self, count: int, event_type: str = _activated_event_type) -> list[dict]:
+        return [{'id': 'e{}'.format(index), 'type': event_type,
+                 'data': {'id': 'a{}'.format(index)}} for index in range(count)]
+
+    def test_activation(self) -> None:
+        self.assertEqual({}, self._event_handler().handle_batch(self._events(1)))
+
+        # consumer and provider are two reads, shared ones are read once
+        # per batch and the outbox takes the write off, see below
+        self.assertEqual({}, self._accounting.over_budget(1, {
+            'dmm': 4, 'dmm.GetDataUsageAgreement': 1, 'dmm.GetDataProduct': 2,
+            'dmm.PutDataUsageAgreement': 1, 'iam.PutRolePolicy': 1}))
+
+    def test_activation__outbox(self) -> None:
+        outbox = DMMOutbox(self._accounting.aws_client('sqs'), 'outbox.fifo',
+                           metrics=self._metrics)
+
+        self.assertEqual({}, self._event_handler(outbox=outbox)
+                         .handle_batch(self._events(1)))
+
+        self.assertEqual({}, self._accounting.over_budget(1, {
+            'dmm': 3, 'iam.PutRolePolicy': 1, 'sqs.SendMessage': 1}))
+
+    def test_deactivation(self) -> None:
+        self.assertEqual({}, self._event_handler().handle_batch(
+            self._events(1, self._deactivated_event_type)))
+
+        self.assertEqual({}, self._accounting.over_budget(1, {
+            'dmm': 3, 'dmm.GetDataUsageAgreement': 1, 'dmm.GetDataProduct': 1,
+            'dmm.PutDataUsageAgreement': 1, 'iam.DeleteRolePolicy': 1}))
+
+    def test_batch__shared_documents_are_read_once(self) -> None:
+        self.assertEqual({}, self._event_handler().handle_batch(self._events(10)))
+
+        self.assertEqual({}, self._accounting.over_budget(10, {
+            'dmm': 3, 'dmm.GetDataUsageAgreement': 1, 'dmm.GetDataProduct': 0.2,
+            'dmm.PutDataUsageAgreement': 1, 'iam.PutRolePolicy': 1}))
+
+    def test_batch__ledger_is_read_once_per_batch(self) -> None:
+        dynamodb = self._accounting.aws_client(
+            'dynamodb', {'BatchGetItem': {'Responses': {'ledger': []}}})
+        ledger = DynamoDBAgreementLedger(dynamodb, 'ledger')
+
+        self.assertEqual({}, self._event_handler(ledger=ledger)
+                         .handle_batch(self._events(10)))
+
+        self.assertEqual({}, self._accounting.over_budget(10, {
+            'dmm': 2.2, 'iam.PutRolePolicy': 1,
+            # the claim before and the record after the access change
+            'dynamodb.BatchGetItem': 0.1, 'dynamodb.PutItem': 2}))
+
+    def test_warm_container__cached_documents_are_not_read_again(self) -> None:
+        self._event_handler().handle_batch(self._events(10))
+        self._accounting.calls.clear()
+
+        self.assertEqual({}, self._event_handler().handle_batch(self._events(10)))
+
+        # only the writes, as the feed did not report a change
+        self.assertEqual({}, self._accounting.over_budget(10, {
+            'dmm': 1, 'dmm.PutDataUsageAgreement': 1, 'iam.PutRolePolicy': 1}))
+
+    def test_warm_container__revocations_read_documents_again(self) -> None:
+        self._event_handler().handle_batch(self._events(10))
+        self._accounting.calls.clear()
+
+        self.assertEqual({}, self._event_handler().handle_batch(
+            self._events(10, self._deactivated_event_type)))
+
+        # each agreement and the consumer they share once more
+        self.assertEqual({}, self._accounting.over_budget(10, {
+            'dmm': 2.1, 'dmm.GetDataUsageAgreement': 1, 'dmm.GetDataProduct': 0.1,
+            'dmm.PutDataUsageAgreement': 1, 'iam.DeleteRolePolicy': 1}))
+        self.assertEqual(1, self._accounting.calls['dmm.GetDataProduct'])
+
+    def test_drain_outbox__one_write_per_agreement(self) -> None:
+        records = [sqs_record(str(index),
+                              {'data_usage_agreement_id': 'a{}'.format(index % 2),
+                               'value': {'tags': ['aws-integration-active']}})
+                   for index in range(10)]
+
+        self.assertEqual([], drain_outbox(records, self._dmm_client,
+                                          mock_failed_record_handler(), self._metrics))
+
+        self.assertEqual({}, self._accounting.over_budget(10, {
+            'dmm.GetDataUsageAgreement': 0.2, 'dmm.PutDataUsageAgreement': 0.2}))
+
+    def test_over_budget(self) -> None:
+        self._accounting.calls.update({'dmm.GetDataProduct': 3, 'iam.PutRolePolicy': 1,
+                                       's3.PutObject': 2})
+
+        self.assertEqual({'dmm': 3, 's3': 2},
+                         self._accounting.over_budget(2, {'dmm': 1, 'iam': 1}))
+        self.assertEqual({}, self._accounting.over_budget(2, {'dmm.GetDataProduct': 1.5,
+                                                              'iam': 0.5, 's3': 1}))
+
+
 if __name__ == '__main__':
     unittest.main()
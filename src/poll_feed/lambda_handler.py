@@ -1,115 +1,606 @@
 import json
 import logging
+import math
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import copy_context
 from os import environ
-from typing import TypeAlias
+from typing import Callable
 
-import boto3
-import requests
-from botocore.client import ClientError
+from botocore.exceptions import ClientError
 
-DMMEvent: TypeAlias = dict[str, str | dict[str]]
+from dmm_common import CircuitBreaker, CircuitOpenException, DMMEvent, Feed, HttpResponse, \
+    HttpSession, LazyJson, Metrics, S3CircuitStateStore, aws_client, bind_request_id, \
+    configure_logging, configured_feeds, event_time, log_context, profiled, \
+    reset_shared_warm_container, run_deadline, shared_http_session, shared_metrics, \
+    shared_secret_cache
+
+log = logging.getLogger('poll_feed')
+# lines per event, which can be sampled or silenced separately
+event_log = logging.getLogger('poll_feed.events')
 
 
 def lambda_handler(event, context) -> None:
-    logging.getLogger().setLevel(logging.INFO)
+    configure_logging(event_log)
+    bind_request_id(context)
+
+    # profile a share of all invocations, if enabled
+    with profiled(context, log):
+        # requests to Data Mesh Manager are not retried beyond the deadline either
+        deadline = run_deadline(context)
+        shared_http_session().set_deadline(deadline)
+
+        # poll the feeds of all organizations, each within its share of the time
+        try:
+            poll_feeds(configured_feeds(), poll_feed, deadline,
+                       int(environ.get('max_feed_concurrency', 8)))
+        finally:
+            log.info('Latencies: %s', LazyJson(shared_metrics().latency_summary))
+            shared_metrics().flush()
+
+        log.info('HTTP session: %s', shared_http_session().stats())
+
+        return
+
+
+def poll_feed(feed: 'Feed', deadline: float | None) -> None:
+    """Sends the new events of a feed to the queue"""
 
     # get configuration
-    dmm_base_url = environ['dmm_base_url']
-    dmm_api_key_secret_name = environ['dmm_api_key_secret_name']
-    bucket_name = environ['bucket_name']
-    last_event_id_object_name = environ['last_event_id_object_name']
     sqs_queue_url = environ['sqs_queue_url']
+    priority_sqs_queue_url = environ.get('priority_sqs_queue_url') or None
 
     # create client for target queue in sqs
-    sqs = boto3.client('sqs')
-    target_queue_client = TargetQueueClient(sqs, sqs_queue_url)
-
-    # create repo for last processed event
-    s3 = boto3.client('s3')
-    last_processed_event_repo = LastProcessedEventIdRepo(
-        s3,
-        bucket_name,
-        last_event_id_object_name
-    )
+    target_queue_client = TargetQueueClient(aws_client('sqs'),
+                                            sqs_queue_url,
+                                            priority_sqs_queue_url,
+                                            message_group_id=feed.message_group_id)
+
+    # create store for last processed event
+    last_processed_event_repo = checkpoint_store(feed)
 
     # create client for Data Mesh Manager
-    secretsmanager = boto3.client('secretsmanager')
-    secrets = Secrets(secretsmanager)
-    dmm_api_key = secrets.get_secret(dmm_api_key_secret_name)
-    dmm_events_client = DMMEventsClient(dmm_base_url, dmm_api_key)
+    circuit_breaker = shared_circuit_breaker(feed)
+    circuit_breaker.load()
+    if not circuit_breaker.allow_request():
+        log.warning('Data Mesh Manager is unavailable, skipping run')
+        return
+
+    secret_cache = shared_secret_cache()
+    dmm_events_client = DMMEventsClient(
+        feed.dmm_base_url,
+        secret_cache.get_secret(feed.dmm_api_key_secret_name),
+        refresh_api_key=lambda: secret_cache.refresh(feed.dmm_api_key_secret_name),
+        circuit_breaker=circuit_breaker)
 
     # create feed processor
     feed_processor = FeedProcessor(
         last_processed_event_repo,
         dmm_events_client,
-        target_queue_client
+        target_queue_client,
+        feed_name=feed.name
     )
 
     # start processing new events
-    feed_processor.process_new_events()
-
-    return
+    try:
+        feed_processor.process_new_events(deadline)
+    except CircuitOpenException as e:
+        # the feed position is saved, so the next run continues from there
+        log.warning('Stopped processing: %s', e)
+    except CheckpointConflictException as e:
+        # the other run sends the following events, the consumer drops the
+        # ones both runs sent
+        log.warning('Stopped processing: %s', e)
+
+
+def poll_feeds(
+    feeds: list['Feed'],
+    poll: Callable[['Feed', float | None], None],
+    deadline: float | None,
+    max_concurrency: int = 8,
+    clock: Callable[[], float] = time.time
+) -> None:
+    """Polls all feeds, concurrently if there are several
+
+    If there are more feeds than can be polled at once, the time until the
+    deadline is shared among the rounds of feeds, so a slow feed leaves its
+    remaining pages to the next run instead of holding up the others. A
+    failing feed does not stop the others either, its error is raised once
+    all feeds are done.
+    """
+
+    if len(feeds) == 1:
+        poll(feeds[0], deadline)
+        return
+
+    # imported on first use, as a single feed needs no threads
+    from concurrent.futures import ThreadPoolExecutor
+
+    workers = min(max_concurrency, len(feeds))
+    share_seconds = None if deadline is None \
+        else (deadline - clock()) / math.ceil(len(feeds) / workers)
+
+    def poll_share(feed: Feed) -> Exception | None:
+        feed_deadline = None if deadline is None else min(deadline, clock() + share_seconds)
+        with log_context(feed=feed.name):
+            try:
+                poll(feed, feed_deadline)
+            except Exception as e:
+                log.exception('Failed to poll feed %s', feed.name)
+                return e
+        return None
+
+    # keeps the correlation ids of the log lines in the worker threads
+    context = copy_context()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        errors = [error for error in executor.map(
+            lambda feed: context.copy().run(poll_share, feed), feeds) if error is not None]
+    if len(errors) > 0:
+        raise errors[0]
+
+
+# reused by all invocations of a warm container
+_circuit_breakers: dict[str, 'CircuitBreaker'] = {}
+# the feeds are polled in threads of their own
+_circuit_breakers_lock = threading.Lock()
+
+
+def shared_circuit_breaker(feed: 'Feed') -> 'CircuitBreaker':
+    # one per feed, so an unavailable organization does not stop the others
+    name = 'dmm' if feed.name is None else 'dmm-{}'.format(feed.name)
+    with _circuit_breakers_lock:
+        if name not in _circuit_breakers:
+            circuit_state_object_name = feed.circuit_state_object_name
+            _circuit_breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=int(environ.get('dmm_circuit_failure_threshold', 5)),
+                reset_timeout_seconds=float(
+                    environ.get('dmm_circuit_reset_timeout_seconds', 30)),
+                half_open_max_calls=int(
+                    environ.get('dmm_circuit_half_open_max_calls', 1)),
+                state_store=None if circuit_state_object_name is None
+                else S3CircuitStateStore(aws_client('s3'),
+                                         environ['bucket_name'],
+                                         circuit_state_object_name))
+        return _circuit_breakers[name]
+
+
+def checkpoint_store(feed: 'Feed') -> 'CheckpointStore':
+    """Returns the store of the feed position selected by checkpoint_store,
+    s3 if it is not set, dynamodb or file
+    """
+
+    match environ.get('checkpoint_store') or 's3':
+        case 's3':
+            return LastProcessedEventIdRepo(aws_client('s3'), environ['bucket_name'],
+                                            feed.last_event_id_object_name)
+        case 'dynamodb':
+            return DynamoDBCheckpointStore(aws_client('dynamodb'),
+                                           environ['checkpoint_table_name'],
+                                           feed.last_event_id_object_name)
+        case 'file':
+            return FileCheckpointStore(os.path.join(environ['checkpoint_directory'],
+                                                    feed.last_event_id_object_name))
+        case other:
+            raise ValueError('Unknown checkpoint store {}'.format(other))
+
+
+def reset_warm_container() -> None:
+    """Drops all clients, secrets, breaker states and metrics kept between
+    invocations
+    """
+
+    reset_shared_warm_container()
+    _circuit_breakers.clear()
 
 
 class TargetQueueClient:
-    def __init__(self, sqs, queue_url: str):
+    """Sends events to the queue of manage_iam_policies
+
+    If a priority queue is given, revocations are sent there, so they do not
+    wait behind a burst of other events. Messages for standard queues are
+    sent in batches, and entries which failed on the side of SQS are sent
+    again. Messages for fifo queues are sent one by one, as a failed entry
+    of a batch could only be sent again after the entries behind it.
+    """
+
+    _priority_event_types = (
+        'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent',)
+    _max_batch_size = 10
+
+    def __init__(self, sqs, queue_url: str, priority_queue_url: str | None = None,
+        max_attempts: int = 3, backoff_base: float = 0.1, backoff_max: float = 2.0,
+        sleep: Callable[[float], None] = time.sleep, message_group_id: str = '1'):
         self._sqs = sqs
         self._queue_url = queue_url
+        self._priority_queue_url = priority_queue_url
+        self._message_group_id = message_group_id
+        self._max_attempts = max_attempts
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._sleep = sleep
+
+    def send_message(self, message: dict, message_id: str,
+        trace_context: dict[str, str | float | None] | None = None) -> None:
+        self._sqs.send_message(**self._request(message, message_id, trace_context))
+
+    def send_messages(self, messages: list[tuple[dict, str, dict[str, str | float | None] | None]]) -> None:
+        """Sends messages given as message, message id and trace context, in
+        their order per queue
+        """
+
+        requests_by_queue: dict[str, list[dict]] = {}
+        for message, message_id, trace_context in messages:
+            request = self._request(message, message_id, trace_context)
+            requests_by_queue.setdefault(request['QueueUrl'], []).append(request)
+
+        for queue_url, requests in requests_by_queue.items():
+            if queue_url.endswith('.fifo'):
+                for request in requests:
+                    self._sqs.send_message(**request)
+            else:
+                for start in range(0, len(requests), self._max_batch_size):
+                    self._send_batch(queue_url, requests[start:start + self._max_batch_size])
+
+    def _send_batch(self, queue_url: str, requests: list[dict]) -> None:
+        entries = {str(index): {key: value for key, value in request.items()
+                                if key != 'QueueUrl'}
+                   for index, request in enumerate(requests)}
+        attempt = 0
+        while True:
+            response = self._sqs.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[{'Id': entry_id, **entry} for entry_id, entry in entries.items()])
+            failed = response.get('Failed', [])
+            if len(failed) == 0:
+                return
+
+            attempt += 1
+            sender_faults = [f for f in failed if f.get('SenderFault')]
+            if len(sender_faults) > 0 or attempt >= self._max_attempts:
+                raise SendMessageBatchException(queue_url, sender_faults or failed)
+
+            log.warning('Sending %s of %s messages again, attempt %s',
+                        len(failed), len(entries), attempt)
+            entries = {f['Id']: entries[f['Id']] for f in failed}
+            self._sleep(random.uniform(
+                0, min(self._backoff_max, self._backoff_base * 2 ** attempt)))
+
+    def _request(self, message: dict, message_id: str,
+        trace_context: dict[str, str | float | None] | None) -> dict:
+        queue_url = self._target_queue_url(message)
+        request = {
+            'QueueUrl': queue_url,
+            'MessageBody': json.dumps(message)
+        }
+        if trace_context:
+            request['MessageAttributes'] = self._message_attributes(trace_context)
+        if queue_url.endswith('.fifo'):
+            request['MessageDeduplicationId'] = message_id
+            # one group per organization, processed one message at a time
+            request['MessageGroupId'] = self._message_group_id
+        # otherwise ordering and deduplication are left to the consumer
+        return request
+
+    @staticmethod
+    def _message_attributes(trace_context: dict[str, str | float | None]) -> dict:
+        # times are sent as epoch milliseconds, the event time as it is
+        return {
+            name: {'DataType': 'String', 'StringValue': value}
+            if isinstance(value, str) else
+            {'DataType': 'Number', 'StringValue': str(int(value * 1000))}
+            for name, value in trace_context.items() if value is not None
+        }
+
+    def _target_queue_url(self, message: dict) -> str:
+        if self._priority_queue_url is not None \
+            and message.get('type') in self._priority_event_types:
+            return self._priority_queue_url
+        return self._queue_url
+
+
+class SendMessageBatchException(Exception):
+    def __init__(self, queue_url: str, failed: list[dict]):
+        super().__init__('Could not send {} messages to {}: {}'.format(
+            len(failed), queue_url, ', '.join(sorted({f['Code'] for f in failed}))))
+        self.failed = failed
+
+
+class CheckpointConflictException(Exception):
+    def __init__(self, name: str):
+        super().__init__('The feed position in {} was moved by another run'.format(name))
+
+
+class CheckpointStore(ABC):
+    """Keeps the id of the last processed event of a feed
+
+    get_last_event_id reads it, compare_and_set replaces it atomically if it
+    still is the expected id. put_last_event_id expects the id this store
+    read or wrote last, so a run which overlaps with another one stops with
+    CheckpointConflictException instead of moving the feed position back.
+    Without a preceding read, it writes unconditionally.
+
+    The backends implement the abstract methods _get, _put and
+    _compare_and_set.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._read = False
+        self._last_event_id: str | None = None
 
-    def send_message(self, message: dict, message_id: str) -> None:
-        self._sqs.send_message(
-            QueueUrl=self._queue_url,
-            MessageBody=json.dumps(message),
-            MessageDeduplicationId=message_id,
-            # use single message processor for now
-            MessageGroupId='1'
-        )
+    def get_last_event_id(self) -> str | None:
+        self._last_event_id = self._get()
+        self._read = True
+        return self._last_event_id
+
+    def put_last_event_id(self, event_id: str) -> None:
+        if not self._read:
+            self._put(event_id)
+            self._last_event_id = event_id
+        elif not self.compare_and_set(self._last_event_id, event_id):
+            raise CheckpointConflictException(self.name)
+
+    def compare_and_set(self, expected_event_id: str | None, event_id: str) -> bool:
+        """Replaces the id if it still is the expected one, None if there is
+        none yet, and returns whether it did
+        """
+
+        if not self._compare_and_set(expected_event_id, event_id):
+            return False
+        self._read = True
+        self._last_event_id = event_id
+        return True
+
+    @abstractmethod
+    def _get(self) -> str | None:
+        pass
+
+    @abstractmethod
+    def _put(self, event_id: str) -> None:
+        pass
+
+    @abstractmethod
+    def _compare_and_set(self, expected_event_id: str | None, event_id: str) -> bool:
+        pass
 
 
-class LastProcessedEventIdRepo:
+class LastProcessedEventIdRepo(CheckpointStore):
+    """Keeps the feed position in a versioned S3 object
+
+    Conditional writes match the ETag of the object as it was read or written.
+    """
+
     def __init__(self, s3, bucket: str, key: str):
+        super().__init__('s3://{}/{}'.format(bucket, key))
         self._s3 = s3
         self._bucket = bucket
         self._key = key
+        # the ETag of the object with this id
+        self._etag: tuple[str | None, str] | None = None
 
-    def get_last_event_id(self) -> str | None:
+    def _get(self) -> str | None:
         try:
             s3_object = self._s3.get_object(Bucket=self._bucket, Key=self._key)
-            return s3_object['Body'].read().decode('utf-8')
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchKey':
                 # no id exists yet, so return None
+                self._etag = None
                 return None
             else:
                 # otherwise raise the error
                 raise e
+        event_id = s3_object['Body'].read().decode('utf-8')
+        if 'ETag' in s3_object:
+            self._etag = (event_id, s3_object['ETag'])
+        return event_id
+
+    def _put(self, event_id: str) -> None:
+        self._write(event_id, {})
+
+    def _compare_and_set(self, expected_event_id: str | None, event_id: str) -> bool:
+        if expected_event_id is None:
+            condition = {'IfNoneMatch': '*'}
+        else:
+            if self._etag is None or self._etag[0] != expected_event_id:
+                if self._get() != expected_event_id or self._etag is None:
+                    return False
+            condition = {'IfMatch': self._etag[1]}
 
-    def put_last_event_id(self, event_id: str):
-        self._s3.put_object(
+        try:
+            self._write(event_id, condition)
+            return True
+        except ClientError as e:
+            # 409 if another conditional write to the object is in progress
+            if e.response['Error']['Code'] in ('PreconditionFailed',
+                                               'ConditionalRequestConflict'):
+                self._etag = None
+                return False
+            else:
+                raise e
+
+    def _write(self, event_id: str, condition: dict[str, str]) -> None:
+        response = self._s3.put_object(
             Body=event_id,
             Bucket=self._bucket,
-            Key=self._key
+            Key=self._key,
+            **condition
         )
+        self._etag = (event_id, response['ETag']) if 'ETag' in response else None
+
+
+class DynamoDBCheckpointStore(CheckpointStore):
+    """Keeps the feed position in a DynamoDB table with the string hash key
+    'feed', which has single-digit millisecond reads and conditional writes
+    """
+
+    def __init__(self, dynamodb, table_name: str, feed_key: str):
+        super().__init__('dynamodb://{}/{}'.format(table_name, feed_key))
+        self._dynamodb = dynamodb
+        self._table_name = table_name
+        self._feed_key = feed_key
+
+    def _get(self) -> str | None:
+        response = self._dynamodb.get_item(
+            TableName=self._table_name,
+            Key={'feed': {'S': self._feed_key}},
+            ConsistentRead=True)
+        return response['Item']['event_id']['S'] if 'Item' in response else None
+
+    def _put(self, event_id: str) -> None:
+        self._dynamodb.put_item(TableName=self._table_name, Item=self._item(event_id))
+
+    def _compare_and_set(self, expected_event_id: str | None, event_id: str) -> bool:
+        if expected_event_id is None:
+            condition = {'ConditionExpression': 'attribute_not_exists(feed)'}
+        else:
+            condition = {'ConditionExpression': 'event_id = :expected',
+                         'ExpressionAttributeValues': {':expected': {'S': expected_event_id}}}
+        try:
+            self._dynamodb.put_item(TableName=self._table_name,
+                                    Item=self._item(event_id), **condition)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            else:
+                raise e
+
+    def _item(self, event_id: str) -> dict:
+        return {'feed': {'S': self._feed_key}, 'event_id': {'S': event_id}}
+
+
+class FileCheckpointStore(CheckpointStore):
+    """Keeps the feed position in a local file, e.g. when poll_feed runs as a
+    long-lived process instead of a Lambda function
+
+    Writes replace the file atomically, and an exclusive lock on a lock file
+    next to it makes compare and set atomic across processes.
+    """
+
+    def __init__(self, file_name: str):
+        super().__init__(file_name)
+        self._file_name = file_name
+        self._lock = threading.Lock()
+
+    def _get(self) -> str | None:
+        try:
+            with open(self._file_name, encoding='utf-8') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def _put(self, event_id: str) -> None:
+        with self._locked():
+            self._write(event_id)
+
+    def _compare_and_set(self, expected_event_id: str | None, event_id: str) -> bool:
+        with self._locked():
+            if self._get() != expected_event_id:
+                return False
+            self._write(event_id)
+            return True
+
+    @contextmanager
+    def _locked(self):
+        # imported on first use, as only this store needs it
+        import fcntl
+        os.makedirs(os.path.dirname(os.path.abspath(self._file_name)), exist_ok=True)
+        with self._lock, open(self._file_name + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, event_id: str) -> None:
+        temporary_file_name = '{}.{}.tmp'.format(self._file_name, os.getpid())
+        with open(temporary_file_name, 'w', encoding='utf-8') as file:
+            file.write(event_id)
+        os.replace(temporary_file_name, self._file_name)
+
+
+class InMemoryCheckpointStore(CheckpointStore):
+    """Keeps the feed position in memory, e.g. for tests
+
+    Stores which share their values behave like runs sharing a backend.
+    """
+
+    def __init__(self, feed_key: str = 'last_event_id', values: dict[str, str] | None = None):
+        super().__init__(feed_key)
+        self._feed_key = feed_key
+        self.values = {} if values is None else values
+        self._lock = threading.Lock()
+
+    def _get(self) -> str | None:
+        with self._lock:
+            return self.values.get(self._feed_key)
+
+    def _put(self, event_id: str) -> None:
+        with self._lock:
+            self.values[self._feed_key] = event_id
+
+    def _compare_and_set(self, expected_event_id: str | None, event_id: str) -> bool:
+        with self._lock:
+            if self.values.get(self._feed_key) != expected_event_id:
+                return False
+            self.values[self._feed_key] = event_id
+            return True
 
 
 class DMMEventsClient:
-    def __init__(self, base_url: str, api_key: str):
+    def __init__(self, base_url: str, api_key: str,
+        session: HttpSession | None = None,
+        refresh_api_key: Callable[[], str] | None = None,
+        circuit_breaker: CircuitBreaker | None = None):
         self._base_url = base_url
         self._api_key = api_key
+        self._session = session or shared_http_session()
+        self._refresh_api_key = refresh_api_key
+        self._circuit_breaker = circuit_breaker
 
     def get_events(
         self,
         last_event_id: str | None
     ) -> list[DMMEvent]:
-        response = requests.get(
-            url=self._events_url(last_event_id),
-            headers={
-                'x-api-key': self._api_key,
-                'accept': 'application/cloudevents-batch+json'
-            })
+        def get() -> HttpResponse:
+            return self._session.get(
+                url=self._events_url(last_event_id),
+                headers={
+                    'x-api-key': self._api_key,
+                    'accept': 'application/cloudevents-batch+json'
+                })
+
+        def authorized_get() -> HttpResponse:
+            response = get()
+            if response.status_code in (401, 403) and self._refresh_api_key_changed():
+                response = get()
+            return response
+
+        if self._circuit_breaker is None:
+            response = authorized_get()
+        else:
+            response = self._circuit_breaker.call(
+                authorized_get,
+                is_failure=lambda r: r.status_code >= 500 or r.status_code == 429)
         response.raise_for_status()
         return response.json()
 
+    def _refresh_api_key_changed(self) -> bool:
+        # the api key might have been rotated since it was read
+        if self._refresh_api_key is None:
+            return False
+        api_key = self._refresh_api_key()
+        if api_key == self._api_key:
+            return False
+        log.warning('DMM rejected the api key, retrying with the rotated one')
+        self._api_key = api_key
+        return True
+
     def _events_url(self, last_event_id: str | None) -> str:
         events_url = '{}/api/events'.format(self._base_url)
 
@@ -118,48 +609,144 @@ class DMMEventsClient:
                                                  id=last_event_id)
 
 
-class Secrets:
-    def __init__(self, secretsmanager):
-        self._secretsmanager = secretsmanager
-
-    def get_secret(self, secret_name: str) -> str:
-        get_secret_value_response = \
-            self._secretsmanager.get_secret_value(SecretId=secret_name)
-
-        return get_secret_value_response['SecretString']
-
-
 class FeedProcessor:
+    # the maximum number of entries of a SendMessageBatch request
+    _messages_per_batch = 10
+    # events of these types change the document with the id of their data,
+    # by the path of its kind in the api of Data Mesh Manager
+    _invalidating_event_types = {
+        'com.datamesh-manager.events.DataProduct': 'dataproducts',
+        'com.datamesh-manager.events.DataUsageAgreement': 'datausageagreements'}
+
     def __init__(
         self,
         last_processed_event_id_repo: LastProcessedEventIdRepo,
         dmm_events_client: DMMEventsClient,
-        target_queue_client: TargetQueueClient
+        target_queue_client: TargetQueueClient,
+        metrics: Metrics | None = None,
+        clock: Callable[[], float] = time.time,
+        feed_name: str | None = None
     ):
         self._last_processed_event_id_repo = last_processed_event_id_repo
         self._dmm_events_client = dmm_events_client
         self._target_queue_client = target_queue_client
-
-    def process_new_events(self) -> None:
+        self._metrics = metrics or shared_metrics()
+        self._clock = clock
+        self._feed_name = feed_name
+        # the metrics of the feeds of several organizations are kept apart
+        self._feed_dimensions = {} if feed_name is None else {'Feed': feed_name}
+
+    def process_new_events(self, deadline: float | None = None) -> bool:
+        """Sends all new events to the queue and returns whether the feed was
+        drained
+
+        A page is only fetched and processed if it is expected to be done
+        before the deadline, which is given in the time of the clock.
+        Otherwise it is left for the next run.
+        """
+
+        started_at = self._clock()
         last_event_id = self._last_processed_event_id_repo.get_last_event_id()
-        logging.info('Starting from event {}'.format(last_event_id))
+        log.info('Starting from event %s', last_event_id)
+        pages = 0
+        processed_events = 0
+        page_seconds = 0.0
         while True:
-            elements = self._dmm_events_client.get_events(last_event_id)
+            page_started_at = self._clock()
+            if deadline is not None and page_started_at + page_seconds > deadline:
+                drained = False
+                break
+            with self._metrics.timer('DMMCallLatency', self._dimensions(Method='GetEvents'),
+                                     error_metric='DMMCallErrors'):
+                elements = self._dmm_events_client.get_events(last_event_id)
+            polled_at = self._clock()
+            self._metrics.put('FeedPageSize', len(elements), 'Count', self._dimensions())
+            if pages == 0:
+                self._put_lag('FeedLag', elements, polled_at)
             if len(elements) == 0:
+                drained = True
                 break
-            else:
-                last_event_id = self._process_batch(elements)
-
-    # todo: process batches of 10 elements to reduce iops
-    def _process_batch(self, elements: list[DMMEvent]) -> str | None:
+            self._metrics.count('EventsFetched', len(elements), self._dimensions())
+            last_event_id = self._process_batch(elements, polled_at)
+            pages += 1
+            processed_events += len(elements)
+            page_seconds = self._clock() - page_started_at
+
+        self._put_run_metrics(started_at, pages, processed_events, drained)
+        return drained
+
+    def _put_run_metrics(self, started_at: float, pages: int, processed_events: int,
+        drained: bool) -> None:
+        finished_at = self._clock()
+        self._metrics.put('FeedPages', pages, 'Count', self._dimensions())
+        if finished_at > started_at:
+            self._metrics.put('EventsPerSecond', processed_events / (finished_at - started_at),
+                              'Count/Second', self._dimensions())
+        # a run which stops at the deadline does not fetch the next page, so
+        # what is left is only known to the next run, which records its FeedLag
+        self._metrics.count('FeedRuns', 1,
+                            self._dimensions(Result='drained' if drained else 'deadline'))
+        log.info('Processed %s events in %s pages, %s', processed_events, pages,
+                 'the feed is drained' if drained else 'stopped at the deadline')
+
+    def _put_lag(self, name: str, elements: list[DMMEvent], now: float) -> None:
+        # the age of the oldest event which is not processed yet
+        if len(elements) == 0:
+            self._metrics.put(name, 0, 'Milliseconds', self._dimensions())
+            return
+        time_of_event = event_time(elements[0])
+        if time_of_event is not None:
+            self._metrics.put(name, (now - time_of_event.timestamp()) * 1000, 'Milliseconds',
+                              self._dimensions())
+
+    def _process_batch(self, elements: list[DMMEvent], polled_at: float) -> str | None:
+        # messages are sent and checkpointed in batches, a batch which failed
+        # is sent again by the next run and deduplicated by the consumer
         element_id = None
-        for element in elements:
-            element_id = element['id']
-            self._process_element(element, element_id)
+        for start in range(0, len(elements), self._messages_per_batch):
+            batch = elements[start:start + self._messages_per_batch]
+            self._process_elements(batch, polled_at)
+            element_id = batch[-1]['id']
         return element_id
 
-    def _process_element(self, element: DMMEvent, element_id: str) -> None:
-        logging.info('Processing event {}'.format(element_id))
-        self._target_queue_client.send_message(element, element_id)
-        self._last_processed_event_id_repo.put_last_event_id(element_id)
-        logging.info('Processed event {}'.format(element_id))
+    def _process_elements(self, elements: list[DMMEvent], polled_at: float) -> None:
+        # lets manage_iam_policies trace the events from their creation
+        enqueued_at = self._clock()
+        messages = [(element, element['id'], self._trace_context(element, polled_at, enqueued_at))
+                    for element in elements]
+        with self._metrics.timer('SQSSendLatency', self._dimensions(),
+                                 error_metric='SQSSendErrors'):
+            self._target_queue_client.send_messages(messages)
+        self._metrics.count('EventsEnqueued', len(elements), self._dimensions())
+        with self._metrics.timer('CheckpointWriteLatency', self._dimensions(),
+                                 error_metric='CheckpointWriteErrors'):
+            self._last_processed_event_id_repo.put_last_event_id(elements[-1]['id'])
+        for element in elements:
+            with log_context(event_id=element['id']):
+                event_log.info('Processed event %s', element.get('type'))
+
+    def _dimensions(self, **dimensions: str) -> dict[str, str]:
+        return {**self._feed_dimensions, **dimensions}
+
+    def _trace_context(self, element: DMMEvent, polled_at: float,
+        enqueued_at: float) -> dict[str, str | float | None]:
+        trace_context = {'dmm-event-time': element.get('time'),
+                         'dmm-poll-time': polled_at,
+                         'dmm-enqueue-time': enqueued_at}
+        if self._feed_name is not None:
+            # lets manage_iam_policies call the organization of the event
+            trace_context['dmm-feed'] = self._feed_name
+        invalidated_document = self._invalidated_document(element)
+        if invalidated_document is not None:
+            # lets manage_iam_policies drop the document from its cache
+            trace_context['dmm-invalidates'] = invalidated_document
+        return trace_context
+
+    def _invalidated_document(self, element: DMMEvent) -> str | None:
+        data_id = (element.get('data') or {}).get('id')
+        if data_id is None:
+            return None
+        for prefix, path in self._invalidating_event_types.items():
+            if element.get('type', '').startswith(prefix):
+                return '{}/{}'.format(path, data_id)
+        return None
@@ -1,21 +1,35 @@
 import json
+import os
+import sys
+import tempfile
+import threading
 import unittest
 from io import BytesIO
 from unittest import TestCase
-from unittest.mock import sentinel, patch, call, Mock
+from unittest.mock import sentinel, patch, call, Mock, ANY
 
 import boto3
 from botocore.response import StreamingBody
 from botocore.stub import Stubber
 
+# the shared module is next to the handler in the bundle, in src/common otherwise
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+
+from call_accounting import CallAccounting  # noqa: E402
+from dmm_common import DMMEvent, HttpSession, aws_client, shared_http_session, \
+    shared_secret_cache, CircuitOpenException, Metrics, InMemoryMetricsSink, \
+    Feed  # noqa: E402
 from lambda_handler import TargetQueueClient, LastProcessedEventIdRepo, \
-    DMMEventsClient, Secrets, FeedProcessor, DMMEvent
+    DMMEventsClient, FeedProcessor, reset_warm_container, \
+    SendMessageBatchException, poll_feeds, shared_circuit_breaker, \
+    CheckpointConflictException, CheckpointStore, DynamoDBCheckpointStore, \
+    FileCheckpointStore, InMemoryCheckpointStore, checkpoint_store  # noqa: E402
 
 
 class TestTargetQueueClient(TestCase):
 
     def setUp(self) -> None:
-        self._queue_url = 'a_queue_url'
+        self._queue_url = 'a_queue_url.fifo'
 
         sqs = boto3.client('sqs')
 
@@ -44,6 +58,178 @@ class TestTargetQueueClient(TestCase):
 
         self._queue_client.send_message(message, message_id)
 
+    def test_send_message__message_group_of_feed(self) -> None:
+        sqs = boto3.client('sqs')
+        sqs_stubber = Stubber(sqs)
+        queue_client = TargetQueueClient(sqs, self._queue_url, message_group_id='org-a')
+        sqs_stubber.add_response(
+            'send_message', {},
+            {'QueueUrl': self._queue_url,
+             'MessageBody': json.dumps({'id': '1'}),
+             'MessageDeduplicationId': '1',
+             'MessageGroupId': 'org-a'})
+        sqs_stubber.activate()
+
+        queue_client.send_message({'id': '1'}, '1')
+
+        sqs_stubber.assert_no_pending_responses()
+
+    def test_send_message__standard_queue(self) -> None:
+        sqs = boto3.client('sqs')
+        sqs_stubber = Stubber(sqs)
+        queue_client = TargetQueueClient(sqs, 'a_standard_queue_url')
+
+        message = {'hello': 'world'}
+        sqs_stubber.add_response(
+            'send_message',
+            {},
+            {'QueueUrl': 'a_standard_queue_url', 'MessageBody': json.dumps(message)}
+        )
+        sqs_stubber.activate()
+
+        queue_client.send_message(message, '123')
+
+        sqs_stubber.assert_no_pending_responses()
+
+    def test_send_message__trace_context(self) -> None:
+        message = {'hello': 'world'}
+        self._sqs_stubber.add_response(
+            'send_message', {},
+            {'QueueUrl': self._queue_url,
+             'MessageBody': json.dumps(message),
+             'MessageAttributes': {
+                 'dmm-event-time': {'DataType': 'String',
+                                    'StringValue': '2023-07-06T12:00:00Z'},
+                 'dmm-poll-time': {'DataType': 'Number', 'StringValue': '1500'}},
+             'MessageDeduplicationId': '123',
+             'MessageGroupId': '1'})
+        self._sqs_stubber.activate()
+
+        self._queue_client.send_message(message, '123', {
+            'dmm-event-time': '2023-07-06T12:00:00Z',
+            'dmm-poll-time': 1.5,
+            'dmm-enqueue-time': None})
+
+        self._sqs_stubber.assert_no_pending_responses()
+
+    def test_send_message__priority_queue(self) -> None:
+        sqs = boto3.client('sqs')
+        sqs_stubber = Stubber(sqs)
+        queue_client = TargetQueueClient(sqs, 'a_queue_url.fifo',
+                                         'a_priority_queue_url.fifo')
+
+        deactivated = {
+            'id': '1',
+            'type': 'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent'
+        }
+        activated = {
+            'id': '2',
+            'type': 'com.datamesh-manager.events.DataUsageAgreementActivatedEvent'
+        }
+        sqs_stubber.add_response(
+            'send_message', {},
+            {'QueueUrl': 'a_priority_queue_url.fifo',
+             'MessageBody': json.dumps(deactivated),
+             'MessageDeduplicationId': '1',
+             'MessageGroupId': '1'})
+        sqs_stubber.add_response(
+            'send_message', {},
+            {'QueueUrl': 'a_queue_url.fifo',
+             'MessageBody': json.dumps(activated),
+             'MessageDeduplicationId': '2',
+             'MessageGroupId': '1'})
+        sqs_stubber.activate()
+
+        queue_client.send_message(deactivated, '1')
+        queue_client.send_message(activated, '2')
+
+        sqs_stubber.assert_no_pending_responses()
+
+    def test_send_messages__fifo_queue_one_by_one(self) -> None:
+        for message_id in ('1', '2'):
+            self._sqs_stubber.add_response(
+                'send_message', {},
+                {'QueueUrl': self._queue_url,
+                 'MessageBody': json.dumps({'id': message_id}),
+                 'MessageDeduplicationId': message_id,
+                 'MessageGroupId': '1'})
+        self._sqs_stubber.activate()
+
+        self._queue_client.send_messages([({'id': '1'}, '1', None), ({'id': '2'}, '2', None)])
+
+        self._sqs_stubber.assert_no_pending_responses()
+
+    def test_send_messages__standard_queue_in_batches(self) -> None:
+        sqs = boto3.client('sqs')
+        sqs_stubber = Stubber(sqs)
+        queue_client = TargetQueueClient(sqs, 'a_standard_queue_url')
+        messages = [({'id': str(i)}, str(i), None) for i in range(12)]
+        for start, end in ((0, 10), (10, 12)):
+            sqs_stubber.add_response(
+                'send_message_batch', {'Successful': [], 'Failed': []},
+                {'QueueUrl': 'a_standard_queue_url',
+                 'Entries': [{'Id': str(i - start), 'MessageBody': json.dumps({'id': str(i)})}
+                             for i in range(start, end)]})
+        sqs_stubber.activate()
+
+        queue_client.send_messages(messages)
+
+        sqs_stubber.assert_no_pending_responses()
+
+    def test_send_messages__failed_entries_sent_again(self) -> None:
+        sqs = boto3.client('sqs')
+        sqs_stubber = Stubber(sqs)
+        sleep = Mock()
+        queue_client = TargetQueueClient(sqs, 'a_standard_queue_url', sleep=sleep)
+        sqs_stubber.add_response(
+            'send_message_batch',
+            {'Successful': [{'Id': '0', 'MessageId': 'm0', 'MD5OfMessageBody': 'x'}],
+             'Failed': [{'Id': '1', 'SenderFault': False, 'Code': 'InternalError'}]},
+            {'QueueUrl': 'a_standard_queue_url', 'Entries': ANY})
+        sqs_stubber.add_response(
+            'send_message_batch', {'Successful': [], 'Failed': []},
+            {'QueueUrl': 'a_standard_queue_url',
+             'Entries': [{'Id': '1', 'MessageBody': json.dumps({'id': '1'})}]})
+        sqs_stubber.activate()
+
+        queue_client.send_messages([({'id': '0'}, '0', None), ({'id': '1'}, '1', None)])
+
+        sqs_stubber.assert_no_pending_responses()
+        sleep.assert_called_once()
+
+    def test_send_messages__sender_fault(self) -> None:
+        sqs = boto3.client('sqs')
+        sqs_stubber = Stubber(sqs)
+        queue_client = TargetQueueClient(sqs, 'a_standard_queue_url', sleep=Mock())
+        sqs_stubber.add_response(
+            'send_message_batch',
+            {'Successful': [],
+             'Failed': [{'Id': '0', 'SenderFault': True, 'Code': 'InvalidMessageContents'}]})
+        sqs_stubber.activate()
+
+        with self.assertRaises(SendMessageBatchException) as raised:
+            queue_client.send_messages([({'id': '0'}, '0', None)])
+
+        self.assertEqual('InvalidMessageContents', raised.exception.failed[0]['Code'])
+        sqs_stubber.assert_no_pending_responses()
+
+    def test_send_messages__gives_up(self) -> None:
+        sqs = boto3.client('sqs')
+        sqs_stubber = Stubber(sqs)
+        queue_client = TargetQueueClient(sqs, 'a_standard_queue_url', max_attempts=2,
+                                         sleep=Mock())
+        for _ in range(2):
+            sqs_stubber.add_response(
+                'send_message_batch',
+                {'Successful': [],
+                 'Failed': [{'Id': '0', 'SenderFault': False, 'Code': 'InternalError'}]})
+        sqs_stubber.activate()
+
+        with self.assertRaises(SendMessageBatchException):
+            queue_client.send_messages([({'id': '0'}, '0', None)])
+
+        sqs_stubber.assert_no_pending_responses()
+
 
 class TestLastProcessedEventIdRepo(TestCase):
 
@@ -97,6 +283,213 @@ class TestLastProcessedEventIdRepo(TestCase):
 
         self._repo.put_last_event_id(the_id)
 
+    def _add_get_object(self, event_id: str, etag: str) -> None:
+        self._s3_stubber.add_response(
+            'get_object',
+            {'Body': StreamingBody(BytesIO(event_id.encode('utf-8')), len(event_id)),
+             'ETag': etag},
+            {'Bucket': self._bucket, 'Key': self._key})
+
+    def test_put_last_event_id__matches_etag_of_read(self) -> None:
+        self._add_get_object('an_id', '"etag-1"')
+        self._s3_stubber.add_response(
+            'put_object', {'ETag': '"etag-2"'},
+            {'Body': 'id_2', 'Bucket': self._bucket, 'Key': self._key, 'IfMatch': '"etag-1"'})
+        self._s3_stubber.add_response(
+            'put_object', {'ETag': '"etag-3"'},
+            {'Body': 'id_3', 'Bucket': self._bucket, 'Key': self._key, 'IfMatch': '"etag-2"'})
+        self._s3_stubber.activate()
+
+        self._repo.get_last_event_id()
+        self._repo.put_last_event_id('id_2')
+        self._repo.put_last_event_id('id_3')
+
+        self._s3_stubber.assert_no_pending_responses()
+
+    def test_put_last_event_id__first_id(self) -> None:
+        self._s3_stubber.add_client_error('get_object', 'NoSuchKey')
+        self._s3_stubber.add_response(
+            'put_object', {'ETag': '"etag-1"'},
+            {'Body': 'id_1', 'Bucket': self._bucket, 'Key': self._key, 'IfNoneMatch': '*'})
+        self._s3_stubber.activate()
+
+        self._repo.get_last_event_id()
+        self._repo.put_last_event_id('id_1')
+
+        self._s3_stubber.assert_no_pending_responses()
+
+    def test_put_last_event_id__conflict(self) -> None:
+        self._add_get_object('an_id', '"etag-1"')
+        self._s3_stubber.add_client_error('put_object', 'PreconditionFailed',
+                                          http_status_code=412)
+        self._s3_stubber.activate()
+
+        self._repo.get_last_event_id()
+        with self.assertRaises(CheckpointConflictException):
+            self._repo.put_last_event_id('id_2')
+
+    def test_compare_and_set__reads_etag_of_other_id(self) -> None:
+        self._add_get_object('other_id', '"etag-1"')
+        self._s3_stubber.activate()
+
+        self.assertFalse(self._repo.compare_and_set('an_id', 'id_2'))
+
+
+class TestDynamoDBCheckpointStore(TestCase):
+    _table_name = 'checkpoints'
+
+    def setUp(self) -> None:
+        dynamodb = boto3.client('dynamodb')
+        self._stubber = Stubber(dynamodb)
+        self._store = DynamoDBCheckpointStore(dynamodb, self._table_name, 'poll_feed/last_event_id')
+
+    def tearDown(self) -> None:
+        self._stubber.deactivate()
+
+    def _add_get_item(self, event_id: str | None) -> None:
+        response = {} if event_id is None else {'Item': {
+            'feed': {'S': 'poll_feed/last_event_id'}, 'event_id': {'S': event_id}}}
+        self._stubber.add_response(
+            'get_item', response,
+            {'TableName': self._table_name,
+             'Key': {'feed': {'S': 'poll_feed/last_event_id'}},
+             'ConsistentRead': True})
+
+    def test_get_last_event_id(self) -> None:
+        self._add_get_item('an_id')
+        self._add_get_item(None)
+        self._stubber.activate()
+
+        self.assertEqual('an_id', self._store.get_last_event_id())
+        self.assertIsNone(self._store.get_last_event_id())
+
+    def test_put_last_event_id__conditional(self) -> None:
+        self._add_get_item('an_id')
+        self._stubber.add_response('put_item', {}, {
+            'TableName': self._table_name,
+            'Item': {'feed': {'S': 'poll_feed/last_event_id'}, 'event_id': {'S': 'id_2'}},
+            'ConditionExpression': 'event_id = :expected',
+            'ExpressionAttributeValues': {':expected': {'S': 'an_id'}}})
+        self._stubber.activate()
+
+        self._store.get_last_event_id()
+        self._store.put_last_event_id('id_2')
+
+        self._stubber.assert_no_pending_responses()
+
+    def test_compare_and_set__first_id(self) -> None:
+        self._stubber.add_response('put_item', {}, {
+            'TableName': self._table_name,
+            'Item': {'feed': {'S': 'poll_feed/last_event_id'}, 'event_id': {'S': 'id_1'}},
+            'ConditionExpression': 'attribute_not_exists(feed)'})
+        self._stubber.activate()
+
+        self.assertTrue(self._store.compare_and_set(None, 'id_1'))
+
+    def test_put_last_event_id__conflict(self) -> None:
+        self._add_get_item('an_id')
+        self._stubber.add_client_error('put_item', 'ConditionalCheckFailedException')
+        self._stubber.activate()
+
+        self._store.get_last_event_id()
+        with self.assertRaises(CheckpointConflictException):
+            self._store.put_last_event_id('id_2')
+
+
+class TestFileCheckpointStore(TestCase):
+
+    def setUp(self) -> None:
+        self._directory = tempfile.TemporaryDirectory()
+        self._file_name = os.path.join(self._directory.name, 'poll_feed', 'last_event_id')
+
+    def tearDown(self) -> None:
+        self._directory.cleanup()
+
+    def test_put_last_event_id(self) -> None:
+        store = FileCheckpointStore(self._file_name)
+
+        self.assertIsNone(store.get_last_event_id())
+        store.put_last_event_id('id_1')
+        store.put_last_event_id('id_2')
+
+        self.assertEqual('id_2', FileCheckpointStore(self._file_name).get_last_event_id())
+
+    def test_put_last_event_id__conflict(self) -> None:
+        store = FileCheckpointStore(self._file_name)
+        other_store = FileCheckpointStore(self._file_name)
+        store.get_last_event_id()
+        other_store.get_last_event_id()
+
+        other_store.put_last_event_id('id_1')
+        with self.assertRaises(CheckpointConflictException):
+            store.put_last_event_id('id_2')
+        self.assertEqual('id_1', store.get_last_event_id())
+
+
+class TestInMemoryCheckpointStore(TestCase):
+
+    def test_compare_and_set(self) -> None:
+        store = InMemoryCheckpointStore()
+
+        self.assertTrue(store.compare_and_set(None, 'id_1'))
+        self.assertFalse(store.compare_and_set(None, 'id_2'))
+        self.assertTrue(store.compare_and_set('id_1', 'id_2'))
+        self.assertEqual('id_2', store.get_last_event_id())
+
+    def test_put_last_event_id__conflict(self) -> None:
+        values = {}
+        store = InMemoryCheckpointStore(values=values)
+        other_store = InMemoryCheckpointStore(values=values)
+        store.get_last_event_id()
+        other_store.get_last_event_id()
+
+        store.put_last_event_id('id_1')
+        with self.assertRaises(CheckpointConflictException):
+            other_store.put_last_event_id('id_2')
+
+    def test_put_last_event_id__without_read(self) -> None:
+        store = InMemoryCheckpointStore(values={'last_event_id': 'id_1'})
+
+        store.put_last_event_id('id_2')
+
+        self.assertEqual({'last_event_id': 'id_2'}, store.values)
+
+
+class TestCheckpointStore(TestCase):
+    _feed = Feed(None, 'https://dmm', 'api_key', 'poll_feed/last_event_id')
+
+    def tearDown(self) -> None:
+        reset_warm_container()
+
+    @patch.dict('os.environ', {'bucket_name': 'a_bucket'})
+    def test_checkpoint_store__s3_by_default(self) -> None:
+        self.assertIsInstance(checkpoint_store(self._feed), LastProcessedEventIdRepo)
+
+    @patch.dict('os.environ', {'checkpoint_store': 'dynamodb',
+                               'checkpoint_table_name': 'checkpoints'})
+    def test_checkpoint_store__dynamodb(self) -> None:
+        self.assertIsInstance(checkpoint_store(self._feed), DynamoDBCheckpointStore)
+
+    @patch.dict('os.environ', {'checkpoint_store': 'file', 'checkpoint_directory': '/tmp/dmm'})
+    def test_checkpoint_store__file(self) -> None:
+        store = checkpoint_store(self._feed)
+
+        self.assertIsInstance(store, FileCheckpointStore)
+        self.assertEqual('/tmp/dmm/poll_feed/last_event_id', store.name)
+
+    @patch.dict('os.environ', {'checkpoint_store': 'redis'})
+    def test_checkpoint_store__unknown(self) -> None:
+        with self.assertRaises(ValueError):
+            checkpoint_store(self._feed)
+
+    def test_checkpoint_store__incomplete_backend(self) -> None:
+        class IncompleteCheckpointStore(CheckpointStore):
+            def _get(self) -> str | None:
+                return None
+
+        with self.assertRaises(TypeError):
+            IncompleteCheckpointStore('incomplete')
+
 
 class TestDMMEventsClient(TestCase):
     _base_url = 'https://dmm-url.com'
@@ -109,13 +502,13 @@ class TestDMMEventsClient(TestCase):
     class MockResponse:
         def __init__(self, body, status):
             self._body = body
-            self._status = status
+            self.status_code = status
 
         def json(self) -> str:
             return self._body
 
         def raise_for_status(self) -> None:
-            if self._status >= 400:
+            if self.status_code >= 400:
                 raise Exception()
 
     @staticmethod
@@ -127,7 +520,7 @@ class TestDMMEventsClient(TestCase):
         else:
             return TestDMMEventsClient.MockResponse(None, 200)
 
-    @patch('requests.get',
+    @patch('lambda_handler.HttpSession.get',
            Mock(side_effect=mock_get_events_without_last_event_id))
     def test_get_events_without_last_event_id(self) -> None:
         self.assertEqual(sentinel.expected, self._client.get_events(None))
@@ -145,7 +538,7 @@ class TestDMMEventsClient(TestCase):
         else:
             return TestDMMEventsClient.MockResponse(None, 200)
 
-    @patch('requests.get', Mock(side_effect=mock_get_events_with_last_event_id))
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_events_with_last_event_id))
     def test_get_events_with_last_event_id(self) -> None:
         self.assertEqual(sentinel.expected,
                          self._client.get_events(self._last_event_id))
@@ -157,7 +550,7 @@ class TestDMMEventsClient(TestCase):
         else:
             return TestDMMEventsClient.MockResponse(None, 200)
 
-    @patch('requests.get', Mock(side_effect=mock_get_events_api_key))
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_events_api_key))
     def test_get_events_api_key(self) -> None:
         client = DMMEventsClient(self._base_url, 'wrong api key')
         with self.assertRaises(Exception):
@@ -170,37 +563,99 @@ class TestDMMEventsClient(TestCase):
         else:
             return TestDMMEventsClient.MockResponse(sentinel.expected, 200)
 
-    @patch('requests.get', Mock(side_effect=mock_get_events_accept_header))
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_events_accept_header))
     def test_get_events_accept_header(self) -> None:
         self.assertEqual(sentinel.expected, self._client.get_events(None))
 
+    @patch('lambda_handler.HttpSession.get', Mock())
+    def test_get_events_circuit_open(self) -> None:
+        breaker = Mock()
+        breaker.call.side_effect = CircuitOpenException('dmm')
+        client = DMMEventsClient(self._base_url, self._api_key,
+                                 circuit_breaker=breaker)
+
+        with self.assertRaises(CircuitOpenException):
+            client.get_events(None)
+        HttpSession.get.assert_not_called()
 
-class TestSecrets(TestCase):
-    _secret_name = 'a_name'
-    _secret_value = 'hi!_i_am_secret'
+    @patch('lambda_handler.HttpSession.get', Mock(side_effect=mock_get_events_api_key))
+    def test_get_events_rotated_api_key(self) -> None:
+        client = DMMEventsClient(self._base_url, 'outdated api key',
+                                 refresh_api_key=lambda: self._api_key)
 
-    def setUp(self) -> None:
-        secretsmanager = boto3.client('secretsmanager')
+        client.get_events(None)
+
+        self.assertEqual(2, HttpSession.get.call_count)
 
-        self._secretsmanager_stubber = Stubber(secretsmanager)
-        self._secrets = Secrets(secretsmanager)
+
+class TestWarmContainer(TestCase):
 
     def tearDown(self) -> None:
-        self._secretsmanager_stubber.deactivate()
+        reset_warm_container()
 
-    def test_get_secret(self) -> None:
-        expected_params = {
-            'SecretId': self._secret_name
-        }
-        response = {
-            'SecretString': self._secret_value
-        }
-        self._secretsmanager_stubber.add_response(
-            'get_secret_value', response, expected_params)
-        self._secretsmanager_stubber.activate()
+    def test_reset_warm_container(self) -> None:
+        client = aws_client('sqs')
+        session = shared_http_session()
+        secret_cache = shared_secret_cache()
+
+        reset_warm_container()
+
+        self.assertIsNot(client, aws_client('sqs'))
+        self.assertIsNot(session, shared_http_session())
+        self.assertIsNot(secret_cache, shared_secret_cache())
+
+
+class TestFeeds(TestCase):
+
+    def test_shared_circuit_breaker__per_feed(self) -> None:
+        feed_a = Feed('org-a', 'https://dmm', 'a/api_key')
+        feed_b = Feed('org-b', 'https://dmm', 'b/api_key')
+        try:
+            self.assertIs(shared_circuit_breaker(feed_a), shared_circuit_breaker(feed_a))
+            self.assertIsNot(shared_circuit_breaker(feed_a), shared_circuit_breaker(feed_b))
+        finally:
+            reset_warm_container()
+
+    def test_poll_feeds__single_feed(self) -> None:
+        poll = Mock()
+        feed = Feed(None, 'https://dmm', 'api_key')
+
+        poll_feeds([feed], poll, 160.0)
+
+        poll.assert_called_once_with(feed, 160.0)
+
+    def test_poll_feeds__concurrently(self) -> None:
+        # all feeds have to wait for each other
+        barrier = threading.Barrier(3, timeout=5)
+        poll = Mock(side_effect=lambda feed, deadline: barrier.wait())
+        feeds = [Feed(name, 'https://dmm', 'api_key') for name in ('a', 'b', 'c')]
+
+        poll_feeds(feeds, poll, 160.0, clock=lambda: 100.0)
+
+        self.assertEqual({('a', 160.0), ('b', 160.0), ('c', 160.0)},
+                         {(c.args[0].name, c.args[1]) for c in poll.call_args_list})
 
-        self.assertEqual(self._secret_value,
-                         self._secrets.get_secret(self._secret_name))
+    def test_poll_feeds__deadline_shared_by_rounds(self) -> None:
+        poll = Mock()
+        feeds = [Feed(name, 'https://dmm', 'api_key') for name in ('a', 'b', 'c')]
+
+        poll_feeds(feeds, poll, 160.0, max_concurrency=2, clock=lambda: 100.0)
+
+        self.assertEqual([130.0] * 3, [c.args[1] for c in poll.call_args_list])
+
+    def test_poll_feeds__failed_feed_does_not_stop_others(self) -> None:
+        def poll(feed: Feed, deadline: float | None) -> None:
+            if feed.name == 'a':
+                raise ValueError('unavailable')
+            polled.append(feed.name)
+
+        polled = []
+        feeds = [Feed(name, 'https://dmm', 'api_key') for name in ('a', 'b', 'c')]
+
+        with self.assertRaises(ValueError), self.assertLogs('poll_feed', 'ERROR'):
+            poll_feeds(feeds, poll, None, max_concurrency=1)
+
+        self.assertEqual(['b', 'c'], polled)
 
 
 class TestFeedProcessor(TestCase):
@@ -250,26 +705,23 @@ class TestFeedProcessor(TestCase):
     def test_process_new_events__sends_message(self) -> None:
         self._feed_processor.process_new_events()
 
-        self._target_queue_client_mock.send_message \
-            .assert_has_calls([call(self._event_1, self._id_1),
-                               call(self._event_2, self._id_2)])
+        self._target_queue_client_mock.send_messages.assert_called_once_with(
+            [(self._event_1, self._id_1, ANY), (self._event_2, self._id_2, ANY)])
 
     def test_process_new_events__put_last_event_id(self) -> None:
         self._feed_processor.process_new_events()
 
         self._last_processed_event_id_repo_mock.put_last_event_id \
-            .assert_has_calls([call(self._id_1), call(self._id_2)])
+            .assert_called_once_with(self._id_2)
 
     def test_process_new_events__order_of_calls(self) -> None:
-        expected = ['send_message {}'.format(self._id_1),
-                    'event_id {}'.format(self._id_1),
-                    'send_message {}'.format(self._id_2),
+        expected = ['send_messages {},{}'.format(self._id_1, self._id_2),
                     'event_id {}'.format(self._id_2)]
         result = []
 
         self._target_queue_client_mock \
-            .send_message.side_effect = lambda m, i: \
-            result.append('send_message {}'.format(i))
+            .send_messages.side_effect = lambda messages: \
+            result.append('send_messages {}'.format(','.join(i for _, i, _ in messages)))
 
         self._last_processed_event_id_repo_mock \
             .put_last_event_id.side_effect = lambda i: \
@@ -289,6 +741,249 @@ class TestFeedProcessor(TestCase):
         self._last_processed_event_id_repo_mock.put_last_event_id \
             .assert_not_called()
 
+    def test_process_new_events__trace_context(self) -> None:
+        event = {'id': '1', 'time': '2023-07-06T12:00:00Z'}
+        self._dmm_events_client_mock.get_events = \
+            lambda last_event_id: [event] if last_event_id is None else []
+        feed_processor = FeedProcessor(
+            self._last_processed_event_id_repo_mock,
+            self._dmm_events_client_mock,
+            self._target_queue_client_mock,
+            clock=lambda: 100.0)
+
+        feed_processor.process_new_events()
+
+        self._target_queue_client_mock.send_messages.assert_called_once_with(
+            [(event, '1', {'dmm-event-time': '2023-07-06T12:00:00Z',
+                           'dmm-poll-time': 100.0,
+                           'dmm-enqueue-time': 100.0})])
+
+    def test_process_new_events__feed_name(self) -> None:
+        self._dmm_events_client_mock.get_events = \
+            lambda last_event_id: [{'id': '1'}] if last_event_id is None else []
+        feed_processor = FeedProcessor(
+            self._last_processed_event_id_repo_mock,
+            self._dmm_events_client_mock,
+            self._target_queue_client_mock,
+            feed_name='org-a')
+
+        feed_processor.process_new_events()
+
+        messages = self._target_queue_client_mock.send_messages.call_args.args[0]
+        self.assertEqual('org-a', messages[0][2]['dmm-feed'])
+
+    def test_process_new_events__invalidated_documents(self) -> None:
+        events = [
+            {'id': '1', 'type': 'com.datamesh-manager.events.DataProductUpdatedEvent',
+             'data': {'id': 'p1'}},
+            {'id': '2', 'type': 'com.datamesh-manager.events.DataUsageAgreementActivatedEvent',
+             'data': {'id': 'a1'}},
+            {'id': '3', 'type': 'com.datamesh-manager.events.TeamUpdatedEvent',
+             'data': {'id': 't1'}},
+            {'id': '4', 'type': 'com.datamesh-manager.events.DataProductDeletedEvent'}]
+        self._dmm_events_client_mock.get_events = \
+            lambda last_event_id: events if last_event_id is None else []
+
+        self._feed_processor.process_new_events()
+
+        messages = self._target_queue_client_mock.send_messages.call_args.args[0]
+        self.assertEqual(['dataproducts/p1', 'datausageagreements/a1', None, None],
+                         [trace_context.get('dmm-invalidates')
+                          for _, _, trace_context in messages])
+
+    def _paged_feed(self) -> None:
+        pages = {None: [{'id': '1', 'time': '1970-01-01T00:00:01Z'}],
+                 '1': [{'id': '2', 'time': '1970-01-01T00:00:02Z'}],
+                 '2': []}
+        self._dmm_events_client_mock.get_events = Mock(
+            side_effect=lambda last_event_id: pages[last_event_id])
+
+    def test_process_new_events__stops_at_deadline(self) -> None:
+        self._paged_feed()
+        sink = InMemoryMetricsSink()
+        metrics = Metrics(sink=sink)
+        now = [0.0]
+
+        def send_messages(*args) -> None:
+            now[0] += 10
+        self._target_queue_client_mock.send_messages.side_effect = send_messages
+        feed_processor = FeedProcessor(
+            self._last_processed_event_id_repo_mock,
+            self._dmm_events_client_mock,
+            self._target_queue_client_mock,
+            metrics,
+            clock=lambda: now[0])
+
+        self.assertFalse(feed_processor.process_new_events(deadline=15))
+        metrics.flush()
+
+        self._last_processed_event_id_repo_mock.put_last_event_id \
+            .assert_called_once_with('1')
+        # the next page would not be done in time, so it is not fetched
+        self._dmm_events_client_mock.get_events.assert_called_once_with(None)
+        self.assertEqual([1], sink.values('FeedPages'))
+        self.assertEqual([1], sink.values('FeedRuns', {'Result': 'deadline'}))
+
+    def test_process_new_events__deadline_before_first_page(self) -> None:
+        self._paged_feed()
+        sink = InMemoryMetricsSink()
+        metrics = Metrics(sink=sink)
+        feed_processor = FeedProcessor(
+            self._last_processed_event_id_repo_mock,
+            self._dmm_events_client_mock,
+            self._target_queue_client_mock,
+            metrics,
+            clock=lambda: 20.0)
+
+        self.assertFalse(feed_processor.process_new_events(deadline=15))
+        metrics.flush()
+
+        self._dmm_events_client_mock.get_events.assert_not_called()
+        self.assertEqual([0], sink.values('FeedPages'))
+
+    def test_process_new_events__drains_feed(self) -> None:
+        self._paged_feed()
+        sink = InMemoryMetricsSink()
+        metrics = Metrics(sink=sink)
+        now = [10.0]
+
+        def send_messages(*args) -> None:
+            now[0] += 1
+        self._target_queue_client_mock.send_messages.side_effect = send_messages
+        feed_processor = FeedProcessor(
+            self._last_processed_event_id_repo_mock,
+            self._dmm_events_client_mock,
+            self._target_queue_client_mock,
+            metrics,
+            clock=lambda: now[0])
+
+        self.assertTrue(feed_processor.process_new_events(deadline=100))
+        metrics.flush()
+
+        self.assertEqual([9000], sink.values('FeedLag'))
+        self.assertEqual([2], sink.values('FeedPages'))
+        self.assertEqual([1], sink.values('EventsPerSecond'))
+        self.assertEqual([1], sink.values('FeedRuns', {'Result': 'drained'}))
+
+    def test_process_new_events__metrics(self) -> None:
+        sink = InMemoryMetricsSink()
+        metrics = Metrics(sink=sink)
+        feed_processor = FeedProcessor(
+            self._last_processed_event_id_repo_mock,
+            self._dmm_events_client_mock,
+            self._target_queue_client_mock,
+            metrics)
+
+        feed_processor.process_new_events()
+        metrics.flush()
+
+        self.assertEqual([2], sink.values('EventsFetched'))
+        self.assertEqual([2], sink.values('EventsEnqueued'))
+        self.assertEqual([2, 0], sink.values('FeedPageSize'))
+        self.assertEqual(2, len(sink.values('DMMCallLatency', {'Method': 'GetEvents'})))
+        self.assertEqual(1, len(sink.values('SQSSendLatency')))
+        self.assertEqual(1, len(sink.values('CheckpointWriteLatency')))
+
+    def test_process_new_events__metrics_of_a_feed(self) -> None:
+        sink = InMemoryMetricsSink()
+        metrics = Metrics(sink=sink)
+        feed_processor = FeedProcessor(
+            self._last_processed_event_id_repo_mock,
+            self._dmm_events_client_mock,
+            self._target_queue_client_mock,
+            metrics,
+            feed_name='org-a')
+
+        feed_processor.process_new_events()
+        metrics.flush()
+
+        self.assertEqual([2], sink.values('EventsFetched', {'Feed': 'org-a'}))
+        self.assertEqual([2], sink.values('EventsEnqueued', {'Feed': 'org-a'}))
+        self.assertEqual([1], sink.values('FeedPages', {'Feed': 'org-a'}))
+        self.assertEqual([1], sink.values('FeedRuns', {'Feed': 'org-a', 'Result': 'drained'}))
+        self.assertEqual(2, len(sink.values('DMMCallLatency',
+                                            {'Feed': 'org-a', 'Method': 'GetEvents'})))
+
+    def test_process_new_events__batches_of_ten(self) -> None:
+        events = [{'id': str(i)} for i in range(25)]
+        self._dmm_events_client_mock.get_events = \
+            lambda last_event_id: events if last_event_id is None else []
+
+        self._feed_processor.process_new_events()
+
+        self.assertEqual([10, 10, 5], [len(c.args[0]) for c in
+                                       self._target_queue_client_mock.send_messages.call_args_list])
+        self._last_processed_event_id_repo_mock.put_last_event_id \
+            .assert_has_calls([call('9'), call('19'), call('24')])
+
+
+class TestCallBudgets(TestCase):
+    """Remote calls per event of polling the feed, so that additional calls,
+    e.g. a checkpoint per event instead of per batch, fail here
+    """
+
+    def setUp(self) -> None:
+        self._accounting = CallAccounting()
+        self._metrics = Metrics(sink=InMemoryMetricsSink())
+        self._events = [{'id': str(index),
+                         'type': 'com.datamesh-manager.events.DataUsageAgreementActivatedEvent',
+                         'data': {'id': 'a{}'.format(index)}}
+                        for index in range(1, 26)]
+
+    def _process_new_events(self, queue_url: str = 'a_queue_url.fifo',
+        checkpoint: LastProcessedEventIdRepo | None = None, page_size: int = 100) -> None:
+        s3 = self._accounting.aws_client('s3', {
+            'GetObject': lambda: {'Body': StreamingBody(BytesIO(b'0'), 1), 'ETag': '"0"'},
+            'PutObject': {'ETag': '"1"'}})
+        feed_processor = FeedProcessor(
+            checkpoint or LastProcessedEventIdRepo(s3, 'bucket', 'last_event_id'),
+            DMMEventsClient('https://dmm-url.com', 'supersecret',
+                            session=self._accounting.dmm_feed_session(self._events, page_size)),
+            TargetQueueClient(self._accounting.aws_client('sqs'), queue_url),
+            self._metrics)
+
+        self.assertTrue(feed_processor.process_new_events())
+
+    def test_fifo_queue(self) -> None:
+        self._process_new_events()
+
+        # one checkpoint per batch of 10 events, besides one read and one empty page per run
+        self.assertEqual({}, self._accounting.over_budget(25, {
+            'dmm.GetEvents': 2 / 25, 's3.GetObject': 1 / 25, 's3.PutObject': 3 / 25,
+            'sqs.SendMessage': 1}))
+
+    def test_standard_queue(self) -> None:
+        self._process_new_events('a_queue_url')
+
+        self.assertEqual({}, self._accounting.over_budget(25, {
+            'dmm.GetEvents': 2 / 25, 's3.GetObject': 1 / 25, 's3.PutObject': 3 / 25,
+            'sqs.SendMessageBatch': 3 / 25}))
+
+    def test_pages(self) -> None:
+        self._process_new_events(page_size=10)
+
+        self.assertEqual({}, self._accounting.over_budget(25, {
+            'dmm.GetEvents': 4 / 25, 's3.GetObject': 1 / 25, 's3.PutObject': 3 / 25,
+            'sqs.SendMessage': 1}))
+
+    def test_dynamodb_checkpoint(self) -> None:
+        dynamodb = self._accounting.aws_client('dynamodb')
+        self._process_new_events(
+            checkpoint=DynamoDBCheckpointStore(dynamodb, 'checkpoints', 'last_event_id'))
+
+        self.assertEqual({}, self._accounting.over_budget(25, {
+            'dmm.GetEvents': 2 / 25, 'dynamodb.GetItem': 1 / 25, 'dynamodb.PutItem': 3 / 25,
+            'sqs.SendMessage': 1}))
+
+    def test_over_budget(self) -> None:
+        self._accounting.calls.update({'dmm.GetEvents': 3, 'sqs.SendMessage': 1,
+                                       's3.PutObject': 2})
+
+        self.assertEqual({'dmm': 3, 's3': 2},
+                         self._accounting.over_budget(2, {'dmm': 1, 'sqs': 1}))
+        self.assertEqual({}, self._accounting.over_budget(2, {'dmm.GetEvents': 1.5,
+                                                              'sqs': 0.5, 's3': 1}))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,70 @@
+# create table for the last applied event per data usage agreement, required in standard queue mode
+
+resource "aws_dynamodb_table" "agreement_ledger" {
+  count        = local.ledger_enabled ? 1 : 0
+  name         = "dmm-integration-agreement-ledger"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "agreement_id"
+
+  attribute {
+    name = "agreement_id"
+    type = "S"
+  }
+}
+
+# allow the manage_iam_policies lambda to read and write the ledger
+
+data "aws_iam_policy_document" "manage_iam_policies_ledger_access" {
+  count = local.ledger_enabled ? 1 : 0
+
+  statement {
+    effect  = "Allow"
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:BatchGetItem",
+      "dynamodb:PutItem"
+    ]
+    resources = [aws_dynamodb_table.agreement_ledger[0].arn]
+  }
+}
+
+resource "aws_iam_role_policy" "manage_iam_policies_ledger_access" {
+  count  = local.ledger_enabled ? 1 : 0
+  role   = aws_iam_role.manage_iam_policies_iam_role.name
+  policy = data.aws_iam_policy_document.manage_iam_policies_ledger_access[0].json
+}
+
+# create table for the feed positions, if they are not kept in S3
+
+resource "aws_dynamodb_table" "feed_checkpoints" {
+  count        = var.checkpoint_store == "dynamodb" ? 1 : 0
+  name         = "dmm-integration-feed-checkpoints"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "feed"
+
+  attribute {
+    name = "feed"
+    type = "S"
+  }
+}
+
+# allow the poll_feed lambda to read and conditionally write the feed positions
+
+data "aws_iam_policy_document" "poll_feed_checkpoint_access" {
+  count = var.checkpoint_store == "dynamodb" ? 1 : 0
+
+  statement {
+    effect  = "Allow"
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:PutItem"
+    ]
+    resources = [aws_dynamodb_table.feed_checkpoints[0].arn]
+  }
+}
+
+resource "aws_iam_role_policy" "poll_feed_checkpoint_access" {
+  count  = var.checkpoint_store == "dynamodb" ? 1 : 0
+  role   = aws_iam_role.poll_feed_iam_role.name
+  policy = data.aws_iam_policy_document.poll_feed_checkpoint_access[0].json
+}
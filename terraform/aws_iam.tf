@@ -15,3 +15,24 @@ resource "aws_iam_role_policy" "manage_iam_policies_iam_control" {
   role   = aws_iam_role.manage_iam_policies_iam_role.name
   policy = data.aws_iam_policy_document.manage_iam_policies_iam_control.json
 }
+
+# allow the manage_iam_policies lambda to manage iam policies in the accounts of consumers
+
+data "aws_caller_identity" "current" {}
+
+data "aws_partition" "current" {}
+
+data "aws_iam_policy_document" "manage_iam_policies_assume_target_account_role" {
+  count = var.target_account_role_name == "" ? 0 : 1
+  statement {
+    effect    = "Allow"
+    actions   = ["sts:AssumeRole"]
+    resources = ["arn:${data.aws_partition.current.partition}:iam::*:role/${var.target_account_role_name}"]
+  }
+}
+
+resource "aws_iam_role_policy" "manage_iam_policies_assume_target_account_role" {
+  count  = var.target_account_role_name == "" ? 0 : 1
+  role   = aws_iam_role.manage_iam_policies_iam_role.name
+  policy = data.aws_iam_policy_document.manage_iam_policies_assume_target_account_role[0].json
+}
@@ -14,6 +14,26 @@ resource "aws_lambda_function" "manage_iam_policies_lambda_function" {
     variables = {
       dmm_base_url                   = local.dmm_base_url
       dmm_api_key_secret_name        = local.dmm_api_key_secret_name
+      feeds                          = local.feeds
+      dead_letter_queue_url          = aws_sqs_queue.dmm_events_dead_letter_queue.url
+      max_receive_count              = var.max_receive_count
+      ledger_table_name              = local.ledger_enabled ? aws_dynamodb_table.agreement_ledger[0].name : ""
+      own_account_id                 = data.aws_caller_identity.current.account_id
+      aws_partition                  = data.aws_partition.current.partition
+      target_account_role_name       = var.target_account_role_name
+      target_account_external_id     = var.target_account_external_id
+      max_account_concurrency        = var.max_account_concurrency
+      dmm_document_cache_size        = var.dmm_document_cache_size
+      dmm_document_cache_ttl_seconds = var.dmm_document_cache_ttl_seconds
+      outbox_queue_url               = var.dmm_outbox ? aws_sqs_queue.dmm_outbox_queue[0].url : ""
+      outbox_dead_letter_queue_url   = var.dmm_outbox ? aws_sqs_queue.dmm_outbox_dead_letter_queue[0].url : ""
+      outbox_max_receive_count       = var.outbox_max_receive_count
+      log_level                      = var.log_level
+      log_levels                     = var.log_levels
+      log_sample_rate                = var.log_sample_rate
+      profile_sample_rate            = var.profile_sample_rate
+      profile_bucket_name            = var.profile_to_s3 ? var.bucket_name : ""
+      profile_object_prefix          = local.profile_object_prefix
     }
   }
 }
@@ -21,8 +41,39 @@ resource "aws_lambda_function" "manage_iam_policies_lambda_function" {
 # trigger lambda on event in sqs
 
 resource "aws_lambda_event_source_mapping" "manage_iam_policies_sqs_trigger" {
-  event_source_arn = aws_sqs_queue.dmm_events_queue.arn
-  function_name    = aws_lambda_function.manage_iam_policies_lambda_function.arn
+  event_source_arn        = aws_sqs_queue.dmm_events_queue.arn
+  function_name           = aws_lambda_function.manage_iam_policies_lambda_function.arn
+  function_response_types = ["ReportBatchItemFailures"]
+  batch_size              = var.batch_size
+
+  # standard queues allow to wait for larger batches and to process them concurrently
+  maximum_batching_window_in_seconds = local.fifo_queue ? null : 1
+
+  dynamic "scaling_config" {
+    for_each = local.fifo_queue ? [] : [var.maximum_concurrency]
+    content {
+      maximum_concurrency = scaling_config.value
+    }
+  }
+}
+
+# trigger lambda on revocations in the priority queue, independent of other events
+
+resource "aws_lambda_event_source_mapping" "manage_iam_policies_sqs_priority_trigger" {
+  count                   = var.priority_lane ? 1 : 0
+  event_source_arn        = aws_sqs_queue.dmm_priority_events_queue[0].arn
+  function_name           = aws_lambda_function.manage_iam_policies_lambda_function.arn
+  function_response_types = ["ReportBatchItemFailures"]
+}
+
+# trigger lambda on updates of data usage agreements in the outbox
+
+resource "aws_lambda_event_source_mapping" "manage_iam_policies_sqs_outbox_trigger" {
+  count                   = var.dmm_outbox ? 1 : 0
+  event_source_arn        = aws_sqs_queue.dmm_outbox_queue[0].arn
+  function_name           = aws_lambda_function.manage_iam_policies_lambda_function.arn
+  function_response_types = ["ReportBatchItemFailures"]
+  batch_size              = 10
 }
 
 # basic iam configuration to assume role
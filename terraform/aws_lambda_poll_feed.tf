@@ -16,7 +16,19 @@ resource "aws_lambda_function" "poll_feed_lambda_function" {
       dmm_base_url              = local.dmm_base_url
       dmm_api_key_secret_name   = local.dmm_api_key_secret_name
       last_event_id_object_name = local.last_event_id_object_name
+      checkpoint_store          = var.checkpoint_store
+      checkpoint_table_name     = var.checkpoint_store == "dynamodb" ? aws_dynamodb_table.feed_checkpoints[0].name : ""
+      circuit_state_object_name = local.circuit_state_object_name
+      feeds                     = local.feeds
+      max_feed_concurrency      = var.max_feed_concurrency
       sqs_queue_url             = aws_sqs_queue.dmm_events_queue.url
+      priority_sqs_queue_url    = var.priority_lane ? aws_sqs_queue.dmm_priority_events_queue[0].url : ""
+      log_level                 = var.log_level
+      log_levels                = var.log_levels
+      log_sample_rate           = var.log_sample_rate
+      profile_sample_rate       = var.profile_sample_rate
+      profile_bucket_name       = var.profile_to_s3 ? var.bucket_name : ""
+      profile_object_prefix     = local.profile_object_prefix
     }
   }
 }
@@ -43,6 +55,23 @@ resource "aws_lambda_permission" "poll_feed_schedule_permission" {
   principal     = "events.amazonaws.com"
 }
 
+# alarm once poll feed falls behind a feed, the metrics of several organizations have their Feed as dimension
+
+resource "aws_cloudwatch_metric_alarm" "poll_feed_lag_alarm" {
+  for_each            = var.feed_lag_alarm_threshold_seconds > 0 ? toset(local.feed_names) : toset([])
+  alarm_name          = each.key == "" ? "DMM_integration__feed_lag" : "DMM_integration__feed_lag_${each.key}"
+  alarm_description   = "The oldest event in the Data Mesh Manager feed that poll_feed has not processed yet is too old"
+  namespace           = "DMMIntegration"
+  metric_name         = "FeedLag"
+  dimensions          = each.key == "" ? null : { Feed = each.key }
+  statistic           = "Maximum"
+  period              = 60
+  evaluation_periods  = 5
+  threshold           = var.feed_lag_alarm_threshold_seconds * 1000
+  comparison_operator = "GreaterThanThreshold"
+  treat_missing_data  = "breaching"
+}
+
 # basic iam configuration to assume role
 
 data "aws_iam_policy_document" "poll_feed_assume_role" {
@@ -14,6 +14,8 @@ resource "aws_s3_bucket_versioning" "versioning_example" {
 }
 
 # give access to s3 bucket to poll_feed lambda to keep state of latest event id
+# and of the circuit breaker for the Data Mesh Manager API, and to both lambdas
+# to write profiles
 
 data "aws_iam_policy_document" "poll_feed_s3_access" {
   statement {
@@ -23,7 +25,13 @@ data "aws_iam_policy_document" "poll_feed_s3_access" {
     }
     effect    = "Allow"
     actions   = ["s3:GetObject", "s3:PutObject"]
-    resources = ["${data.aws_s3_bucket.common_s3_bucket.arn}/${local.last_event_id_object_name}"]
+    resources = [
+      "${data.aws_s3_bucket.common_s3_bucket.arn}/${local.last_event_id_object_name}",
+      "${data.aws_s3_bucket.common_s3_bucket.arn}/${local.circuit_state_object_name}",
+      # feed positions and circuit states of further organizations
+      "${data.aws_s3_bucket.common_s3_bucket.arn}/poll_feed/*/last_event_id",
+      "${data.aws_s3_bucket.common_s3_bucket.arn}/poll_feed/*/circuit_state"
+    ]
   }
 
   statement {
@@ -35,6 +43,20 @@ data "aws_iam_policy_document" "poll_feed_s3_access" {
     actions   = ["s3:ListBucket"]
     resources = [data.aws_s3_bucket.common_s3_bucket.arn]
   }
+
+  # profiles of sampled invocations of both functions
+  dynamic "statement" {
+    for_each = var.profile_to_s3 ? [1] : []
+    content {
+      principals {
+        identifiers = [aws_iam_role.poll_feed_iam_role.arn, aws_iam_role.manage_iam_policies_iam_role.arn]
+        type        = "AWS"
+      }
+      effect    = "Allow"
+      actions   = ["s3:PutObject"]
+      resources = ["${data.aws_s3_bucket.common_s3_bucket.arn}/${local.profile_object_prefix}*"]
+    }
+  }
 }
 
 resource "aws_s3_bucket_policy" "poll_feed_s3_access" {
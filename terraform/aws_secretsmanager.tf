@@ -32,3 +32,40 @@ resource "aws_secretsmanager_secret_policy" "lambda_secretsmanager_access" {
   secret_arn = aws_secretsmanager_secret.dmm_api_key.arn
   policy     = data.aws_iam_policy_document.lambda_secretsmanager_access.json
 }
+
+# create secrets for further organizations, with the same access
+
+resource "aws_secretsmanager_secret" "organization_api_key" {
+  for_each                       = toset(var.organizations)
+  name                           = "${var.secrets_manager_prefix}${each.key}/api_key"
+  force_overwrite_replica_secret = true # make sure to override secret
+  recovery_window_in_days        = 0    # force deletion on destroy
+}
+
+resource "aws_secretsmanager_secret_version" "organization_api_key" {
+  for_each      = toset(var.organizations)
+  secret_id     = aws_secretsmanager_secret.organization_api_key[each.key].id
+  secret_string = var.organization_api_keys[each.key]
+}
+
+data "aws_iam_policy_document" "lambda_organization_secretsmanager_access" {
+  for_each = toset(var.organizations)
+  statement {
+    principals {
+      identifiers = [
+        aws_iam_role.poll_feed_iam_role.arn,
+        aws_iam_role.manage_iam_policies_iam_role.arn
+      ]
+      type = "AWS"
+    }
+    effect    = "Allow"
+    actions   = ["secretsmanager:GetSecretValue"]
+    resources = [aws_secretsmanager_secret.organization_api_key[each.key].arn]
+  }
+}
+
+resource "aws_secretsmanager_secret_policy" "lambda_organization_secretsmanager_access" {
+  for_each   = toset(var.organizations)
+  secret_arn = aws_secretsmanager_secret.organization_api_key[each.key].arn
+  policy     = data.aws_iam_policy_document.lambda_organization_secretsmanager_access[each.key].json
+}
@@ -1,10 +1,65 @@
 # create queue for forwarded DMM events in sqs
 
 resource "aws_sqs_queue" "dmm_events_queue" {
-  name                        = var.event_queue_name
-  fifo_queue                  = true
-  content_based_deduplication = true
+  name                        = local.event_queue_name
+  fifo_queue                  = local.fifo_queue
+  content_based_deduplication = local.fifo_queue ? true : null
   visibility_timeout_seconds  = 60 # six times the consuming lambda timeout as stated in aws docs
+
+  # manage_iam_policies moves poison messages itself, this is the fallback if it crashes
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.dmm_events_dead_letter_queue.arn
+    maxReceiveCount     = var.max_receive_count + 1
+  })
+}
+
+# create queue for revocations of access, which are processed before other events,
+# the claims in the agreement ledger keep the order of the events of an agreement across both queues
+
+resource "aws_sqs_queue" "dmm_priority_events_queue" {
+  count                       = var.priority_lane ? 1 : 0
+  name                        = "${trimsuffix(var.event_queue_name, ".fifo")}-priority${local.queue_suffix}"
+  fifo_queue                  = local.fifo_queue
+  content_based_deduplication = local.fifo_queue ? true : null
+  visibility_timeout_seconds  = 60
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.dmm_events_dead_letter_queue.arn
+    maxReceiveCount     = var.max_receive_count + 1
+  })
+}
+
+# create queue for updates of data usage agreements after their access change,
+# ordered per agreement
+
+resource "aws_sqs_queue" "dmm_outbox_queue" {
+  count                      = var.dmm_outbox ? 1 : 0
+  name                       = "${trimsuffix(var.event_queue_name, ".fifo")}-outbox.fifo"
+  fifo_queue                 = true
+  deduplication_scope        = "messageGroup"
+  fifo_throughput_limit      = "perMessageGroupId"
+  visibility_timeout_seconds = 60
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.dmm_outbox_dead_letter_queue[0].arn
+    maxReceiveCount     = var.outbox_max_receive_count + 1
+  })
+}
+
+resource "aws_sqs_queue" "dmm_outbox_dead_letter_queue" {
+  count                     = var.dmm_outbox ? 1 : 0
+  name                      = "${trimsuffix(var.event_queue_name, ".fifo")}-outbox-dlq.fifo"
+  fifo_queue                = true
+  message_retention_seconds = 1209600 # 14 days, the maximum
+}
+
+# create dead-letter queue for events which could not be processed
+
+resource "aws_sqs_queue" "dmm_events_dead_letter_queue" {
+  name                        = "${trimsuffix(var.event_queue_name, ".fifo")}-dlq${local.queue_suffix}"
+  fifo_queue                  = local.fifo_queue
+  content_based_deduplication = local.fifo_queue ? true : null
+  message_retention_seconds   = 1209600 # 14 days, the maximum
 }
 
 # give access to DMM event queue to lambdas
@@ -26,7 +81,12 @@ data "aws_iam_policy_document" "lambda_sqs_access" {
       type        = "AWS"
     }
     effect    = "Allow"
-    actions   = ["sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:GetQueueAttributes"]
+    actions   = [
+      "sqs:ReceiveMessage",
+      "sqs:DeleteMessage",
+      "sqs:GetQueueAttributes",
+      "sqs:ChangeMessageVisibility"
+    ]
     resources = [aws_sqs_queue.dmm_events_queue.arn]
   }
 }
@@ -35,3 +95,107 @@ resource "aws_sqs_queue_policy" "lambda_sqs_access" {
   queue_url = aws_sqs_queue.dmm_events_queue.id
   policy    = data.aws_iam_policy_document.lambda_sqs_access.json
 }
+
+# give the same access to the priority queue
+
+data "aws_iam_policy_document" "lambda_sqs_priority_access" {
+  count = var.priority_lane ? 1 : 0
+
+  statement {
+    principals {
+      identifiers = [aws_iam_role.poll_feed_iam_role.arn]
+      type        = "AWS"
+    }
+    actions   = ["sqs:SendMessage", "sqs:GetQueueUrl"]
+    effect    = "Allow"
+    resources = [aws_sqs_queue.dmm_priority_events_queue[0].arn]
+  }
+
+  statement {
+    principals {
+      identifiers = [aws_iam_role.manage_iam_policies_iam_role.arn]
+      type        = "AWS"
+    }
+    effect    = "Allow"
+    actions   = [
+      "sqs:ReceiveMessage",
+      "sqs:DeleteMessage",
+      "sqs:GetQueueAttributes",
+      "sqs:ChangeMessageVisibility"
+    ]
+    resources = [aws_sqs_queue.dmm_priority_events_queue[0].arn]
+  }
+}
+
+resource "aws_sqs_queue_policy" "lambda_sqs_priority_access" {
+  count     = var.priority_lane ? 1 : 0
+  queue_url = aws_sqs_queue.dmm_priority_events_queue[0].id
+  policy    = data.aws_iam_policy_document.lambda_sqs_priority_access[0].json
+}
+
+# give access to the dead-letter queue to manage_iam_policies lambda
+
+data "aws_iam_policy_document" "lambda_sqs_dead_letter_access" {
+  statement {
+    principals {
+      identifiers = [aws_iam_role.manage_iam_policies_iam_role.arn]
+      type        = "AWS"
+    }
+    actions   = ["sqs:SendMessage"]
+    effect    = "Allow"
+    resources = [aws_sqs_queue.dmm_events_dead_letter_queue.arn]
+  }
+}
+
+resource "aws_sqs_queue_policy" "lambda_sqs_dead_letter_access" {
+  queue_url = aws_sqs_queue.dmm_events_dead_letter_queue.id
+  policy    = data.aws_iam_policy_document.lambda_sqs_dead_letter_access.json
+}
+
+# give access to the outbox and its dead-letter queue to manage_iam_policies lambda
+
+data "aws_iam_policy_document" "lambda_sqs_outbox_access" {
+  count = var.dmm_outbox ? 1 : 0
+
+  statement {
+    principals {
+      identifiers = [aws_iam_role.manage_iam_policies_iam_role.arn]
+      type        = "AWS"
+    }
+    effect    = "Allow"
+    actions   = [
+      "sqs:SendMessage",
+      "sqs:ReceiveMessage",
+      "sqs:DeleteMessage",
+      "sqs:GetQueueAttributes",
+      "sqs:ChangeMessageVisibility"
+    ]
+    resources = [aws_sqs_queue.dmm_outbox_queue[0].arn]
+  }
+}
+
+resource "aws_sqs_queue_policy" "lambda_sqs_outbox_access" {
+  count     = var.dmm_outbox ? 1 : 0
+  queue_url = aws_sqs_queue.dmm_outbox_queue[0].id
+  policy    = data.aws_iam_policy_document.lambda_sqs_outbox_access[0].json
+}
+
+data "aws_iam_policy_document" "lambda_sqs_outbox_dead_letter_access" {
+  count = var.dmm_outbox ? 1 : 0
+
+  statement {
+    principals {
+      identifiers = [aws_iam_role.manage_iam_policies_iam_role.arn]
+      type        = "AWS"
+    }
+    actions   = ["sqs:SendMessage"]
+    effect    = "Allow"
+    resources = [aws_sqs_queue.dmm_outbox_dead_letter_queue[0].arn]
+  }
+}
+
+resource "aws_sqs_queue_policy" "lambda_sqs_outbox_dead_letter_access" {
+  count     = var.dmm_outbox ? 1 : 0
+  queue_url = aws_sqs_queue.dmm_outbox_dead_letter_queue[0].id
+  policy    = data.aws_iam_policy_document.lambda_sqs_outbox_dead_letter_access[0].json
+}
@@ -1,5 +1,26 @@
 locals {
   dmm_api_key_secret_name   = "${var.secrets_manager_prefix}api_key"
   last_event_id_object_name = "poll_feed/last_event_id"
+  circuit_state_object_name = "poll_feed/circuit_state"
+  profile_object_prefix     = "profiles/"
   dmm_base_url              = "https://api.datamesh-manager.com"
+  fifo_queue                = var.queue_mode == "fifo"
+  queue_suffix              = local.fifo_queue ? ".fifo" : ""
+  event_queue_name          = "${trimsuffix(var.event_queue_name, ".fifo")}${local.queue_suffix}"
+  ledger_enabled            = !local.fifo_queue || var.priority_lane
+  # the single feed has no name
+  feed_names = length(var.organizations) == 0 ? [""] : concat(["primary"], var.organizations)
+  # the organization of var.dmm keeps its feed position, further organizations get their own
+  feeds = length(var.organizations) == 0 ? "" : jsonencode(concat(
+    [{
+      name                      = "primary"
+      dmm_api_key_secret_name   = local.dmm_api_key_secret_name
+      last_event_id_object_name = local.last_event_id_object_name
+      circuit_state_object_name = local.circuit_state_object_name
+    }],
+    [for name in var.organizations : {
+      name                    = name
+      dmm_api_key_secret_name = "${var.secrets_manager_prefix}${name}/api_key"
+    }]
+  ))
 }
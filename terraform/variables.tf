@@ -16,6 +16,30 @@ variable "dmm" {
   description = "Data Mesh Manager configuration"
 }
 
+variable "organizations" {
+  type        = list(string)
+  default     = []
+  description = "Names of further Data Mesh Manager organizations whose feeds are polled as well, e.g. ['org-a', 'org-b']"
+
+  validation {
+    condition     = alltrue([for name in var.organizations : can(regex("^[a-zA-Z0-9_-]{1,64}$", name)) && name != "primary"])
+    error_message = "Names may contain letters, digits, '_' and '-', 'primary' is the organization of var.dmm."
+  }
+}
+
+variable "organization_api_keys" {
+  type        = map(string)
+  default     = {}
+  sensitive   = true
+  description = "The api key of every further organization by its name"
+}
+
+variable "max_feed_concurrency" {
+  type        = number
+  default     = 8
+  description = "How many feeds of organizations poll_feed polls at once"
+}
+
 variable "versions" {
   type = object({
     poll_feed           = string
@@ -39,5 +63,134 @@ variable "secrets_manager_prefix" {
 variable "event_queue_name" {
   type        = string
   default     = "dmm-events.fifo"
-  description = "The name of the sqs queue in which the dmm events get forwarded. Must end with '.fifo'."
+  description = "The name of the sqs queue in which the dmm events get forwarded. Must end with '.fifo'. The suffix is removed for standard queues."
+}
+
+variable "queue_mode" {
+  type        = string
+  default     = "fifo"
+  description = "Either 'fifo' or 'standard'. In standard mode, ordering and deduplication of events is done by manage_iam_policies using a DynamoDB table, which allows larger batches and more concurrency."
+
+  validation {
+    condition     = contains(["fifo", "standard"], var.queue_mode)
+    error_message = "The queue_mode must be either 'fifo' or 'standard'."
+  }
+}
+
+variable "batch_size" {
+  type        = number
+  default     = 10
+  description = "The maximum number of events passed to manage_iam_policies at once. Values above 10 require the standard queue mode."
+}
+
+variable "maximum_concurrency" {
+  type        = number
+  default     = 2
+  description = "The maximum number of concurrent manage_iam_policies invocations. Only used in standard queue mode."
+}
+
+variable "max_receive_count" {
+  type        = number
+  default     = 5
+  description = "How often an event is processed before it is moved to the dead-letter queue"
+}
+
+variable "checkpoint_store" {
+  type        = string
+  default     = "s3"
+  description = "Where poll_feed keeps the position of each feed: 's3' for an object in the bucket or 'dynamodb' for a table with faster reads and writes. Both are written conditionally, so overlapping runs cannot move a position back."
+
+  validation {
+    condition     = contains(["s3", "dynamodb"], var.checkpoint_store)
+    error_message = "The checkpoint_store must be either 's3' or 'dynamodb'."
+  }
+}
+
+variable "priority_lane" {
+  type        = bool
+  default     = false
+  description = "Send revocations of access through a separate queue, so they do not wait behind other events. Enables the DynamoDB ledger of the standard queue mode, in which an event claims its data usage agreement before changing IAM, to keep the order of events per data usage agreement across both queues."
+}
+
+variable "dmm_outbox" {
+  type        = bool
+  default     = false
+  description = "Update data usage agreements in Data Mesh Manager from a separate queue after their access change, so a slow or failing Data Mesh Manager does not delay access changes or cause them to be redone"
+}
+
+variable "outbox_max_receive_count" {
+  type        = number
+  default     = 10
+  description = "How often an update of a data usage agreement is tried before it is moved to the dead-letter queue of the outbox"
+}
+
+variable "feed_lag_alarm_threshold_seconds" {
+  type        = number
+  default     = 0
+  description = "Raise a CloudWatch alarm if the oldest event in the feed that poll_feed has not processed yet is older than this when a run starts. 0 disables the alarm."
+}
+
+variable "target_account_role_name" {
+  type        = string
+  default     = ""
+  description = "Name of the role manage_iam_policies assumes in the accounts of consumers with the custom field aws-account-id. Empty disables roles in other accounts."
+}
+
+variable "target_account_external_id" {
+  type        = string
+  default     = ""
+  description = "External id required by the roles in the accounts of consumers, if any"
+}
+
+variable "max_account_concurrency" {
+  type        = number
+  default     = 8
+  description = "How many accounts of consumers manage_iam_policies changes at once"
+}
+
+variable "dmm_document_cache_size" {
+  type        = number
+  default     = 10000
+  description = "How many data products and data usage agreements manage_iam_policies keeps between invocations until the feed reports a change. 0 keeps them for a single invocation."
+}
+
+variable "dmm_document_cache_ttl_seconds" {
+  type        = number
+  default     = 300
+  description = "Read kept documents again after this time, even if the feed reported no change. Invalidations only reach the warm container that handles the event, so other containers may grant access based on outdated documents until then. Revocations always read their documents again."
+
+  validation {
+    condition     = var.dmm_document_cache_ttl_seconds > 0 && var.dmm_document_cache_ttl_seconds <= 3600
+    error_message = "The dmm_document_cache_ttl_seconds must be more than 0 and at most 3600."
+  }
+}
+
+variable "log_level" {
+  type        = string
+  default     = "INFO"
+  description = "The log level of both functions"
+}
+
+variable "log_levels" {
+  type        = string
+  default     = ""
+  description = "Levels of single loggers, e.g. 'poll_feed.events=WARNING,botocore=ERROR'"
+}
+
+variable "log_sample_rate" {
+  type        = number
+  default     = 1
+  description = "The share of events for which the lines per event are logged. Warnings and errors are always logged."
+}
+
+variable "profile_sample_rate" {
+  type        = number
+  default     = 0
+  description = "The share of invocations of both functions which are profiled with cProfile and tracemalloc. 0 disables profiling."
+}
+
+variable "profile_to_s3" {
+  type        = bool
+  default     = false
+  description = "Write the profiles to the bucket in addition to the logs"
 }
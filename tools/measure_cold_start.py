@@ -0,0 +1,151 @@
+"""Measures the cold start of both Lambda functions
+
+Every run imports lambda_handler, and with it the shared module, in a fresh
+interpreter, as it happens on a cold start, and then creates the boto3 clients
+the first invocation uses. It reports the median and minimum of the init and
+of the init plus the first invocation, as a handler which imports boto3 lazily
+only moves that time to its first invocation. With --baseline the handlers of
+another git revision are measured as well, so that the effect of a change on
+the cold start can be reported as before and after.
+
+Example:
+    python3 tools/measure_cold_start.py --runs 20 --baseline HEAD~1 --no-bytecode-cache
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+LAMBDAS = ['poll_feed', 'manage_iam_policies']
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# executed in the fresh interpreter, prints the init duration and the one
+# including the first invocation in milliseconds. The clients are created
+# with boto3 itself, as the handlers of older revisions have no aws_client
+IMPORT_SCRIPT = '''
+import time
+start = time.perf_counter()
+import lambda_handler
+init = time.perf_counter()
+import boto3
+for service in {services}:
+    boto3.client(service)
+print((init - start) * 1000, (time.perf_counter() - start) * 1000)
+'''
+
+# as listed in AWS_SERVICES of cicd.sh
+SERVICES = {
+    'poll_feed': ['s3', 'sqs', 'secretsmanager', 'dynamodb'],
+    'manage_iam_policies': ['iam', 'sqs', 'secretsmanager', 'dynamodb', 'sts'],
+}
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--baseline', default=None,
+                        help='git revision to compare against, e.g. HEAD~1 or main')
+    parser.add_argument('--no-bytecode-cache', action='store_true',
+                        help='compile all modules on every run, like a bundle without precompiled bytecode')
+    parser.add_argument('--slowest', type=int, default=0,
+                        help='list this many modules with the highest cumulative import time')
+    args = parser.parse_args()
+
+    for name in LAMBDAS:
+        measurement = ColdStartMeasurement(name, args.no_bytecode_cache)
+        current = measurement.run(os.path.join(REPOSITORY, 'src', name), args.runs)
+        if args.baseline is None:
+            logging.info('{}: {}'.format(name, report(current)))
+        else:
+            with tempfile.TemporaryDirectory() as directory:
+                checkout_handler(args.baseline, name, directory)
+                before = measurement.run(directory, args.runs)
+            logging.info('{} before: {}'.format(name, report(before)))
+            logging.info('{} after:  {}'.format(name, report(current)))
+
+        if args.slowest > 0:
+            for module, micros in measurement.slowest_imports(os.path.join(REPOSITORY, 'src', name), args.slowest):
+                logging.info('  {:>8.1f} ms  {}'.format(micros / 1000, module))
+
+
+def report(durations: dict[str, tuple[float, float]]) -> str:
+    return '; '.join('{} median {:.0f} ms, min {:.0f} ms'.format(stage, *duration)
+                     for stage, duration in durations.items())
+
+
+def checkout_handler(revision: str, name: str, directory: str) -> None:
+    checkout_file(revision, 'src/{}/lambda_handler.py'.format(name), directory)
+    # revisions before the shared module was introduced do not have it
+    if subprocess.run(['git', 'cat-file', '-e', '{}:src/common/dmm_common.py'.format(revision)],
+                      cwd=REPOSITORY, capture_output=True).returncode == 0:
+        checkout_file(revision, 'src/common/dmm_common.py', directory)
+
+
+def checkout_file(revision: str, path: str, directory: str) -> None:
+    source = subprocess.run(['git', 'show', '{}:{}'.format(revision, path)],
+                            cwd=REPOSITORY, check=True, capture_output=True).stdout
+    with open(os.path.join(directory, os.path.basename(path)), 'wb') as file:
+        file.write(source)
+
+
+class ColdStartMeasurement:
+    def __init__(self, name: str, no_bytecode_cache: bool):
+        self._no_bytecode_cache = no_bytecode_cache
+        self._script = IMPORT_SCRIPT.format(services=SERVICES[name])
+        # the shared module is next to the handler in the bundle, the copy of a checked out revision is found first
+        self._environment = dict(os.environ, AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'eu-central-1'),
+                                 PYTHONPATH=os.path.join(REPOSITORY, 'src', 'common'))
+
+    def run(self, directory: str, runs: int) -> dict[str, tuple[float, float]]:
+        """Returns the median and minimum of the init and of the init plus
+        the first invocation
+        """
+
+        # the first run populates the bytecode cache unless it is disabled
+        self._import(directory)
+        inits, first_invocations = zip(*(self._import(directory) for _ in range(runs)))
+        return {'init': (statistics.median(inits), min(inits)),
+                'init and first invocation': (statistics.median(first_invocations),
+                                              min(first_invocations))}
+
+    def slowest_imports(self, directory: str, count: int) -> list[tuple[str, int]]:
+        output = self._interpreter(directory, ['-X', 'importtime']).stderr
+        cumulative = {}
+        for line in output.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, micros, module = line.split('|')
+            cumulative[module.strip()] = int(micros)
+        return sorted(cumulative.items(), key=lambda item: item[1], reverse=True)[:count]
+
+    def _import(self, directory: str) -> tuple[float, float]:
+        init, first_invocation = self._interpreter(directory, []).stdout.strip().splitlines()[-1].split()
+        return float(init), float(first_invocation)
+
+    def _interpreter(self, directory: str, options: list[str]) -> subprocess.CompletedProcess:
+        cache = tempfile.mkdtemp() if self._no_bytecode_cache else None
+        try:
+            if cache is not None:
+                options = options + ['-X', 'pycache_prefix={}'.format(cache)]
+            started = time.perf_counter()
+            result = subprocess.run([sys.executable, *options, '-c', self._script],
+                                    cwd=directory, env=self._environment, check=True,
+                                    capture_output=True, text=True)
+            logging.debug('Run took {:.0f} ms'.format((time.perf_counter() - started) * 1000))
+            return result
+        finally:
+            if cache is not None:
+                shutil.rmtree(cache, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""Moves messages from the dead-letter queue back to the events queue
+
+Messages are replayed at a limited rate, so that manage_iam_policies and the
+Data Mesh Manager API are not flooded after an outage. Every message is only
+deleted from the dead-letter queue once it was sent to the target queue.
+
+An event replayed behind later events of its data usage agreement would undo
+them. Events are therefore checked against the agreement ledger first, and
+events which the ledger shows as applied or outdated are dropped instead of
+replayed. Without a ledger, i.e. with the fifo queue and no priority lane,
+messages are only listed and have to be checked by hand.
+
+Example:
+    python3 tools/redrive_dlq.py \\
+        --dead-letter-queue-url https://sqs.<region>.amazonaws.com/<account>/dmm-events-dlq \\
+        --target-queue-url https://sqs.<region>.amazonaws.com/<account>/dmm-events \\
+        --ledger-table-name dmm-integration-agreement-ledger \\
+        --messages-per-second 2
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import boto3
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'src', 'common'))
+
+from dmm_common import event_time  # noqa: E402
+
+DATA_USAGE_AGREEMENT_EVENT_TYPES = (
+    'com.datamesh-manager.events.DataUsageAgreementDeactivatedEvent',
+    'com.datamesh-manager.events.DataUsageAgreementActivatedEvent')
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dead-letter-queue-url', required=True)
+    parser.add_argument('--target-queue-url', required=True)
+    parser.add_argument('--ledger-table-name', default=None,
+                        help='agreement ledger of manage_iam_policies, required unless --dry-run')
+    parser.add_argument('--messages-per-second', type=float, default=1.0)
+    parser.add_argument('--max-messages', type=int, default=None,
+                        help='stop after this many messages')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only print the messages which would be moved')
+    args = parser.parse_args()
+    if args.ledger_table_name is None and not args.dry_run:
+        parser.error('without the agreement ledger, replayed events could undo later ones, '
+                     'use --dry-run to list them')
+
+    ledger = None if args.ledger_table_name is None else \
+        AgreementLedger(boto3.client('dynamodb'), args.ledger_table_name)
+    redrive = Redrive(boto3.client('sqs'),
+                      args.dead_letter_queue_url,
+                      args.target_queue_url,
+                      args.messages_per_second,
+                      ledger)
+    moved, dropped = redrive.run(args.max_messages, args.dry_run)
+
+    logging.info('{} {} messages, {} {} outdated ones'.format(
+        'Found' if args.dry_run else 'Moved', moved,
+        'found' if args.dry_run else 'dropped', dropped))
+
+
+class AgreementLedger:
+    """Reads the last event applied to a data usage agreement, as
+    manage_iam_policies records it
+    """
+
+    def __init__(self, dynamodb, table_name: str):
+        self._dynamodb = dynamodb
+        self._table_name = table_name
+
+    def superseding_event_id(self, event: dict) -> str | None:
+        """Returns the id of the event that was applied instead of the given
+        one or after it, or None if the event can be replayed
+        """
+
+        if event.get('type') not in DATA_USAGE_AGREEMENT_EVENT_TYPES:
+            return None
+
+        item = self._dynamodb.get_item(
+            TableName=self._table_name,
+            Key={'agreement_id': {'S': event['data']['id']}},
+            ConsistentRead=True).get('Item')
+        if item is None:
+            return None
+        if item['event_id']['S'] == event['id']:
+            # an unrecorded claim is left by an attempt which did not finish
+            return None if 'claimed_until' in item else event['id']
+        if int(item['version']['N']) > self._version(event):
+            return item['event_id']['S']
+        return None
+
+    @staticmethod
+    def _version(event: dict) -> int:
+        # as manage_iam_policies versions events
+        time_of_event = event_time(event)
+        if time_of_event is None:
+            return 0
+        return int(time_of_event.timestamp() * 1_000_000)
+
+
+class Redrive:
+    def __init__(self, sqs, dead_letter_queue_url: str, target_queue_url: str,
+        messages_per_second: float, ledger: AgreementLedger | None = None):
+        self._sqs = sqs
+        self._dead_letter_queue_url = dead_letter_queue_url
+        self._target_queue_url = target_queue_url
+        self._interval_seconds = 1 / messages_per_second
+        self._ledger = ledger
+
+    def run(self, max_messages: int | None, dry_run: bool) -> tuple[int, int]:
+        """Returns the number of moved and of dropped messages"""
+
+        moved = 0
+        dropped = 0
+        next_send = time.monotonic()
+        while max_messages is None or moved + dropped < max_messages:
+            messages = self._receive(10 if max_messages is None
+                                     else min(10, max_messages - moved - dropped))
+            if len(messages) == 0:
+                break
+
+            for message in messages:
+                superseding_event_id = self._superseding_event_id(message)
+                if superseding_event_id is not None:
+                    logging.info('{} is outdated by event {}'.format(
+                        message['MessageId'], superseding_event_id))
+                    if not dry_run:
+                        self._delete(message)
+                    dropped += 1
+                elif dry_run:
+                    logging.info('{}: {}'.format(message['MessageId'], message['Body']))
+                    moved += 1
+                else:
+                    time.sleep(max(next_send - time.monotonic(), 0))
+                    next_send = time.monotonic() + self._interval_seconds
+                    self._move(message)
+                    moved += 1
+
+        return moved, dropped
+
+    def _superseding_event_id(self, message: dict) -> str | None:
+        if self._ledger is None:
+            return None
+        return self._ledger.superseding_event_id(json.loads(message['Body']))
+
+    def _receive(self, max_number_of_messages: int) -> list[dict]:
+        response = self._sqs.receive_message(
+            QueueUrl=self._dead_letter_queue_url,
+            MaxNumberOfMessages=max_number_of_messages,
+            AttributeNames=['All'],
+            MessageAttributeNames=['All'],
+            WaitTimeSeconds=1,
+            VisibilityTimeout=60)
+        return response.get('Messages', [])
+
+    def _move(self, message: dict) -> None:
+        # the failure reason is only of interest in the dead-letter queue
+        message_attributes = {
+            name: attribute
+            for name, attribute in message.get('MessageAttributes', {}).items()
+            if name != 'dmm-error'}
+
+        request = {
+            'QueueUrl': self._target_queue_url,
+            'MessageBody': message['Body'],
+            'MessageAttributes': message_attributes
+        }
+        if self._target_queue_url.endswith('.fifo'):
+            request['MessageGroupId'] = message['Attributes']['MessageGroupId']
+            # a new id, otherwise the message might be dropped as a duplicate
+            request['MessageDeduplicationId'] = 'redrive-{}'.format(message['MessageId'])
+
+        self._sqs.send_message(**request)
+        self._delete(message)
+        logging.info('Moved {}'.format(message['MessageId']))
+
+    def _delete(self, message: dict) -> None:
+        self._sqs.delete_message(QueueUrl=self._dead_letter_queue_url,
+                                 ReceiptHandle=message['ReceiptHandle'])
+
+
+if __name__ == '__main__':
+    main()